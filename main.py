@@ -8,18 +8,34 @@
 Зависимости: requests
 """
 import argparse
+import asyncio
 import base64
+import bisect
+import codecs
+import collections
+import contextlib
+import errno
+import functools
+import hashlib
+import ipaddress
+import itertools
 import json
+import random
 import re
+import signal
 import socket
+import ssl
+import struct
 import sys
 import time
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from urllib.parse import urlparse, parse_qs, unquote
+from array import array
+from concurrent.futures import Future, ThreadPoolExecutor
+from urllib.parse import urlparse, parse_qs, unquote, urljoin
 
 import subprocess
 import statistics
 import platform
+import queue
 import requests
 import tempfile
 import os
@@ -35,6 +51,29 @@ try:
 except Exception:
     tqdm = None
 
+# optional brotli support: lets requests/urllib3 decode 'br' responses
+try:
+    import brotli  # noqa: F401
+    _ACCEPT_ENCODING = 'gzip, deflate, br'
+except Exception:
+    try:
+        import brotlicffi  # noqa: F401
+        _ACCEPT_ENCODING = 'gzip, deflate, br'
+    except Exception:
+        _ACCEPT_ENCODING = 'gzip, deflate'
+
+# optional DNS library: gives real record TTLs to the resolver cache
+try:
+    import dns.resolver as dns_resolver
+except Exception:
+    dns_resolver = None
+
+# optional gRPC runtime for xray's HandlerService; a built-in HTTP/2 client is used without it
+try:
+    import grpc
+except Exception:
+    grpc = None
+
 LINK_RE = re.compile(r"(vless|vmess|trojan|ss)://[^\s'\"<>]+", re.IGNORECASE)
 
 
@@ -47,6 +86,99 @@ def fetch_url(url, timeout=15):
         raise RuntimeError(f"Failed to fetch URL: {exc}")
 
 
+def read_url_list(path):
+    """Read subscription URLs from a file: one per line, '#' starts a comment."""
+    urls = []
+    with open(path, 'r', encoding='utf-8') as fh:
+        for line in fh:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                urls.append(line)
+    return urls
+
+
+def make_session(pool_size=16):
+    """requests.Session with a connection pool sized for concurrent subscription fetches."""
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.headers['Accept-Encoding'] = _ACCEPT_ENCODING
+    return session
+
+
+class SubscriptionCache:
+    """On-disk cache of subscription validators (ETag / Last-Modified) and parsed nodes,
+    one JSON file per URL, so an unchanged subscription costs a 304 and no re-parsing.
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    def _path(self, url):
+        return self.cache_dir / (hashlib.sha1(url.encode('utf-8')).hexdigest() + '.json')
+
+    def load(self, url):
+        try:
+            with open(self._path(url), 'r', encoding='utf-8') as fh:
+                entry = json.load(fh)
+            return entry if entry.get('url') == url else None
+        except Exception:
+            return None
+
+    def store(self, url, etag, last_modified, nodes):
+        entry = {'url': url, 'etag': etag, 'last_modified': last_modified, 'fetched_at': datetime.utcnow().isoformat(), 'nodes': nodes}
+        path = self._path(url)
+        tmp = path.with_suffix('.tmp')
+        with open(tmp, 'w', encoding='utf-8') as fh:
+            json.dump(entry, fh, ensure_ascii=False)
+        os.replace(tmp, path)
+
+
+def fetch_subscription(session, url, cache=None, timeout=15):
+    """Fetch and parse one subscription using conditional requests when cached.
+    Returns {'url', 'status': 'fetched'|'not_modified'|'stale'|'error', 'nodes', 'error'}.
+    On a network error the last cached node list is used ('stale') if there is one.
+    """
+    entry = cache.load(url) if cache else None
+    headers = {}
+    if entry:
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+    try:
+        resp = session.get(url, timeout=timeout, verify=False, headers=headers)
+        if resp.status_code == 304 and entry:
+            return {'url': url, 'status': 'not_modified', 'nodes': entry.get('nodes') or [], 'error': None}
+        resp.raise_for_status()
+        nodes = gather_nodes_from_text(resp.text)
+        if cache:
+            try:
+                cache.store(url, resp.headers.get('ETag'), resp.headers.get('Last-Modified'), nodes)
+            except Exception:
+                pass
+        return {'url': url, 'status': 'fetched', 'nodes': nodes, 'error': None}
+    except Exception as exc:
+        if entry:
+            return {'url': url, 'status': 'stale', 'nodes': entry.get('nodes') or [], 'error': str(exc)}
+        return {'url': url, 'status': 'error', 'nodes': [], 'error': str(exc)}
+
+
+def fetch_subscriptions(urls, cache_dir=None, workers=8, timeout=15, session=None):
+    """Fetch many subscriptions concurrently over one pooled session.
+    Returns the per-URL fetch_subscription dicts in input order.
+    """
+    urls = list(dict.fromkeys(urls))
+    if not urls:
+        return []
+    session = session or make_session(pool_size=max(1, min(workers, len(urls))))
+    cache = SubscriptionCache(cache_dir) if cache_dir else None
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(urls)))) as ex:
+        return list(ex.map(lambda u: fetch_subscription(session, u, cache=cache, timeout=timeout), urls))
+
+
 def try_base64_decode(text):
     """Попытаться декодировать base64 (если это закодированная подписка).
     Возвращает декодированную строку или None.
@@ -79,13 +211,30 @@ def find_links(text):
     return []
 
 
+def _b64_text(data):
+    """Decode standard or URL-safe base64 with or without padding."""
+    data = data.strip().replace('-', '+').replace('_', '/')
+    return base64.b64decode(data + '=' * (-len(data) % 4)).decode('utf-8', errors='ignore')
+
+
+# transport/security query parameters of vless and trojan share links
+_LINK_PARAMS = ('security', 'sni', 'fp', 'pbk', 'sid', 'spx', 'flow', 'serviceName', 'host', 'alpn', 'headerType', 'mode', 'allowInsecure')
+
+
+def _link_params(qs):
+    """Non-empty transport/TLS parameters of a vless/trojan link query."""
+    params = {k: qs[k][0] for k in _LINK_PARAMS if qs.get(k, [''])[0]}
+    if 'sni' not in params and qs.get('peer', [''])[0]:
+        params['sni'] = qs['peer'][0]
+    return params
+
+
 def parse_vmess(link):
     # vmess://<base64_json>
     b64 = link[len('vmess://'):]
     try:
-        decoded = base64.b64decode(b64 + '===').decode('utf-8', errors='ignore')
-        data = json.loads(decoded)
-        return {
+        data = json.loads(_b64_text(b64))
+        node = {
             'protocol': 'vmess',
             'ps': data.get('ps') or data.get('name'),
             'add': data.get('add') or data.get('host'),
@@ -96,6 +245,10 @@ def parse_vmess(link):
             'tls': data.get('tls'),
             'raw': link,
         }
+        for k in ('path', 'host', 'sni', 'alpn', 'fp', 'aid', 'scy'):
+            if data.get(k) not in (None, ''):
+                node[k] = str(data[k])
+        return node
     except Exception:
         return {'protocol': 'vmess', 'raw': link}
 
@@ -115,46 +268,50 @@ def parse_vless(link):
         'path': qs.get('path', [None])[0],
         'tls': 'tls' if qs.get('security', [None])[0] == 'tls' or qs.get('tls', [None])[0] == 'tls' else None,
         'raw': link,
+        **_link_params(qs),
     }
 
 
 def parse_trojan(link):
     # trojan://password@host:port?params#name
     u = urlparse(link)
+    qs = parse_qs(u.query)
     name = unquote(u.fragment) if u.fragment else None
     return {
         'protocol': 'trojan',
         'ps': name,
         'add': u.hostname,
         'port': u.port,
-        'password': u.username,
+        'password': unquote(u.username) if u.username else u.username,
+        'net': qs.get('type', [None])[0],
+        'path': qs.get('path', [None])[0],
         'raw': link,
+        **_link_params(qs),
     }
 
 
 def parse_ss(link):
-    # ss://<base64>@host:port or ss://<method:password>@host:port
-    # Simplified parsing
-    rest = link[len('ss://'):]
-    try:
-        if '@' in rest:
-            head, addr = rest.split('@', 1)
-            if ':' in head:
-                method, password = head.split(':', 1)
-            else:
-                method, password = None, None
-            if ':' in addr:
-                host, port = addr.rsplit(':', 1)
-                port = int(port)
-            else:
-                host, port = addr, None
-            return {'protocol': 'ss', 'add': host, 'port': port, 'method': method, 'password': password, 'raw': link}
-        else:
-            # base64 encoded
-            dec = base64.b64decode(rest + '===').decode('utf-8', errors='ignore')
-            return parse_ss('ss://' + dec)
+    # SIP002: ss://<base64url(method:password) or percent-encoded method:password>@host:port/?plugin=...#name
+    # legacy: ss://<base64(method:password@host:port)>#name
+    rest, _, frag = link[len('ss://'):].partition('#')
+    name = unquote(frag) if frag else None
+    try:
+        if '@' not in rest:
+            rest = _b64_text(rest.split('?', 1)[0].rstrip('/'))
+        userinfo, addr = rest.rsplit('@', 1)
+        userinfo = unquote(userinfo)
+        if ':' not in userinfo:
+            userinfo = _b64_text(userinfo)
+        method, password = userinfo.split(':', 1)
+        addr, _, query = addr.partition('?')
+        u = urlparse('//' + addr.rstrip('/'))
+        node = {'protocol': 'ss', 'ps': name, 'add': u.hostname, 'port': u.port, 'method': method, 'password': password, 'raw': link}
+        plugin = parse_qs(query).get('plugin', [None])[0]
+        if plugin:
+            node['plugin'] = plugin
+        return node
     except Exception:
-        return {'protocol': 'ss', 'raw': link}
+        return {'protocol': 'ss', 'ps': name, 'raw': link}
 
 
 def parse_link(link):
@@ -188,12 +345,570 @@ def gather_nodes_from_text(text):
     return nodes
 
 
+class Node:
+    """Compact, slotted node record. Behaves like the parser dicts for reading
+    (get, [], in, keys, {**node}) and converts back with to_dict(). Rare fields
+    live in the `extra` dict; repeated short strings are interned. The transport/TLS
+    parameters most vless/vmess/trojan links carry have slots too, so a typical node
+    needs no `extra` dict at all.
+    """
+    __slots__ = ('protocol', 'ps', 'add', 'port', 'id', 'password', 'method', 'net', 'type', 'tls', 'path', 'raw',
+                 'security', 'sni', 'host', 'fp', 'alpn', 'flow', 'pbk', 'sid', 'serviceName', 'headerType', 'aid', 'scy', 'extra')
+    _FIELDS = __slots__[:-1]
+    _FIELD_SET = frozenset(_FIELDS)
+    _INTERN = frozenset(('protocol', 'add', 'method', 'net', 'type', 'tls', 'security', 'sni', 'host', 'fp', 'alpn', 'flow', 'headerType', 'aid', 'scy'))
+
+    def __init__(self, **fields):
+        self.extra = None
+        for f in self._FIELDS:
+            v = fields.pop(f, None)
+            if f in self._INTERN and isinstance(v, str):
+                v = sys.intern(v)
+            object.__setattr__(self, f, v)
+        if fields:
+            self.extra = fields
+
+    @classmethod
+    def from_dict(cls, d):
+        return d if isinstance(d, cls) else cls(**d)
+
+    def get(self, key, default=None):
+        if key in self._FIELD_SET:
+            v = getattr(self, key)
+            return default if v is None else v
+        if self.extra:
+            return self.extra.get(key, default)
+        return default
+
+    def __getitem__(self, key):
+        if key in self._FIELD_SET:
+            return getattr(self, key)
+        if self.extra and key in self.extra:
+            return self.extra[key]
+        raise KeyError(key)
+
+    def __contains__(self, key):
+        if key in self._FIELD_SET:
+            return getattr(self, key) is not None
+        return bool(self.extra) and key in self.extra
+
+    def keys(self):
+        keys = [f for f in self._FIELDS if getattr(self, f) is not None]
+        if self.extra:
+            keys.extend(self.extra)
+        return keys
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def setdefault(self, key, default=None):
+        if key in self._FIELD_SET:
+            if getattr(self, key) is None:
+                setattr(self, key, default)
+            return getattr(self, key)
+        if self.extra is None:
+            self.extra = {}
+        return self.extra.setdefault(key, default)
+
+    def to_dict(self):
+        return {k: self[k] for k in self.keys()}
+
+    def __repr__(self):
+        return f'Node({self.to_dict()!r})'
+
+
+def compact_nodes(nodes):
+    """Convert parser dicts to Node records (works on lists and streams)."""
+    for node in nodes:
+        yield Node.from_dict(node)
+
+
+_SCHEMAS = {}
+
+
+def _shared(layout):
+    """Intern a layout tuple so every result with the same keys shares one copy."""
+    return _SCHEMAS.setdefault(layout, layout)
+
+
+_SCHEMA_SLOTS = {}
+
+
+def _slots(schema):
+    """key -> (kind, position in nums/objs) for a PackedStats schema, built once per schema."""
+    slots = _SCHEMA_SLOTS.get(schema)
+    if slots is None:
+        slots, ni, oi = {}, 0, 0
+        for k, kind in schema:
+            if kind == 'f' or kind == 'i':
+                slots[k] = (kind, ni)
+                ni += 1
+            elif kind == 'n':
+                slots[k] = (kind, 0)
+            else:
+                slots[k] = (kind, oi)
+                oi += 1
+        _SCHEMA_SLOTS[schema] = slots
+    return slots
+
+
+class PackedStats:
+    """One stage result (ping/tcp/speed/...) packed for memory: the key layout is a
+    schema tuple shared by all results, numbers live in one array('d'), RTT-like
+    sample lists become array('f') and any other values are kept in a tuple.
+    Read access mirrors the original dict (get, [], in, bool); to_dict() unpacks.
+    """
+    __slots__ = ('schema', 'nums', 'objs')
+
+    def __init__(self, schema, nums, objs):
+        self.schema = schema
+        self.nums = nums
+        self.objs = objs
+
+    @classmethod
+    def pack(cls, d):
+        layout, nums, objs = [], [], []
+        for k, v in d.items():
+            if v is None:
+                kind = 'n'
+            elif type(v) is float or type(v) is int:
+                kind = 'f' if type(v) is float else 'i'
+                nums.append(v)
+            elif isinstance(v, list) and all(type(x) is float or type(x) is int for x in v):
+                kind = 'a'
+                objs.append(array('f', v))
+            else:
+                kind = 'o'
+                objs.append(v)
+            layout.append((k, kind))
+        return cls(_shared(tuple(layout)), array('d', nums), tuple(objs))
+
+    def items(self):
+        ni = oi = 0
+        for k, kind in self.schema:
+            if kind == 'n':
+                yield k, None
+            elif kind == 'f' or kind == 'i':
+                v = self.nums[ni]
+                ni += 1
+                yield k, (int(v) if kind == 'i' else v)
+            else:
+                v = self.objs[oi]
+                oi += 1
+                yield k, (v.tolist() if kind == 'a' else v)
+
+    def to_dict(self):
+        return dict(self.items())
+
+    def get(self, key, default=None):
+        try:
+            v = self[key]
+        except KeyError:
+            return default
+        return default if v is None else v
+
+    def __getitem__(self, key):
+        kind, i = _slots(self.schema)[key]
+        if kind == 'n':
+            return None
+        if kind == 'f':
+            return self.nums[i]
+        if kind == 'i':
+            return int(self.nums[i])
+        v = self.objs[i]
+        return v.tolist() if kind == 'a' else v
+
+    def __contains__(self, key):
+        return key in _slots(self.schema)
+
+    def keys(self):
+        return [k for k, _ in self.schema]
+
+    def __bool__(self):
+        return bool(self.schema)
+
+    def __repr__(self):
+        return f'PackedStats({self.to_dict()!r})'
+
+
+_STAGE_INDEX = {}
+
+
+def _stage_index(stage_keys):
+    """stage name -> position in stage_vals for a shared NodeResult key tuple, built once per tuple."""
+    index = _STAGE_INDEX.get(stage_keys)
+    if index is None:
+        index = _STAGE_INDEX[stage_keys] = {k: i for i, k in enumerate(stage_keys)}
+    return index
+
+
+class NodeResult:
+    """Compact per-node test result: references the Node and keeps each stage result
+    as PackedStats, with the stage names in a shared tuple. get() mirrors the result
+    dict; to_dict() rebuilds it.
+    """
+    __slots__ = ('node', 'reachable', 'stage_keys', 'stage_vals')
+
+    def __init__(self, node, reachable=None, stages=None):
+        stages = stages or {}
+        self.node = node
+        self.reachable = reachable
+        self.stage_keys = _shared(tuple(stages))
+        self.stage_vals = tuple(stages.values())
+
+    @classmethod
+    def from_result(cls, node, node_res):
+        """Pack a test_nodes result dict; keys that are not node fields become stages."""
+        node = Node.from_dict(node)
+        node_keys = set(node.keys())
+        stages = {}
+        for k, v in node_res.items():
+            if k in node_keys or k == 'reachable':
+                continue
+            stages[k] = PackedStats.pack(v) if isinstance(v, dict) else v
+        return cls(node, node_res.get('reachable'), stages)
+
+    @property
+    def stages(self):
+        return dict(zip(self.stage_keys, self.stage_vals))
+
+    def get(self, key, default=None):
+        if key == 'reachable':
+            return self.reachable
+        i = _stage_index(self.stage_keys).get(key)
+        if i is not None:
+            v = self.stage_vals[i]
+            return default if v is None else v
+        return self.node.get(key, default)
+
+    def __getitem__(self, key):
+        if key == 'reachable':
+            return self.reachable
+        i = _stage_index(self.stage_keys).get(key)
+        if i is not None:
+            return self.stage_vals[i]
+        return self.node[key]
+
+    def to_dict(self):
+        d = self.node.to_dict()
+        d.update((k, v.to_dict() if isinstance(v, PackedStats) else v) for k, v in zip(self.stage_keys, self.stage_vals))
+        d['reachable'] = self.reachable
+        return d
+
+
+def as_result_dict(r):
+    """Plain dict view of a result (NodeResult or dict), for JSON and the HTML report."""
+    return r.to_dict() if hasattr(r, 'to_dict') else r
+
+
+# fields that make two links the same server for each protocol (besides host/port)
+_IDENTITY_FIELDS = {
+    'vmess': ('id', 'net', 'path', 'tls', 'host', 'sni', 'serviceName'),
+    'vless': ('id', 'net', 'path', 'tls', 'security', 'host', 'sni', 'serviceName', 'flow', 'pbk', 'sid'),
+    'trojan': ('password', 'net', 'path', 'host', 'sni', 'serviceName'),
+    'ss': ('method', 'password', 'plugin'),
+}
+
+
+def node_identity(node):
+    """Protocol-normalized identity of a node: ignores the name ('ps') and the raw link
+    formatting, so the same server listed by several subscriptions compares equal.
+    """
+    proto = (node.get('protocol') or '').lower()
+    host = (node.get('add') or '').strip().strip('[]').rstrip('.').lower()
+    if proto not in _IDENTITY_FIELDS or not host:
+        return (proto, node.get('raw'))
+    try:
+        port = int(node.get('port')) if node.get('port') else None
+    except (TypeError, ValueError):
+        port = None
+    fields = []
+    for f in _IDENTITY_FIELDS[proto]:
+        v = node.get(f)
+        if isinstance(v, str):
+            v = v.strip()
+            if f in ('id', 'method', 'net', 'tls', 'security'):
+                v = v.lower()
+        fields.append(v or None)
+    return (proto, host, port, *fields)
+
+
+def node_key(node):
+    """Stable string form of node_identity (used as a key in files and databases)."""
+    ident = json.dumps(node_identity(node), ensure_ascii=False, separators=(',', ':'))
+    return hashlib.sha1(ident.encode('utf-8')).hexdigest()
+
+
+def iter_dedup(nodes):
+    """Drop nodes whose node_identity was already seen. Works on lists and streams.
+    Names of dropped copies are collected in the kept node's 'aliases' list.
+    """
+    seen = {}
+    for node in nodes:
+        ident = node_identity(node)
+        kept = seen.get(ident)
+        if kept is None:
+            seen[ident] = node
+            yield node
+        elif node.get('ps') and node.get('ps') != kept.get('ps'):
+            kept.setdefault('aliases', [])
+            if node['ps'] not in kept['aliases']:
+                kept['aliases'].append(node['ps'])
+
+
+def dedup_nodes(nodes):
+    return list(iter_dedup(nodes))
+
+
+def iter_url_chunks(url, timeout=15, chunk_size=64*1024, session=None):
+    """Stream the subscription body in chunks instead of loading resp.text."""
+    try:
+        resp = (session or requests).get(url, timeout=timeout, verify=False, stream=True)
+        resp.raise_for_status()
+    except Exception as exc:
+        raise RuntimeError(f"Failed to fetch URL: {exc}")
+    with resp:
+        for chunk in resp.iter_content(chunk_size=chunk_size):
+            if chunk:
+                yield chunk
+
+
+def stream_subscription(session, url, cache=None, timeout=15, chunk_size=64*1024):
+    """--stream counterpart of fetch_subscription: nodes are parsed while the body
+    downloads. With a cache the request is conditional and a 304 replays the cached
+    nodes; a fully read body is stored with its validators. On a network error the
+    cached nodes are used if there are any, otherwise RuntimeError is raised.
+    """
+    entry = cache.load(url) if cache else None
+    headers = {}
+    if entry:
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+    try:
+        resp = session.get(url, timeout=timeout, verify=False, headers=headers, stream=True)
+        if resp.status_code == 304 and entry:
+            resp.close()
+            yield from entry.get('nodes') or []
+            return
+        resp.raise_for_status()
+    except Exception as exc:
+        if entry:
+            yield from entry.get('nodes') or []
+            return
+        raise RuntimeError(f"Failed to fetch URL: {exc}")
+    nodes = [] if cache else None
+    with resp:
+        for node in iter_nodes(c for c in resp.iter_content(chunk_size=chunk_size) if c):
+            if nodes is not None:
+                nodes.append(node)
+            yield node
+    if cache:
+        try:
+            cache.store(url, resp.headers.get('ETag'), resp.headers.get('Last-Modified'), nodes)
+        except Exception:
+            pass
+
+
+def iter_file_chunks(path, chunk_size=64*1024):
+    with open(path, 'rb') as fh:
+        while True:
+            chunk = fh.read(chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+
+_B64_CHARS = frozenset(b'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/=-_ \t\r\n')
+_B64_STRIP = bytes.maketrans(b'-_', b'+/')
+
+
+def iter_links(chunks, sniff_size=4096):
+    """Incrementally extract links from a stream of byte chunks.
+
+    The first `sniff_size` bytes decide the format: plain text with links, or a
+    base64-encoded subscription. Base64 is decoded in 4-byte aligned pieces as it
+    arrives, so neither the raw body nor the decoded text is ever held in full.
+    """
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='ignore')
+    text_tail = ''
+
+    def scan(text, final=False):
+        # only scan up to the last whitespace: a link may continue in the next chunk
+        nonlocal text_tail
+        text = text_tail + text
+        if final:
+            cut = len(text)
+        else:
+            cut = max(text.rfind(c) for c in ' \n\r\t')
+            cut = cut + 1 if cut >= 0 else 0
+        text_tail = text[cut:]
+        return [m.group(0) for m in LINK_RE.finditer(text, 0, cut)]
+
+    it = iter(chunks)
+    head = b''
+    for chunk in it:
+        head += chunk
+        if len(head) >= sniff_size:
+            break
+    probe = head[:sniff_size]
+    is_base64 = bool(probe.strip()) and b'://' not in probe and all(c in _B64_CHARS for c in probe)
+
+    if not is_base64:
+        yield from scan(decoder.decode(head))
+        for chunk in it:
+            yield from scan(decoder.decode(chunk))
+        yield from scan(decoder.decode(b'', final=True), final=True)
+        return
+
+    pending = b''
+
+    def decode(body):
+        if len(body) % 4 == 1:
+            body = body[:-1]  # a lone trailing char carries no byte
+        try:
+            return base64.b64decode(body + b'=' * (-len(body) % 4))
+        except Exception:
+            return b''
+
+    def feed(data, final=False):
+        nonlocal pending
+        pending += bytes(data).translate(_B64_STRIP, b' \t\r\n')
+        out = []
+        # padding inside the stream ends a blob (concatenated subscriptions): decode
+        # up to it, then resync on a fresh 4-char quantum after the whole '=' run
+        while True:
+            idx = pending.find(b'=')
+            if idx < 0:
+                break
+            end = idx
+            while end < len(pending) and pending[end] == 0x3d:
+                end += 1
+            if end == len(pending) and not final:
+                break  # the run may go on in the next chunk
+            out.append(decode(pending[:idx]))
+            pending = pending[end:]
+        if final:
+            out.append(decode(pending))
+            pending = b''
+        else:
+            n = pending.find(b'=')
+            n = len(pending) if n < 0 else n
+            n -= n % 4
+            out.append(decode(pending[:n]))
+            pending = pending[n:]
+        return scan(decoder.decode(b''.join(out), final=final), final=final)
+
+    yield from feed(head)
+    for chunk in it:
+        yield from feed(chunk)
+    yield from feed(b'', final=True)
+
+
+def iter_nodes(chunks):
+    """Generator of parsed nodes from a stream of byte chunks (see iter_links)."""
+    for ln in iter_links(chunks):
+        try:
+            yield parse_link(ln)
+        except Exception:
+            yield {'protocol': 'unknown', 'raw': ln}
+
+
+class DnsCache:
+    """Thread-safe host -> IP cache with per-entry TTL and negative caching.
+
+    With dnspython installed the A/AAAA record TTL is used (clamped to `max_ttl`);
+    otherwise getaddrinfo is used and entries live for `ttl` seconds. Failed lookups
+    are remembered for `negative_ttl` seconds so dead names are not retried per probe.
+    """
+
+    def __init__(self, ttl=300, negative_ttl=30, max_ttl=3600):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_ttl = max_ttl
+        self._entries = {}  # host -> (expires_at, ips, error)
+        self._lock = threading.Lock()
+
+    def _lookup(self, host):
+        """Return (ips, ttl). Raises on failure."""
+        if dns_resolver is not None:
+            ips = []
+            ttl = None
+            for rdtype in ('A', 'AAAA'):
+                try:
+                    answer = dns_resolver.resolve(host, rdtype)
+                except Exception:
+                    continue
+                ips.extend(r.address for r in answer)
+                ttl = answer.rrset.ttl if ttl is None else min(ttl, answer.rrset.ttl)
+            if ips:
+                return ips, min(max(ttl or 0, 1), self.max_ttl)
+        infos = socket.getaddrinfo(host, None, type=socket.SOCK_STREAM)
+        return list(dict.fromkeys(info[4][0] for info in infos)), self.ttl
+
+    def resolve(self, host):
+        """Resolve host, returning {'ip', 'ips', 'resolve_ms', 'cached', 'error'}.
+        'ip' prefers IPv4 (the ICMP engine is IPv4-only).
+        """
+        try:
+            ipaddress.ip_address(host)
+            return {'ip': host, 'ips': [host], 'resolve_ms': 0.0, 'cached': True, 'error': None}
+        except ValueError:
+            pass
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(host)
+        if entry and entry[0] > now:
+            ips, error = entry[1], entry[2]
+            return {'ip': self._pick(ips), 'ips': ips, 'resolve_ms': 0.0, 'cached': True, 'error': error}
+        start = time.perf_counter()
+        try:
+            ips, ttl = self._lookup(host)
+            error = None
+        except Exception as exc:
+            ips, ttl, error = [], self.negative_ttl, str(exc)
+        elapsed = (time.perf_counter() - start) * 1000.0
+        if not ips:
+            ttl = self.negative_ttl
+            error = error or 'no addresses'
+        with self._lock:
+            self._entries[host] = (time.monotonic() + ttl, ips, error)
+        return {'ip': self._pick(ips), 'ips': ips, 'resolve_ms': elapsed, 'cached': False, 'error': error}
+
+    @staticmethod
+    def _pick(ips):
+        for ip in ips:
+            if ':' not in ip:
+                return ip
+        return ips[0] if ips else None
+
+    def resolve_many(self, hosts, workers=64):
+        """Resolve every unique host once, concurrently. Returns {host: resolve() dict}."""
+        unique = [h for h in dict.fromkeys(hosts) if h]
+        if not unique:
+            return {}
+        with ThreadPoolExecutor(max_workers=max(1, min(workers, len(unique)))) as ex:
+            return dict(zip(unique, ex.map(self.resolve, unique)))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+# shared by all sweeps in this process
+DNS_CACHE = DnsCache()
+
+
 def tcp_connect_test(host, port, timeout=5):
-    start = time.time()
+    start = time.perf_counter()
     try:
         sock = socket.create_connection((host, port), timeout=timeout)
         sock.close()
-        rtt = (time.time() - start)
+        rtt = (time.perf_counter() - start)
         return True, rtt
     except Exception:
         return False, None
@@ -213,20 +928,19 @@ def percentile(data, p):
     return d0 + d1
 
 
-def ping_host(host, count=4, timeout_ms=1000):
-    """Call system ping and parse results. Returns dict with sent/received/loss and rtts list and stats."""
+def _ping_cmd(host, count, timeout_ms):
     if platform.system().lower().startswith('win'):
-        cmd = ['ping', '-n', str(count), '-w', str(timeout_ms), host]
-    else:
-        # -c count, -W timeout in seconds (per-packet)
-        cmd = ['ping', '-c', str(count), '-W', str(max(1, int(timeout_ms/1000))), host]
-    try:
-        out = subprocess.check_output(cmd, stderr=subprocess.STDOUT, universal_newlines=True, timeout=(count * (timeout_ms/1000.0) + 5))
-    except subprocess.CalledProcessError as e:
-        out = e.output
-    except Exception:
-        return {'sent': count, 'received': 0, 'loss_percent': 100.0, 'rtts': [], 'min': None, 'avg': None, 'max': None}
+        return ['ping', '-n', str(count), '-w', str(timeout_ms), host]
+    # -c count, -W timeout in seconds (per-packet)
+    return ['ping', '-c', str(count), '-W', str(max(1, int(timeout_ms/1000))), host]
+
 
+def _ping_failed(count):
+    return {'sent': count, 'received': 0, 'loss_percent': 100.0, 'rtts': [], 'min': None, 'avg': None, 'max': None}
+
+
+def parse_ping_output(out, count):
+    """Parse output of the system ping (unix or windows) into the ping stats dict."""
     # extract per-reply times
     rtts = []
     for line in out.splitlines():
@@ -275,18 +989,279 @@ def ping_host(host, count=4, timeout_ms=1000):
     return stats
 
 
-def repeated_tcp_test(host, port, retries=6, timeout=3):
+def ping_host(host, count=4, timeout_ms=1000, method='auto', adaptive=None):
+    """Ping a host. Returns dict with sent/received/loss and rtts list and stats.
+
+    method='auto' uses the in-process ICMP engine (icmp_ping_many) and falls back to
+    the system ping when no ICMP socket can be opened; method='system' always calls ping.
+    """
+    if method == 'auto':
+        try:
+            res = icmp_ping_many([host], count=count, timeout_ms=timeout_ms, adaptive=adaptive)
+        except Exception:
+            res = None
+        if res and host in res:
+            return res[host]
+    cmd = _ping_cmd(host, count, timeout_ms)
+    try:
+        out = subprocess.check_output(cmd, stderr=subprocess.STDOUT, universal_newlines=True, timeout=(count * (timeout_ms/1000.0) + 5))
+    except subprocess.CalledProcessError as e:
+        out = e.output
+    except Exception:
+        return _ping_failed(count)
+    return parse_ping_output(out, count)
+
+
+def _icmp_checksum(data):
+    if len(data) % 2:
+        data += b'\0'
+    total = sum(struct.unpack(f'!{len(data) // 2}H', data))
+    total = (total >> 16) + (total & 0xFFFF)
+    total += total >> 16
+    return ~total & 0xFFFF
+
+
+def _open_icmp_socket():
+    """Open an ICMP socket: unprivileged SOCK_DGRAM (Linux ping_group_range) first, raw as fallback.
+    Returns (sock, is_raw) or (None, None) if neither is permitted.
+    """
+    for stype, is_raw in ((socket.SOCK_DGRAM, False), (socket.SOCK_RAW, True)):
+        try:
+            sock = socket.socket(socket.AF_INET, stype, socket.IPPROTO_ICMP)
+            sock.setblocking(False)
+            return sock, is_raw
+        except (OSError, AttributeError):
+            continue
+    return None, None
+
+
+def _resolve_ipv4(host):
+    try:
+        return socket.getaddrinfo(host, None, socket.AF_INET)[0][4][0]
+    except socket.gaierror:
+        return None
+
+
+def icmp_ping_many(hosts, count=4, timeout_ms=1000, interval=0.2, max_outstanding=4096, adaptive=None):
+    """Ping many hosts in-process over a single ICMP socket.
+
+    Each host gets `count` echo requests, one at a time (next one after the reply or
+    timeout, at least `interval` seconds apart); all hosts are pinged concurrently.
+    Replies are matched by ICMP id + sequence and source address.
+    Returns {host: stats} in the ping_host format, or None if no ICMP socket could be
+    opened. Hosts without an IPv4 address are left out so callers can fall back to the
+    system ping for them; unresolvable hosts get 100% loss. With `adaptive` a host
+    stops being pinged once probe_settled holds for it.
+    """
+    import selectors
+
+    settings = adaptive_settings(adaptive)
+
+    sock, is_raw = _open_icmp_socket()
+    if sock is None:
+        return None
+
+    results = {}
+    state = {}  # ip -> [hosts, sent, rtts, ready_at, pending_seq, fail_streak]
+    for host in dict.fromkeys(hosts):
+        try:
+            ip = _resolve_ipv4(host)
+        except Exception:
+            ip = None
+        if ip is None:
+            try:
+                socket.getaddrinfo(host, None)
+            except Exception:
+                results[host] = _ping_failed(count)
+            continue
+        state.setdefault(ip, [[], 0, [], 0.0, None, 0])[0].append(host)
+
+    timeout = timeout_ms / 1000.0
+    if is_raw:
+        ident = os.getpid() & 0xFFFF
+    else:
+        # the kernel rewrites the id of unprivileged echo requests to the socket's "port"
+        sock.bind(('', 0))
+        ident = sock.getsockname()[1]
+    seq_counter = itertools.count(random.randrange(0x10000))
+    pending = {}  # seq -> (ip, sent_at)
+    deadlines = collections.deque()  # (deadline, seq) in send order
+    sel = selectors.DefaultSelector()
+    sel.register(sock, selectors.EVENT_READ)
+    payload_pad = b'\x5a' * 48
+    finished = set()
+
+    def close_probe(ip, seq, rtt_ms):
+        st = state[ip]
+        if st[4] != seq:
+            return
+        st[4] = None
+        if rtt_ms is not None:
+            st[2].append(rtt_ms)
+            st[5] = 0
+        else:
+            st[5] += 1
+        st[3] = pending.pop(seq)[1] + interval
+        if settings and probe_settled(st[1], len(st[2]), st[2], st[5], settings):
+            # verdict settled: no more echo requests for this host
+            finished.add(ip)
+
+    try:
+        while True:
+            now = time.perf_counter()
+            active = False
+            for ip, st in state.items():
+                if st[4] is not None:
+                    active = True
+                    continue
+                if st[1] >= count or ip in finished:
+                    continue
+                active = True
+                if st[3] > now or len(pending) >= max_outstanding:
+                    continue
+                seq = next(seq_counter) & 0xFFFF
+                header = struct.pack('!BBHHH', 8, 0, 0, ident, seq)
+                body = struct.pack('!d', now) + payload_pad
+                packet = struct.pack('!BBHHH', 8, 0, _icmp_checksum(header + body), ident, seq) + body
+                try:
+                    sock.sendto(packet, (ip, 0))
+                except OSError:
+                    # count as lost; try the next one after the interval
+                    st[1] += 1
+                    st[3] = now + interval
+                    continue
+                st[1] += 1
+                st[4] = seq
+                pending[seq] = (ip, now)
+                deadlines.append((now + timeout, seq))
+            if not active:
+                break
+
+            wake = [st[3] for ip, st in state.items() if st[4] is None and st[1] < count and ip not in finished]
+            if deadlines:
+                wake.append(deadlines[0][0])
+            wait = max(0.0, min(wake) - time.perf_counter()) if wake else timeout
+            for _ in sel.select(min(wait, timeout)):
+                while True:
+                    try:
+                        data, addr = sock.recvfrom(2048)
+                    except (BlockingIOError, InterruptedError):
+                        break
+                    except OSError:
+                        break
+                    received_at = time.perf_counter()
+                    if is_raw:
+                        data = data[(data[0] & 0x0F) * 4:]
+                    if len(data) < 8:
+                        continue
+                    icmp_type, _, _, r_ident, r_seq = struct.unpack('!BBHHH', data[:8])
+                    if icmp_type != 0 or (is_raw and r_ident != ident):
+                        continue
+                    entry = pending.get(r_seq)
+                    if entry is None or entry[0] != addr[0]:
+                        continue
+                    close_probe(entry[0], r_seq, (received_at - entry[1]) * 1000.0)
+
+            now = time.perf_counter()
+            while deadlines and deadlines[0][0] <= now:
+                _, seq = deadlines.popleft()
+                entry = pending.get(seq)
+                if entry is not None:
+                    close_probe(entry[0], seq, None)
+    finally:
+        sel.close()
+        sock.close()
+
+    for ip, (ip_hosts, sent, rtts, _, _, _) in state.items():
+        stats = {'sent': sent, 'received': len(rtts), 'loss_percent': (1 - len(rtts) / sent) * 100.0 if sent else 100.0, 'rtts': rtts}
+        if rtts:
+            stats.update({'min': min(rtts), 'avg': statistics.mean(rtts), 'max': max(rtts)})
+        else:
+            stats.update({'min': None, 'avg': None, 'max': None})
+        for host in ip_hosts:
+            results[host] = dict(stats, rtts=list(rtts))
+    return results
+
+
+# adaptive early-exit settings (see probe_settled / http_download_test)
+ADAPTIVE_DEFAULTS = {
+    'fail_streak': 3,        # stop after this many failures in a row with no success
+    'min_samples': 4,        # never decide "healthy" on fewer samples
+    'loss_ci': 0.4,          # stop when the 90% Wilson interval on success rate is this narrow
+    'rtt_tol': 0.15,         # ... and the p95 moved less than this (relative) with the last sample
+    'speed_tol': 0.10,       # speed: stop when the last windows agree within this fraction
+    'speed_window': 4,       # speed: number of sampling intervals that must agree
+    'speed_interval': 0.5,   # speed: sampling interval, seconds
+    'speed_min_time': 2.0,   # speed: never stop a live transfer before this
+    'speed_dead_after': 3.0, # speed: give up if no byte arrived by then
+}
+
+
+def adaptive_settings(adaptive):
+    """None if adaptive mode is off, else ADAPTIVE_DEFAULTS updated with overrides."""
+    if not adaptive:
+        return None
+    settings = dict(ADAPTIVE_DEFAULTS)
+    if isinstance(adaptive, dict):
+        settings.update(adaptive)
+    return settings
+
+
+def wilson_interval(successes, n, z=1.645):
+    """Wilson score interval for a success proportion (default 90%)."""
+    if n <= 0:
+        return 0.0, 1.0
+    p = successes / n
+    denom = 1 + z * z / n
+    centre = (p + z * z / (2 * n)) / denom
+    half = z * ((p * (1 - p) / n + z * z / (4 * n * n)) ** 0.5) / denom
+    return max(0.0, centre - half), min(1.0, centre + half)
+
+
+def probe_settled(attempts, successes, rtts, fail_streak_now, settings):
+    """True when more probes are unlikely to change the verdict: the node is clearly
+    dead (a streak of failures and no success), or both the loss estimate and the
+    p95 RTT have stabilised.
+    """
+    if successes == 0 and fail_streak_now >= settings['fail_streak']:
+        return True
+    if attempts < settings['min_samples'] or len(rtts) < settings['min_samples']:
+        return False
+    lo, hi = wilson_interval(successes, attempts)
+    if hi - lo > settings['loss_ci']:
+        return False
+    p95_all = percentile(rtts, 95)
+    p95_prev = percentile(rtts[:-1], 95)
+    return bool(p95_all) and abs(p95_all - p95_prev) / p95_all <= settings['rtt_tol']
+
+
+def repeated_tcp_test(host, port, retries=6, timeout=3, adaptive=None):
+    """Up to `retries` TCP connects. With `adaptive` (True or a dict of ADAPTIVE_DEFAULTS
+    overrides) it stops as soon as probe_settled says the verdict will not change.
+    """
+    settings = adaptive_settings(adaptive)
     attempts = 0
     successes = 0
+    streak = 0
     rtts = []
     for i in range(retries):
         attempts += 1
         ok, rtt = tcp_connect_test(host, port, timeout=timeout)
         if ok and rtt is not None:
             successes += 1
+            streak = 0
             # store in ms
             rtts.append(rtt * 1000.0)
+        else:
+            streak += 1
+        if settings and probe_settled(attempts, successes, rtts, streak, settings):
+            break
         time.sleep(0.05)
+    return tcp_stats(attempts, successes, rtts)
+
+
+def tcp_stats(attempts, successes, rtts):
+    """Build the repeated TCP test result dict from raw counters and RTT samples (ms)."""
     result = {'attempts': attempts, 'successes': successes, 'loss_percent': (1 - successes/attempts) * 100.0 if attempts else 100.0, 'rtts': rtts}
     if rtts:
         result.update({'min': min(rtts), 'avg': statistics.mean(rtts), 'max': max(rtts), 'p50': percentile(rtts, 50), 'p95': percentile(rtts, 95), 'p99': percentile(rtts, 99)})
@@ -295,115 +1270,580 @@ def repeated_tcp_test(host, port, retries=6, timeout=3):
     return result
 
 
-def http_download_test(url, proxy=None, duration=10, concurrency=1, chunk_size=64*1024):
-    """Download for `duration` seconds (or until EOF) and measure throughput.
-    Returns dict: total_bytes, duration, avg_bps, peak_bps
-    """
-    stop_time = time.time() + duration
-    total_bytes = 0
-    lock = threading.Lock()
-    peak = 0
+def _fd_budget(wanted):
+    """Cap the number of simultaneously open sockets to what RLIMIT_NOFILE allows."""
+    try:
+        import resource
+        soft, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft != resource.RLIM_INFINITY:
+            return max(16, min(wanted, soft - 64))
+    except Exception:
+        pass
+    return wanted
 
-    proxies = None
-    if proxy:
-        proxies = {'http': proxy, 'https': proxy}
 
-    errors_total = 0
-    status_counts_total = {}
+def batch_tcp_test(endpoints, retries=6, timeout=3, spacing=0.05, max_inflight=1024, adaptive=None, dns_cache=None):
+    """Repeated TCP connect test for many (host, port) pairs on one selector loop.
 
-    def worker():
-        nonlocal total_bytes, peak, errors_total
-        session = requests.Session()
-        if proxies:
-            session.proxies.update(proxies)
-        errors = 0
-        status_counts = {}
-        window_bytes = 0
-        window_start = time.time()
-        while time.time() < stop_time:
-            try:
-                r = session.get(url, stream=True, timeout=10)
-                status_counts[r.status_code] = status_counts.get(r.status_code, 0) + 1
-                for chunk in r.iter_content(chunk_size=chunk_size):
-                    if not chunk:
-                        break
-                    now = time.time()
-                    l = len(chunk)
-                    window_bytes += l
-                    # every half-second update peak and total
-                    if now - window_start >= 0.5:
-                        bw = window_bytes / (now - window_start)
-                        with lock:
-                            if bw > peak:
-                                peak = bw
-                            total_bytes += window_bytes
-                        window_start = now
-                        window_bytes = 0
-                    if now >= stop_time:
-                        break
-                # leftover
-                with lock:
-                    total_bytes += window_bytes
-                window_bytes = 0
+    Every endpoint gets `retries` non-blocking connects; attempt k is due at
+    k*spacing after the start (plus a per-endpoint offset so the sweep does not burst),
+    independently of how long earlier attempts take. At most `max_inflight` sockets are
+    open at once. RTT is measured with time.perf_counter.
+    With `adaptive`, attempts not yet started for an endpoint are dropped once
+    probe_settled holds for it. Host names are resolved up front, concurrently,
+    through `dns_cache` (default DNS_CACHE); endpoints whose lookup fails count
+    every attempt as failed.
+    Returns {(host, port): dict} with the same shape as repeated_tcp_test.
+    """
+    import heapq
+    import selectors
+
+    settings = adaptive_settings(adaptive)
+    eps = list(dict.fromkeys((h, int(p)) for h, p in endpoints))
+    counters = {ep: [0, 0, []] for ep in eps}  # attempts, successes, rtts (ms)
+    streaks = {ep: 0 for ep in eps}
+    settled = set()
+    dns = (dns_cache or DNS_CACHE).resolve_many(h for h, _ in eps)
+    addrs = {}
+    for ep in eps:
+        ip = (dns.get(ep[0]) or {}).get('ip')
+        if ip is None:
+            # unresolvable: every attempt counts as failed
+            counters[ep][0] = retries
+        elif ':' in ip:
+            addrs[ep] = (socket.AF_INET6, socket.SOCK_STREAM, 0, (ip, ep[1], 0, 0))
+        else:
+            addrs[ep] = (socket.AF_INET, socket.SOCK_STREAM, 0, (ip, ep[1]))
+
+    t0 = time.perf_counter()
+    due = []
+    resolved = [ep for ep in eps if ep in addrs]
+    for i, ep in enumerate(resolved):
+        offset = spacing * i / max(1, len(resolved))
+        for k in range(retries):
+            due.append((t0 + offset + k * spacing, i, ep))
+    heapq.heapify(due)
+
+    max_inflight = _fd_budget(max_inflight)
+    sel = selectors.DefaultSelector()
+    inflight = {}  # sock -> (ep, start)
+    deadlines = []  # (deadline, n, sock) with lazy deletion
+    tiebreak = itertools.count()
+
+    def finish(sock, ok):
+        ep, start = inflight.pop(sock)
+        rtt = time.perf_counter() - start
+        try:
+            sel.unregister(sock)
+        except Exception:
+            pass
+        sock.close()
+        counters[ep][0] += 1
+        if ok:
+            counters[ep][1] += 1
+            counters[ep][2].append(rtt * 1000.0)
+            streaks[ep] = 0
+        else:
+            streaks[ep] += 1
+        if settings and probe_settled(counters[ep][0], counters[ep][1], counters[ep][2], streaks[ep], settings):
+            settled.add(ep)
+
+    try:
+        while due or inflight:
+            now = time.perf_counter()
+            # launch attempts that are due
+            while due and due[0][0] <= now and len(inflight) < max_inflight:
+                _, _, ep = heapq.heappop(due)
+                if ep in settled:
+                    continue
+                family, stype, proto, sockaddr = addrs[ep]
+                try:
+                    sock = socket.socket(family, stype, proto)
+                    sock.setblocking(False)
+                except Exception:
+                    counters[ep][0] += 1
+                    continue
+                start = time.perf_counter()
+                err = sock.connect_ex(sockaddr)
+                inflight[sock] = (ep, start)
+                if err == 0:
+                    finish(sock, True)
+                elif err in (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY, getattr(errno, 'WSAEWOULDBLOCK', -1)):
+                    sel.register(sock, selectors.EVENT_WRITE)
+                    heapq.heappush(deadlines, (start + timeout, next(tiebreak), sock))
+                else:
+                    finish(sock, False)
+
+            # wait for the next completion, deadline or scheduled attempt
+            wake = []
+            if due and len(inflight) < max_inflight:
+                wake.append(due[0][0])
+            if deadlines:
+                wake.append(deadlines[0][0])
+            wait = max(0.0, min(wake) - time.perf_counter()) if wake else 0.0
+            if inflight:
+                for key, _ in sel.select(wait):
+                    sock = key.fileobj
+                    if sock in inflight:
+                        finish(sock, sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) == 0)
+            elif wait:
+                time.sleep(wait)
+
+            # expire connects that hit the timeout
+            now = time.perf_counter()
+            while deadlines and deadlines[0][0] <= now:
+                _, _, sock = heapq.heappop(deadlines)
+                if sock in inflight:
+                    finish(sock, False)
+    finally:
+        for sock in list(inflight):
+            try:
+                sock.close()
             except Exception:
-                errors += 1
-                # small backoff
-                time.sleep(0.2)
-                continue
-        # aggregate diagnostics
-        with lock:
-            errors_total += errors
-            for k, v in status_counts.items():
-                status_counts_total[k] = status_counts_total.get(k, 0) + v
-        # function ends; no return value
+                pass
+        sel.close()
 
+    return {ep: tcp_stats(a, s, r) for ep, (a, s, r) in counters.items()}
+
+
+def _recv_exact(sock, n):
+    data = b''
+    while len(data) < n:
+        part = sock.recv(n - len(data))
+        if not part:
+            raise ConnectionError('connection closed')
+        data += part
+    return data
+
+
+def _parse_proxy(proxy):
+    """'http://h:p', 'socks5://h:p' or 'h:p' -> (scheme, host, port), or None."""
+    if not proxy:
+        return None
+    if '://' not in proxy:
+        proxy = 'http://' + proxy
+    p = urlparse(proxy)
+    scheme = 'socks5' if p.scheme.startswith('socks') else 'http'
+    return scheme, p.hostname, p.port or (1080 if scheme == 'socks5' else 8080)
 
-    threads = []
-    for _ in range(max(1, concurrency)):
-        t = threading.Thread(target=worker, daemon=True)
-        threads.append(t)
-        t.start()
-    for t in threads:
-        t.join(timeout=duration + 5)
 
-    actual_duration = duration
-    avg_bps = (total_bytes / actual_duration) if actual_duration > 0 else 0
-    return {'total_bytes': total_bytes, 'duration': actual_duration, 'avg_bps': avg_bps, 'peak_bps': peak, 'errors': errors_total, 'status_codes': status_counts_total}
+def _socks5_addr(host):
+    """SOCKS5 address field (ATYP + address) for an IPv4/IPv6 literal or a host name."""
+    try:
+        return b'\x01' + socket.inet_pton(socket.AF_INET, host)
+    except OSError:
+        pass
+    try:
+        return b'\x04' + socket.inet_pton(socket.AF_INET6, host)
+    except OSError:
+        name = host.encode('idna')
+        return b'\x03' + bytes([len(name)]) + name
 
 
-def udp_game_test(target_host, target_port, duration=5, psize=60, interval_ms=20, expect_echo=False):
-    """Send small UDP packets for duration seconds. If expect_echo True, waits for echo and measures RTTs.
-    Returns: sent, received, loss_percent, rtts list, pps
+def _socks5_request(sock, cmd, host, port):
+    """SOCKS5 greeting (no auth) and one request on an open socket to the proxy.
+    Returns the bound (host, port) from the reply.
     """
-    addr = (target_host, int(target_port))
-    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    sock.settimeout(1.0)
-    stop = time.time() + duration
-    sent = 0
-    rcv = 0
-    rtts = []
-    payload = os.urandom(psize)
-    seq = 0
-    while time.time() < stop:
-        seq += 1
-        ts = time.time()
-        try:
-            sock.sendto(payload, addr)
-            sent += 1
-            if expect_echo:
+    sock.sendall(b'\x05\x01\x00')
+    if _recv_exact(sock, 2) != b'\x05\x00':
+        raise ConnectionError('socks5: no acceptable auth method')
+    sock.sendall(b'\x05' + bytes([cmd]) + b'\x00' + _socks5_addr(host) + struct.pack('!H', port))
+    rep = _recv_exact(sock, 4)
+    if rep[1] != 0:
+        raise ConnectionError(f'socks5: request {cmd} failed (code {rep[1]})')
+    if rep[3] == 1:
+        bound = socket.inet_ntop(socket.AF_INET, _recv_exact(sock, 4))
+    elif rep[3] == 4:
+        bound = socket.inet_ntop(socket.AF_INET6, _recv_exact(sock, 16))
+    else:
+        bound = _recv_exact(sock, _recv_exact(sock, 1)[0]).decode('idna')
+    return bound, struct.unpack('!H', _recv_exact(sock, 2))[0]
+
+
+def _socks5_connect(sock, host, port):
+    """SOCKS5 CONNECT (no auth) on an open socket to the proxy."""
+    _socks5_request(sock, 1, host, port)
+
+
+class Socks5UdpAssociation:
+    """SOCKS5 UDP ASSOCIATE: datagrams sent to `relay` with header(host, port) in
+    front are forwarded by the proxy (e.g. a node's xray socks inbound) to host:port,
+    and replies come back with the same kind of header (see unwrap). The relay lives
+    as long as the control connection, so keep the object until close().
+    """
+
+    def __init__(self, proxy, timeout=5):
+        px = _parse_proxy(proxy)
+        if not px or px[0] != 'socks5':
+            raise ValueError(f'UDP needs a socks5 proxy, got {proxy!r}')
+        self.ctrl = socket.create_connection((px[1], px[2]), timeout=timeout)
+        try:
+            host, port = _socks5_request(self.ctrl, 3, '0.0.0.0', 0)
+        except Exception:
+            self.ctrl.close()
+            raise
+        # an unspecified bound address means "the proxy's own address"
+        if host in ('0.0.0.0', '::'):
+            host = px[1]
+        self.relay = (host, port)
+
+    @staticmethod
+    def header(host, port):
+        return b'\x00\x00\x00' + _socks5_addr(host) + struct.pack('!H', int(port))
+
+    @staticmethod
+    def unwrap(data):
+        """Payload of a relayed datagram, or None for fragments/garbage."""
+        if len(data) < 4 or data[2] != 0:
+            return None
+        atyp = data[3]
+        if atyp == 1:
+            off = 10
+        elif atyp == 4:
+            off = 22
+        elif atyp == 3 and len(data) > 4:
+            off = 7 + data[4]
+        else:
+            return None
+        return data[off:] if len(data) >= off else None
+
+    def close(self):
+        try:
+            self.ctrl.close()
+        except Exception:
+            pass
+
+
+def _read_http_head(sock, limit=65536):
+    """Read a response head. Returns (status, headers with lower-case names, body bytes
+    already read); headers[':version'] holds the HTTP version of the status line.
+    """
+    data = b''
+    while b'\r\n\r\n' not in data:
+        part = sock.recv(16384)
+        if not part:
+            raise ConnectionError('connection closed before response head')
+        data += part
+        if len(data) > limit:
+            raise ValueError('response head too large')
+    head, _, rest = data.partition(b'\r\n\r\n')
+    status, headers = _parse_http_head(head)
+    return status, headers, rest
+
+
+def _keeps_alive(headers):
+    """Whether the server keeps the connection open after this response."""
+    conn_hdr = headers.get('connection', '').lower()
+    if headers.get(':version') == 'HTTP/1.0':
+        return conn_hdr == 'keep-alive'
+    return conn_hdr != 'close'
+
+
+def _parse_http_head(head):
+    """Status line + header lines (without the blank line) -> (status, headers)."""
+    lines = head.decode('latin-1').split('\r\n')
+    version, status = lines[0].split(None, 2)[:2]
+    headers = {':version': version}
+    for line in lines[1:]:
+        k, _, v = line.partition(':')
+        headers[k.strip().lower()] = v.strip()
+    return int(status), headers
+
+
+def _open_http_conn(url, proxy=None, timeout=10):
+    """Open a connection for requests to `url`: direct, through an HTTP proxy
+    (absolute-URI for http, CONNECT for https) or through SOCKS5; TLS for https.
+    Returns (sock, request target).
+    """
+    u = urlparse(url)
+    https = u.scheme == 'https'
+    host, port = u.hostname, u.port or (443 if https else 80)
+    target = (u.path or '/') + (f'?{u.query}' if u.query else '')
+    px = _parse_proxy(proxy)
+    sock = socket.create_connection((px[1], px[2]) if px else (host, port), timeout=timeout)
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+    except OSError:
+        pass
+    try:
+        if px and px[0] == 'socks5':
+            _socks5_connect(sock, host, port)
+        elif px and https:
+            sock.sendall(f'CONNECT {host}:{port} HTTP/1.1\r\nHost: {host}:{port}\r\n\r\n'.encode())
+            status, _, _ = _read_http_head(sock)
+            if status != 200:
+                raise ConnectionError(f'proxy CONNECT failed ({status})')
+        elif px:
+            target = url
+        if https:
+            sock = ssl.create_default_context().wrap_socket(sock, server_hostname=host)
+    except Exception:
+        sock.close()
+        raise
+    return sock, target
+
+
+class _ThroughputMeter:
+    """Byte counters with one slot per connection (each written only by its own
+    worker, so no lock) and a sampler that turns them into a fixed-interval timeline.
+    """
+
+    def __init__(self, slots, interval=0.5):
+        self.counts = [0] * max(1, slots)
+        self.interval = interval
+        self.samples = []  # (seconds since start, total bytes)
+        self.started = None
+
+    def start(self):
+        self.started = time.perf_counter()
+        self.samples = [(0.0, 0)]
+
+    def total(self):
+        return sum(self.counts)
+
+    def sample(self):
+        t = time.perf_counter() - self.started
+        self.samples.append((t, self.total()))
+        return t
+
+    def rates(self, since=0.0):
+        """Bytes/s for each sampling interval that ends after `since`."""
+        s = self.samples
+        return [(s[i][1] - s[i - 1][1]) / (s[i][0] - s[i - 1][0]) for i in range(1, len(s)) if s[i][0] > since and s[i][0] > s[i - 1][0]]
+
+    def summary(self, warmup=0.0):
+        """total_bytes/duration over the whole run, avg/peak over the part after `warmup`
+        (ignored when nothing would remain), plus the per-interval timeline.
+        """
+        elapsed, total = self.samples[-1]
+        base = next((smp for smp in self.samples if smp[0] >= warmup), None)
+        if base is None or base[0] >= elapsed:
+            base = self.samples[0]
+        applied = base[0]
+        avg = (total - base[1]) / (elapsed - applied) if elapsed > applied else 0
+        # a short trailing interval is too noisy for the peak
+        s = self.samples
+        full = [(s[i][1] - s[i - 1][1]) / (s[i][0] - s[i - 1][0]) for i in range(1, len(s))
+                if s[i - 1][0] >= applied and s[i][0] - s[i - 1][0] >= self.interval / 2]
+        return {'total_bytes': total, 'duration': elapsed, 'avg_bps': avg, 'peak_bps': max(full, default=avg),
+                'warmup': applied, 'interval': self.interval, 'timeline': self.rates()}
+
+    def run(self, stop, deadline, threads, settings=None, warmup=0.0):
+        """Sample every `interval` until `deadline` (seconds since start), all threads
+        are done, or - with adaptive `settings` - the rate settles. Returns the early
+        exit reason ('converged', 'dead') or None.
+        """
+        tick = 0
+        while True:
+            tick += 1
+            now = time.perf_counter() - self.started
+            stop.wait(max(0.0, min(tick * self.interval, deadline) - now))
+            t = self.sample()
+            if t >= deadline or not any(th.is_alive() for th in threads):
+                return None
+            if not settings:
+                continue
+            if self.samples[-1][1] == 0:
+                if t >= settings['speed_dead_after']:
+                    return 'dead'
+                continue
+            tail = self.rates(since=warmup)[-settings['speed_window']:]
+            mean = sum(tail) / len(tail) if tail else 0
+            if (t >= settings['speed_min_time'] and len(tail) == settings['speed_window']
+                    and mean > 0 and (max(tail) - min(tail)) / mean <= settings['speed_tol']):
+                return 'converged'
+
+
+def _download_worker(idx, url, proxy, chunk_size, meter, stop, live, diag):
+    """One connection: keep-alive GETs of `url`, body read with recv_into into one buffer."""
+    buf = bytearray(chunk_size)
+    view = memoryview(buf)
+    counts = meter.counts
+    errors = 0
+    status_counts = {}
+    sock = None
+    while not stop.is_set():
+        try:
+            if sock is None:
+                sock, target = _open_http_conn(url, proxy)
+                live[idx] = sock
+                host = urlparse(url).netloc
+            sock.sendall(f'GET {target} HTTP/1.1\r\nHost: {host}\r\nUser-Agent: sub-checker\r\nAccept-Encoding: identity\r\n\r\n'.encode())
+            status, headers, rest = _read_http_head(sock)
+            status_counts[status] = status_counts.get(status, 0) + 1
+            counts[idx] += len(rest)
+            length = headers.get('content-length')
+            chunked = 'chunked' in headers.get('transfer-encoding', '').lower()
+            keep = _keeps_alive(headers) and (length is not None or chunked)
+            remaining = int(length) - len(rest) if length is not None else None
+            # chunked bodies end with the zero-size chunk (trailers are not expected here)
+            tail = rest[-5:]
+            while not stop.is_set():
+                if remaining is not None and remaining <= 0:
+                    break
+                if chunked and tail == b'0\r\n\r\n':
+                    break
+                n = sock.recv_into(view if remaining is None or remaining >= chunk_size else view[:remaining])
+                if not n:
+                    keep = False
+                    break
+                counts[idx] += n
+                if remaining is not None:
+                    remaining -= n
+                elif chunked:
+                    tail = (tail + bytes(view[max(0, n - 5):n]))[-5:]
+            if status in (301, 302, 303, 307, 308) and headers.get('location'):
+                url = urljoin(url, headers['location'])
+                keep = False
+            elif status >= 400:
+                stop.wait(0.2)
+            if not keep or stop.is_set():
+                sock.close()
+                sock = None
+        except Exception:
+            if sock is not None:
+                try:
+                    sock.close()
+                except Exception:
+                    pass
+                sock = None
+            if stop.is_set():
+                break
+            errors += 1
+            # small backoff
+            stop.wait(0.2)
+    live.pop(idx, None)
+    if sock is not None:
+        sock.close()
+    diag.append((errors, status_counts))
+
+
+def _upload_worker(idx, url, proxy, chunk_size, meter, stop, live, diag, request_size=64*1024*1024):
+    """One connection: keep-alive POSTs of `request_size` bytes from one reused buffer."""
+    block = memoryview(bytes(chunk_size))
+    counts = meter.counts
+    errors = 0
+    status_counts = {}
+    sock = None
+    while not stop.is_set():
+        try:
+            if sock is None:
+                sock, target = _open_http_conn(url, proxy)
+                live[idx] = sock
+                host = urlparse(url).netloc
+            sock.sendall(f'POST {target} HTTP/1.1\r\nHost: {host}\r\nUser-Agent: sub-checker\r\nContent-Type: application/octet-stream\r\nContent-Length: {request_size}\r\n\r\n'.encode())
+            left = request_size
+            while left > 0 and not stop.is_set():
+                n = min(left, chunk_size)
+                sock.sendall(block[:n])
+                counts[idx] += n
+                left -= n
+            if left > 0:
+                break
+            status, headers, rest = _read_http_head(sock)
+            status_counts[status] = status_counts.get(status, 0) + 1
+            length = int(headers.get('content-length') or 0) - len(rest)
+            if length > 0:
+                _recv_exact(sock, length)
+            if not _keeps_alive(headers) or 'content-length' not in headers:
+                sock.close()
+                sock = None
+            if status >= 400:
+                stop.wait(0.2)
+        except Exception:
+            if sock is not None:
                 try:
-                    data, _ = sock.recvfrom(2048)
-                    rcv += 1
-                    rtts.append((time.time() - ts) * 1000.0)
+                    sock.close()
                 except Exception:
                     pass
+                sock = None
+            if stop.is_set():
+                break
+            errors += 1
+            # small backoff
+            stop.wait(0.2)
+    live.pop(idx, None)
+    if sock is not None:
+        sock.close()
+    diag.append((errors, status_counts))
+
+
+def _measure_throughput(worker, url, proxy, duration, concurrency, chunk_size, adaptive, warmup, interval):
+    """Run `concurrency` worker threads against url for up to `duration` seconds and
+    summarise their byte counters (see http_download_test)."""
+    settings = adaptive_settings(adaptive)
+    warmup = min(warmup, duration / 4.0)
+    n = max(1, concurrency)
+    meter = _ThroughputMeter(n, interval)
+    stop = threading.Event()
+    live = {}
+    diag = []
+    threads = [threading.Thread(target=worker, args=(i, url, proxy, chunk_size, meter, stop, live, diag), daemon=True) for i in range(n)]
+    meter.start()
+    for t in threads:
+        t.start()
+    stop_reason = meter.run(stop, duration, threads, settings, warmup)
+    stop.set()
+    # unblock workers waiting in recv/send so the measured window ends now
+    for sock in list(live.values()):
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
         except Exception:
             pass
-        time.sleep(interval_ms / 1000.0)
-    sock.close()
-    loss = (1 - (rcv / sent)) * 100.0 if sent else 100.0
-    pps = sent / duration if duration > 0 else 0
-    stats = {'sent': sent, 'received': rcv, 'loss_percent': loss, 'rtts': rtts, 'pps': pps}
+    res = meter.summary(warmup)
+    for t in threads:
+        t.join(timeout=5)
+
+    errors_total = 0
+    status_counts_total = {}
+    for errors, status_counts in list(diag):
+        errors_total += errors
+        for k, v in status_counts.items():
+            status_counts_total[k] = status_counts_total.get(k, 0) + v
+    res.update(errors=errors_total, status_codes=status_counts_total)
+    if settings:
+        res['early_exit'] = stop_reason
+    return res
+
+
+def http_download_test(url, proxy=None, duration=10, concurrency=1, chunk_size=1024*1024, adaptive=None, warmup=1.0, interval=0.5):
+    """Download for `duration` seconds over `concurrency` keep-alive connections and
+    measure throughput.
+
+    Bytes are counted per connection without locks and sampled every `interval`
+    seconds into 'timeline' (bytes/s). avg_bps and peak_bps leave out the first
+    `warmup` seconds (TCP slow start; capped at a quarter of the run), and
+    'duration' is the time that actually passed. `proxy` may be an http:// or
+    socks5:// URL. With `adaptive` the run stops once the rate has converged within
+    speed_tol, or when nothing arrived after speed_dead_after seconds.
+    Returns dict: total_bytes, duration, avg_bps, peak_bps, errors, status_codes, warmup, interval, timeline
+    """
+    return _measure_throughput(_download_worker, url, proxy, duration, concurrency, chunk_size, adaptive, warmup, interval)
+
+
+def http_upload_test(url, proxy=None, duration=10, concurrency=1, chunk_size=256*1024, adaptive=None, warmup=1.0, interval=0.5):
+    """Upload for `duration` seconds: keep-alive POSTs to `url` (e.g. the speed
+    server's /upload) over `concurrency` connections, body sent from one reused
+    buffer. Bytes count once handed to the socket. Same result dict as
+    http_download_test.
+    """
+    return _measure_throughput(_upload_worker, url, proxy, duration, concurrency, chunk_size, adaptive, warmup, interval)
+
+
+def _latency_result(url, via, connect_ms, ttfb_ms, rtts, requests_done, errors, reconnects, status_codes):
+    stats = {
+        'url': url,
+        'via': via,
+        'connect_ms': connect_ms,
+        'ttfb_ms': ttfb_ms,
+        'rtts': rtts,
+        'requests': requests_done,
+        'ok': ttfb_ms is not None,
+        'errors': errors,
+        'reconnects': reconnects,
+        'status_codes': status_codes,
+    }
     if rtts:
         stats.update({'min': min(rtts), 'avg': statistics.mean(rtts), 'max': max(rtts), 'p50': percentile(rtts, 50), 'p95': percentile(rtts, 95)})
     else:
@@ -411,6 +1851,330 @@ def udp_game_test(target_host, target_port, duration=5, psize=60, interval_ms=20
     return stats
 
 
+def _response_body_left(status, headers, rest):
+    """Bytes still to read for a response body: an int, or None if it runs to EOF."""
+    if status in (204, 304) or 100 <= status < 200:
+        return 0
+    if 'content-length' in headers:
+        return max(0, int(headers['content-length']) - len(rest))
+    return None
+
+
+def http_latency_test(url, proxy=None, count=5, timeout=5):
+    """HTTP round trips through `proxy` (e.g. the node's xray http inbound) to a small
+    endpoint such as a 204, all on one kept-alive connection. Unlike ping/TCP this
+    shows whether the node really forwards traffic.
+
+    connect_ms: connection setup (TCP to the proxy + proxy/TLS handshake);
+    ttfb_ms: from the start until the first response head arrived (handshake cost);
+    rtts: request -> response head for the following `count - 1` requests on the same
+    connection (steady state, summarised in min/avg/max/p50/p95).
+    """
+    host = urlparse(url).netloc
+    rtts = []
+    errors = 0
+    reconnects = 0
+    status_codes = {}
+    connect_ms = ttfb_ms = None
+    sock = None
+    done = 0
+    start = time.perf_counter()
+    try:
+        for i in range(max(1, count)):
+            try:
+                if sock is None:
+                    if i:
+                        reconnects += 1
+                    sock, target = _open_http_conn(url, proxy, timeout=timeout)
+                    if connect_ms is None:
+                        connect_ms = (time.perf_counter() - start) * 1000.0
+                sent_at = time.perf_counter()
+                sock.sendall(f'GET {target} HTTP/1.1\r\nHost: {host}\r\nUser-Agent: sub-checker\r\n\r\n'.encode())
+                status, headers, rest = _read_http_head(sock)
+                now = time.perf_counter()
+                done += 1
+                status_codes[status] = status_codes.get(status, 0) + 1
+                if ttfb_ms is None:
+                    ttfb_ms = (now - start) * 1000.0
+                else:
+                    rtts.append((now - sent_at) * 1000.0)
+                left = _response_body_left(status, headers, rest)
+                if left:
+                    _recv_exact(sock, left)
+                if left is None or not _keeps_alive(headers):
+                    sock.close()
+                    sock = None
+            except Exception:
+                errors += 1
+                if sock is not None:
+                    sock.close()
+                    sock = None
+                if ttfb_ms is None:
+                    # the first request failed: the node does not forward traffic
+                    break
+    finally:
+        if sock is not None:
+            sock.close()
+    return _latency_result(url, 'proxy' if proxy else 'direct', connect_ms, ttfb_ms, rtts, done, errors, reconnects, status_codes)
+
+
+class _GameStats:
+    """Send/receive bookkeeping for the UDP game test, shared by udp_game_test and
+    async_udp_game_test. Every packet starts with a header (magic, sequence number,
+    send time); the echo carries it back, so replies are matched without a lookup
+    table and late, duplicated or reordered packets are recognised.
+    """
+    HDR = struct.Struct('!4sId')
+    MAGIC = b'SCgm'
+
+    def __init__(self, psize):
+        self.payload = bytearray(os.urandom(max(self.HDR.size, psize)))
+        self.sent = 0
+        self.send_errors = 0
+        self.seen = set()
+        self.duplicates = 0
+        self.reordered = 0
+        self.max_seq = -1
+        self.rtts = []
+        self.jitter = 0.0
+        self.last_transit = None
+
+    def packet(self):
+        """Payload for the next sequence number, stamped with the current time."""
+        self.HDR.pack_into(self.payload, 0, self.MAGIC, self.sent, time.perf_counter())
+        self.sent += 1
+        return self.payload
+
+    def on_datagram(self, data):
+        now = time.perf_counter()
+        if len(data) < self.HDR.size:
+            return
+        magic, seq, ts = self.HDR.unpack_from(data)
+        if magic != self.MAGIC or seq >= self.sent:
+            return
+        if seq in self.seen:
+            self.duplicates += 1
+            return
+        self.seen.add(seq)
+        if seq < self.max_seq:
+            self.reordered += 1
+        else:
+            self.max_seq = seq
+        transit = (now - ts) * 1000.0
+        self.rtts.append(transit)
+        # RFC 3550 interarrival jitter over the round-trip transit time
+        if self.last_transit is not None:
+            self.jitter += (abs(transit - self.last_transit) - self.jitter) / 16.0
+        self.last_transit = transit
+
+    def all_received(self):
+        return len(self.seen) >= self.sent
+
+    def result(self, elapsed, interval_ms, expect_echo):
+        rcv = len(self.seen)
+        rtts = self.rtts
+        stats = {
+            'sent': self.sent,
+            'received': rcv,
+            # without an echo there is nothing to compare against
+            'loss_percent': ((1 - rcv / self.sent) * 100.0 if self.sent else 100.0) if expect_echo else None,
+            'rtts': rtts,
+            'pps': self.sent / elapsed if elapsed > 0 else 0,
+            'target_pps': 1000.0 / interval_ms if interval_ms > 0 else None,
+            'rx_pps': rcv / elapsed if elapsed > 0 else 0,
+            'jitter_ms': self.jitter if len(rtts) > 1 else None,
+            'reordered': self.reordered,
+            'duplicates': self.duplicates,
+            'send_errors': self.send_errors,
+        }
+        if rtts:
+            stats.update({'min': min(rtts), 'avg': statistics.mean(rtts), 'max': max(rtts), 'p50': percentile(rtts, 50), 'p95': percentile(rtts, 95)})
+        else:
+            stats.update({'min': None, 'avg': None, 'max': None, 'p50': None, 'p95': None})
+        return stats
+
+
+# a sender stalled longer than this (5 intervals, at least 20 ms) skips the missed
+# slots instead of bursting them out
+_GAME_MAX_LAG = (5, 0.02)
+
+
+def udp_game_batch(proxies, target_host, target_port, duration=5, psize=60, interval_ms=20, expect_echo=False, grace=1.0):
+    """Run the UDP game test for several flows at once, one per entry of `proxies`:
+    None sends directly, a socks5:// URL (a node's xray socks inbound) goes through
+    a SOCKS5 UDP ASSOCIATE relay. All flows share one selector loop and one send
+    schedule. Returns a list of result dicts in the order of `proxies` (see
+    udp_game_test); a flow whose proxy cannot be set up gets None.
+    """
+    import selectors
+
+    interval = max(interval_ms, 0.01) / 1000.0
+    sel = selectors.DefaultSelector()
+    flows = []  # (sock, stats, socks header or b'', association or None)
+    results = [None] * len(proxies)
+    try:
+        for i, proxy in enumerate(proxies):
+            assoc = None
+            try:
+                if proxy:
+                    assoc = Socks5UdpAssociation(proxy)
+                    dest = assoc.relay
+                    prefix = assoc.header(target_host, target_port)
+                else:
+                    dest = (target_host, int(target_port))
+                    prefix = b''
+                sock = socket.socket(socket.AF_INET6 if ':' in dest[0] else socket.AF_INET, socket.SOCK_DGRAM)
+                sock.setblocking(False)
+                sock.connect(dest)
+            except Exception:
+                if assoc:
+                    assoc.close()
+                continue
+            sel.register(sock, selectors.EVENT_READ, len(flows))
+            flows.append((sock, _GameStats(psize), prefix, assoc, i))
+
+        start = time.perf_counter()
+        end = start + duration
+        next_send = start
+        elapsed = None  # wall time of the send phase, set once it is over
+        while flows:
+            now = time.perf_counter()
+            if now >= end and elapsed is None:
+                elapsed = now - start
+            if now < end:
+                if now - next_send > max(_GAME_MAX_LAG[0] * interval, _GAME_MAX_LAG[1]):
+                    next_send = now
+                while next_send <= now and next_send < end:
+                    for sock, stats, prefix, _, _ in flows:
+                        try:
+                            if prefix:
+                                sock.sendmsg([prefix, stats.packet()])
+                            else:
+                                sock.send(stats.packet())
+                        except OSError:
+                            stats.send_errors += 1
+                    next_send += interval
+                wake = min(next_send, end)
+            elif not expect_echo or all(f[1].all_received() for f in flows) or now >= end + grace:
+                break
+            else:
+                wake = end + grace
+            for key, _ in sel.select(max(0.0, wake - time.perf_counter())):
+                sock, stats, prefix, _, _ = flows[key.data]
+                while True:
+                    try:
+                        data = sock.recv(65535)
+                    except (BlockingIOError, InterruptedError):
+                        break
+                    except OSError:
+                        # e.g. ICMP port unreachable reported on the connected socket
+                        break
+                    if prefix:
+                        data = Socks5UdpAssociation.unwrap(data)
+                        if data is None:
+                            continue
+                    stats.on_datagram(data)
+        if elapsed is None:
+            elapsed = time.perf_counter() - start
+        for sock, stats, prefix, _, i in flows:
+            results[i] = stats.result(elapsed, interval_ms, expect_echo)
+            results[i]['via'] = 'proxy' if prefix else 'direct'
+    finally:
+        sel.close()
+        for sock, _, _, assoc, _ in flows:
+            sock.close()
+            if assoc:
+                assoc.close()
+    return results
+
+
+def udp_game_test(target_host, target_port, duration=5, psize=60, interval_ms=20, expect_echo=False, grace=1.0, proxy=None):
+    """Send small UDP packets every `interval_ms` for `duration` seconds and collect
+    echoes as they come. One non-blocking socket and a selector: packets go out on an
+    absolute schedule (no sleep drift, a lost reply never delays the next send) while
+    replies are read in between. With `expect_echo` the test waits up to `grace`
+    seconds for late echoes. `proxy` (socks5://...) routes the datagrams through the
+    node via SOCKS5 UDP ASSOCIATE; if the association fails the result is None.
+    Returns: sent, received, loss_percent, rtts, pps (achieved send rate), target_pps,
+    rx_pps, jitter_ms (RFC 3550), reordered, duplicates, send_errors, via, min/avg/max/p50/p95
+    """
+    return udp_game_batch([proxy], target_host, target_port, duration=duration, psize=psize, interval_ms=interval_ms, expect_echo=expect_echo, grace=grace)[0]
+
+
+class GameBatcher:
+    """Collects concurrent udp_game_test calls from test_nodes workers into
+    udp_game_batch runs of up to `batch_size` flows. A caller waits at most `linger`
+    seconds for others to join before its batch starts; its thread then runs the
+    batch and hands every waiting caller its own result.
+    """
+
+    def __init__(self, batch_size=32, linger=0.2, **game_kwargs):
+        self.batch_size = max(1, batch_size)
+        self.linger = linger
+        self.game_kwargs = game_kwargs
+        self.lock = threading.Lock()
+        self.pending = []
+
+    def _take(self):
+        batch, self.pending = self.pending, []
+        return batch
+
+    def run(self, proxy):
+        entry = {'proxy': proxy, 'done': threading.Event(), 'result': None}
+        with self.lock:
+            self.pending.append(entry)
+            batch = self._take() if len(self.pending) >= self.batch_size else None
+        if batch is None and not entry['done'].wait(self.linger):
+            with self.lock:
+                batch = self._take() if any(e is entry for e in self.pending) else None
+        if batch:
+            try:
+                results = udp_game_batch([e['proxy'] for e in batch], **self.game_kwargs)
+            except Exception:
+                results = [None] * len(batch)
+            for e, r in zip(batch, results):
+                e['result'] = r
+                e['done'].set()
+        entry['done'].wait()
+        return entry['result']
+
+
+class _UdpEchoServer:
+    """Threaded UDP echo for local game tests (see start_udp_echo_server)."""
+
+    def __init__(self, host='127.0.0.1', port=0):
+        family = socket.AF_INET6 if ':' in host else socket.AF_INET
+        self.sock = socket.socket(family, socket.SOCK_DGRAM)
+        self.sock.bind((host, port))
+        self.sock.settimeout(0.5)
+        self.address = self.sock.getsockname()[:2]
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._serve, daemon=True)
+        self._thread.start()
+
+    def _serve(self):
+        while not self._stop.is_set():
+            try:
+                data, addr = self.sock.recvfrom(65535)
+                self.sock.sendto(data, addr)
+            except socket.timeout:
+                continue
+            except OSError:
+                if self._stop.is_set():
+                    break
+
+    def close(self):
+        self._stop.set()
+        self._thread.join(timeout=2)
+        self.sock.close()
+
+
+def start_udp_echo_server(host='127.0.0.1', port=0):
+    """Start a local UDP echo server. Returns (server, 'host:port') for --udp-target."""
+    srv = _UdpEchoServer(host, port)
+    return srv, f'{srv.address[0]}:{srv.address[1]}'
+
+
 def get_free_port():
     s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     s.bind(('127.0.0.1', 0))
@@ -420,48 +2184,201 @@ def get_free_port():
 
 
 # Simple local HTTP server for speed tests
-def start_local_http_server(file_path):
-    """Start a small HTTP server serving the directory of file_path. Returns (server, url)"""
-    import http.server
-    import socketserver
+# synthetic speed-server payload: one zero-filled block, sent over and over
+_SPEED_BLOCK = 4 * 1024 * 1024
 
-    file_path = os.path.abspath(file_path)
-    directory = os.path.dirname(file_path)
-    filename = os.path.basename(file_path)
 
-    class Handler(http.server.SimpleHTTPRequestHandler):
-        def __init__(self, *args, **kwargs):
-            super().__init__(*args, directory=directory, **kwargs)
-
-        def log_message(self, format, *args):
-            # suppress noisy logs
+def _speed_block():
+    """(file object or None, bytes) for the synthetic payload. On Linux the block is a
+    memfd so it can be sent with sendfile(2); elsewhere a reused in-memory buffer.
+    """
+    buf = bytes(_SPEED_BLOCK)
+    if hasattr(os, 'memfd_create'):
+        try:
+            fd = os.memfd_create('speed-block')
+            os.ftruncate(fd, _SPEED_BLOCK)
+            return os.fdopen(fd, 'rb'), buf
+        except OSError:
             pass
+    return None, buf
+
+
+def _parse_range(value, size):
+    """'bytes=a-b' -> (start, length) within size, or None if absent/unsatisfiable."""
+    m = re.match(r'bytes=(\d*)-(\d*)$', (value or '').strip())
+    if not m or size is None or (not m.group(1) and not m.group(2)):
+        return None
+    if m.group(1):
+        first = int(m.group(1))
+        last = min(int(m.group(2)), size - 1) if m.group(2) else size - 1
+    else:
+        first = max(0, size - int(m.group(2)))
+        last = size - 1
+    if first > last:
+        return None
+    return first, last - first + 1
+
+
+def start_speed_server(file_path=None, size=0, host='127.0.0.1', port=0):
+    """Start a keep-alive HTTP/1.1 server for speed tests. Returns (server, url).
+
+    - GET /<file name>: `file_path` sent with sendfile (Range supported)
+    - GET /speed.bin[?size=N]: synthetic zero body of `size` bytes (Range supported),
+      or an endless close-delimited body when the size is 0; no disk file involved
+    - POST /upload: body is read and discarded, replies {"received": N}
+    - GET /204: empty 204 reply (latency probes)
+    The returned url is the file URL when `file_path` is given, else /speed.bin.
+    """
+    import socketserver
+
+    file_path = os.path.abspath(file_path) if file_path else None
+    file_name = '/' + os.path.basename(file_path) if file_path else None
+    size_default = int(size or 0)
+    block_file, block = _speed_block()
+
+    def send_synthetic(sock, length):
+        # length None: endless body until the client goes away; the block is all
+        # zeros, so every piece is sent from its start
+        while length is None or length > 0:
+            n = _SPEED_BLOCK if length is None else min(length, _SPEED_BLOCK)
+            if block_file is None:
+                sock.sendall(memoryview(block)[:n])
+            else:
+                sock.sendfile(block_file, 0, n)
+            if length is not None:
+                length -= n
 
-        def copyfile(self, source, outputfile):
-            """Override to avoid noisy tracebacks when client disconnects while
-            serving large files (catch BrokenPipeError/ConnectionResetError).
-            """
+    class Handler(socketserver.BaseRequestHandler):
+        def handle(self):
+            sock = self.request
+            pending = b''
             try:
-                shutil.copyfileobj(source, outputfile)
-            except (BrokenPipeError, ConnectionResetError):
-                # client closed connection early — ignore quietly
-                return
-            except OSError:
-                # other socket/OS errors — ignore to avoid noisy logs
-                return
-            except Exception:
-                # fallback: ignore any unexpected errors during file copy
+                while True:
+                    while b'\r\n\r\n' not in pending:
+                        data = sock.recv(65536)
+                        if not data:
+                            return
+                        pending += data
+                        if len(pending) > 65536:
+                            return
+                    head, _, pending = pending.partition(b'\r\n\r\n')
+                    lines = head.decode('latin-1').split('\r\n')
+                    method, target, version = (lines[0].split() + ['', '', ''])[:3]
+                    headers = {}
+                    for line in lines[1:]:
+                        k, _, v = line.partition(':')
+                        headers[k.strip().lower()] = v.strip()
+                    conn_hdr = headers.get('connection', '').lower()
+                    keep = conn_hdr != 'close' if version == 'HTTP/1.1' else conn_hdr == 'keep-alive'
+                    u = urlparse(target)
+                    if method == 'POST' and u.path == '/upload':
+                        pending, keep = self.upload(sock, headers, pending, keep)
+                    elif method in ('GET', 'HEAD'):
+                        keep = self.download(sock, method, u, headers, keep)
+                    else:
+                        self.reply(sock, 404, b'', keep)
+                    if not keep:
+                        return
+            except (BrokenPipeError, ConnectionResetError, OSError):
+                # client closed the connection mid-transfer
                 return
 
-    httpd = socketserver.ThreadingTCPServer(('127.0.0.1', 0), Handler)
+        def reply(self, sock, status, body, keep, extra=''):
+            reason = {200: 'OK', 204: 'No Content', 206: 'Partial Content', 404: 'Not Found', 416: 'Range Not Satisfiable'}.get(status, '')
+            conn = 'keep-alive' if keep else 'close'
+            length = '' if status == 204 else f'Content-Length: {len(body)}\r\n'
+            sock.sendall(f'HTTP/1.1 {status} {reason}\r\n{length}{extra}Connection: {conn}\r\n\r\n'.encode() + body)
+
+        def upload(self, sock, headers, pending, keep):
+            length = headers.get('content-length')
+            remaining = int(length) if length is not None else None
+            received = 0
+            if remaining is not None:
+                take = pending[:remaining]
+                pending = pending[remaining:]
+                received += len(take)
+                remaining -= len(take)
+            else:
+                # no length: the body runs until the client shuts down its side
+                received += len(pending)
+                pending = b''
+                keep = False
+            buf = bytearray(1024 * 1024)
+            while remaining is None or remaining > 0:
+                n = sock.recv_into(buf, len(buf) if remaining is None else min(len(buf), remaining))
+                if not n:
+                    break
+                received += n
+                if remaining is not None:
+                    remaining -= n
+            self.reply(sock, 200, json.dumps({'received': received}).encode(), keep, 'Content-Type: application/json\r\n')
+            return pending, keep
+
+        def download(self, sock, method, u, headers, keep):
+            if u.path == '/204':
+                self.reply(sock, 204, b'', keep)
+                return keep
+            if file_path and u.path == file_name:
+                src = open(file_path, 'rb')
+                size = os.fstat(src.fileno()).st_size
+            elif u.path == '/speed.bin':
+                src = None
+                q = parse_qs(u.query)
+                size = int(q['size'][0]) if q.get('size') else size_default
+            else:
+                self.reply(sock, 404, b'', keep)
+                return keep
+            try:
+                offset, length, status, extra = 0, size or None, 200, ''
+                if size and headers.get('range'):
+                    rng = _parse_range(headers['range'], size)
+                    if rng is None:
+                        self.reply(sock, 416, b'', keep, f'Content-Range: bytes */{size}\r\n')
+                        return keep
+                    offset, length = rng
+                    status, extra = 206, f'Content-Range: bytes {offset}-{offset + length - 1}/{size}\r\n'
+                if length is None:
+                    # endless body: delimited by closing the connection
+                    keep = False
+                    head = 'HTTP/1.1 200 OK\r\nContent-Type: application/octet-stream\r\nConnection: close\r\n\r\n'
+                else:
+                    head = (f'HTTP/1.1 {status} {"OK" if status == 200 else "Partial Content"}\r\nContent-Type: application/octet-stream\r\n'
+                            f'Content-Length: {length}\r\nAccept-Ranges: bytes\r\n{extra}Connection: {"keep-alive" if keep else "close"}\r\n\r\n')
+                sock.sendall(head.encode())
+                if method == 'GET' and src is None:
+                    send_synthetic(sock, length)
+                elif method == 'GET':
+                    sock.sendfile(src, offset, length)
+            finally:
+                if src is not None:
+                    src.close()
+            return keep
+
+    class Server(socketserver.ThreadingTCPServer):
+        daemon_threads = True
+        allow_reuse_address = True
+        # many nodes start their speed test at the same moment
+        request_queue_size = 1024
+
+        def server_close(self):
+            super().server_close()
+            if block_file is not None:
+                block_file.close()
+
+    httpd = Server((host, port), Handler)
     port = httpd.server_address[1]
-    url = f'http://127.0.0.1:{port}/{filename}'
+    url = f'http://{host}:{port}{file_name or "/speed.bin"}'
 
     thread = threading.Thread(target=httpd.serve_forever, daemon=True)
     thread.start()
     return httpd, url
 
 
+def start_local_http_server(file_path):
+    """Start a small HTTP server serving file_path (see start_speed_server). Returns (server, url)"""
+    return start_speed_server(file_path=file_path)
+
+
 def stop_local_http_server(httpd):
     try:
         httpd.shutdown()
@@ -470,89 +2387,296 @@ def stop_local_http_server(httpd):
         pass
 
 
-def run_xray_for_node(node, xray_path='xray', start_timeout=5):
-    """Try to start xray with a minimal client config for this single outbound node.
-    Returns: {'proc': Popen, 'socks': 'socks5://127.0.0.1:PORT', 'http': 'http://127.0.0.1:PORT'} or None on failure.
-
-    NOTE: This is a best-effort helper: not all node types/options are covered. Use --xray-path to set binary path.
+def _xray_stream_settings(node, address=None):
+    """streamSettings for the node's transport and security layer, or None if unsupported.
+    When `address` replaces the node's hostname (a resolved IP), the hostname is kept
+    as the HTTP Host / gRPC authority / TLS SNI the server expects.
     """
     proto = node.get('protocol')
-    if proto not in ('vless', 'vmess'):
+    net = (node.get('net') or 'tcp').lower()
+    host = node.get('host')
+    if not host and address and address != node.get('add'):
+        host = node.get('add')
+    path = node.get('path')
+    header_type = node.get('headerType') or (node.get('type') if proto == 'vmess' else None)
+    stream = {}
+    if net in ('tcp', 'raw'):
+        net = 'tcp'
+        if header_type == 'http':
+            request = {'path': (path or '/').split(',')}
+            if host:
+                request['headers'] = {'Host': host.split(',')}
+            stream['tcpSettings'] = {'header': {'type': 'http', 'request': request}}
+    elif net == 'ws':
+        stream['wsSettings'] = {'path': path or '/', 'headers': {'Host': host} if host else {}}
+    elif net == 'grpc':
+        # vmess links carry the gRPC service name in 'path'
+        stream['grpcSettings'] = {'serviceName': node.get('serviceName') or path or '', 'multiMode': node.get('mode') == 'multi'}
+        if host:
+            stream['grpcSettings']['authority'] = host.split(',')[0]
+    elif net in ('h2', 'http'):
+        net = 'http'
+        stream['httpSettings'] = {'path': path or '/', 'host': host.split(',') if host else []}
+    elif net == 'httpupgrade':
+        stream['httpupgradeSettings'] = {'path': path or '/', 'host': host or ''}
+    elif net in ('xhttp', 'splithttp'):
+        net = 'xhttp'
+        stream['xhttpSettings'] = {'path': path or '/', 'host': host or '', 'mode': node.get('mode') or 'auto'}
+    elif net == 'kcp':
+        stream['kcpSettings'] = {'header': {'type': header_type or 'none'}, 'seed': path or ''}
+    else:
         return None
+    stream['network'] = net
 
-    # prepare ports
-    socks_port = get_free_port()
-    http_port = get_free_port()
-    tempdir = tempfile.mkdtemp(prefix='xray-client-')
-    cfg_path = os.path.join(tempdir, 'config.json')
-
-    # build minimal outbound
-    if proto == 'vless':
-        outbound = {
-            "protocol": "vless",
-            "settings": {
-                "vnext": [
-                    {
-                        "address": node.get('add'),
-                        "port": int(node.get('port') or 0),
-                        "users": [
-                            {"id": node.get('id'), "flow": ""}
-                        ]
-                    }
-                ]
-            }
-        }
-    else:  # vmess
-        outbound = {
-            "protocol": "vmess",
-            "settings": {
-                "vnext": [
-                    {
-                        "address": node.get('add'),
-                        "port": int(node.get('port') or 0),
-                        "users": [
-                            {"id": node.get('id')}
-                        ]
-                    }
-                ]
-            }
+    security = (node.get('security') or node.get('tls') or ('tls' if proto == 'trojan' else 'none')).lower()
+    sni = node.get('sni') or (host.split(',')[0] if host else None) or node.get('add')
+    if security == 'tls':
+        tls = {'serverName': sni, 'allowInsecure': node.get('allowInsecure') in ('1', 'true')}
+        if node.get('fp'):
+            tls['fingerprint'] = node.get('fp')
+        if node.get('alpn'):
+            tls['alpn'] = node.get('alpn').split(',')
+        stream['security'] = 'tls'
+        stream['tlsSettings'] = tls
+    elif security == 'reality':
+        if not node.get('pbk'):
+            return None
+        stream['security'] = 'reality'
+        stream['realitySettings'] = {
+            'serverName': node.get('sni') or '',
+            'fingerprint': node.get('fp') or 'chrome',
+            'publicKey': node.get('pbk'),
+            'shortId': node.get('sid') or '',
+            'spiderX': node.get('spx') or '',
         }
+    elif security not in ('none', ''):
+        return None
+    return stream
 
-    cfg = {
-        "log": {"access":"", "error":"", "loglevel":"warning"},
-        "inbounds": [
-            {"port": socks_port, "protocol": "socks", "settings": {"udp": True}},
-            {"port": http_port, "protocol": "http", "settings": {}}
-        ],
-        "outbounds": [
-            outbound,
-            {"protocol": "freedom", "settings": {}}
-        ]
-    }
 
+def compile_xray_outbound(node, address=None):
+    """Translate a parsed vless/vmess/trojan/ss node into an untagged xray outbound.
+    Returns None if the protocol, transport or security layer is not supported or a
+    required field is missing. `address` overrides the server address.
+    """
+    proto = node.get('protocol')
+    server = address or node.get('add')
     try:
-        with open(cfg_path, 'w', encoding='utf-8') as fh:
-            json.dump(cfg, fh)
-        proc = subprocess.Popen([xray_path, '-config', cfg_path], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-        # wait a bit for the process to become ready
-        t0 = time.time()
-        while time.time() - t0 < start_timeout:
-            # try to connect to socks port
-            try:
-                s = socket.create_connection(('127.0.0.1', socks_port), timeout=1)
-                s.close()
-                return {'proc': proc, 'socks': f'socks5h://127.0.0.1:{socks_port}', 'http': f'http://127.0.0.1:{http_port}', 'tmpdir': tempdir}
-            except Exception:
-                time.sleep(0.1)
-        # failed to start
-        proc.kill()
-    except Exception:
-        pass
-    try:
-        shutil.rmtree(tempdir)
-    except Exception:
-        pass
-    return None
+        port = int(node.get('port') or 0)
+    except (TypeError, ValueError):
+        return None
+    if not server or not port:
+        return None
+
+    if proto == 'vless':
+        if not node.get('id'):
+            return None
+        user = {"id": node.get('id'), "encryption": "none", "flow": node.get('flow') or ""}
+        settings = {"vnext": [{"address": server, "port": port, "users": [user]}]}
+    elif proto == 'vmess':
+        if not node.get('id'):
+            return None
+        user = {"id": node.get('id'), "alterId": int(node.get('aid') or 0), "security": node.get('scy') or "auto"}
+        settings = {"vnext": [{"address": server, "port": port, "users": [user]}]}
+    elif proto == 'trojan':
+        if not node.get('password'):
+            return None
+        settings = {"servers": [{"address": server, "port": port, "password": node.get('password')}]}
+    elif proto == 'ss':
+        # xray has no SIP003 plugin support (obfs, v2ray-plugin)
+        if not (node.get('method') and node.get('password')) or node.get('plugin'):
+            return None
+        settings = {"servers": [{"address": server, "port": port, "method": node.get('method'), "password": node.get('password')}]}
+    else:
+        return None
+
+    outbound = {"protocol": "shadowsocks" if proto == 'ss' else proto, "settings": settings}
+    if proto != 'ss':
+        stream = _xray_stream_settings(node, address)
+        if stream is None:
+            return None
+        outbound["streamSettings"] = stream
+    return outbound
+
+
+class OutboundCache:
+    """Compiled outbounds keyed by (link, address), so a node is translated once and
+    reused by every xray provider, retry and incremental rerun. Bounded LRU, thread-safe.
+    """
+
+    def __init__(self, maxsize=65536):
+        self.maxsize = maxsize
+        self._items = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, node, address=None):
+        key = (node.get('raw') or node_key(node), address)
+        with self._lock:
+            if key in self._items:
+                self._items.move_to_end(key)
+                self.hits += 1
+                return self._items[key]
+        outbound = compile_xray_outbound(node, address=address)
+        with self._lock:
+            self.misses += 1
+            self._items[key] = outbound
+            if len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+        return outbound
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+
+OUTBOUND_CACHE = OutboundCache()
+
+
+def build_xray_outbound(node, address=None, tag=None):
+    """Build an xray outbound for the node, or None if the protocol is not supported.
+    `address` overrides the server address (e.g. an IP from the resolver stage).
+    """
+    outbound = OUTBOUND_CACHE.get(node, address)
+    if outbound is None:
+        return None
+    # shallow copy: the cached nested settings are shared and never mutated
+    outbound = dict(outbound)
+    if tag:
+        outbound['tag'] = tag
+    return outbound
+
+
+def check_xray_config(cfg, xray_path='xray', timeout=15):
+    """Validate a config with `xray run -test`. Returns (ok, output)."""
+    tempdir = tempfile.mkdtemp(prefix='xray-test-')
+    cfg_path = os.path.join(tempdir, 'config.json')
+    try:
+        with open(cfg_path, 'w', encoding='utf-8') as fh:
+            json.dump(cfg, fh)
+        proc = subprocess.run([xray_path, 'run', '-test', '-config', cfg_path], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, timeout=timeout)
+        return proc.returncode == 0, proc.stdout.decode('utf-8', errors='replace').strip()
+    except Exception as e:
+        return False, str(e)
+    finally:
+        shutil.rmtree(tempdir, ignore_errors=True)
+
+
+def _outbound_test_config(outbounds):
+    return {"log": {"loglevel": "warning"}, "outbounds": list(outbounds) + [{"tag": "direct", "protocol": "freedom", "settings": {}}]}
+
+
+def bisect_outbounds(entries, xray_path='xray'):
+    """Validate (item, tagged outbound) pairs with `xray run -test`; a failing set is
+    split until the rejected outbounds are isolated, so one bad outbound costs about
+    2*log2(n) extra runs. Returns (accepted entries, [(item, output)] rejected).
+    """
+    accepted, rejected = [], []
+
+    def check(part):
+        ok, output = check_xray_config(_outbound_test_config(ob for _, ob in part), xray_path=xray_path)
+        if ok:
+            accepted.extend(part)
+        elif len(part) == 1:
+            rejected.append((part[0][0], output))
+        else:
+            half = len(part) // 2
+            check(part[:half])
+            check(part[half:])
+
+    if entries:
+        check(list(entries))
+    return accepted, rejected
+
+
+def check_outbounds(nodes, xray_path='xray', batch_size=200):
+    """Translate every node and validate the outbounds with `xray run -test`, batch_size
+    per config; a failing batch is split until the bad outbounds are isolated.
+    Returns {'ok': n, 'unsupported': [nodes], 'invalid': [(node, output)]}.
+    """
+    report = {'ok': 0, 'unsupported': [], 'invalid': []}
+    compiled = []
+    for node in nodes:
+        outbound = build_xray_outbound(node)
+        if outbound is None:
+            report['unsupported'].append(node)
+        else:
+            compiled.append((node, outbound))
+
+    for i in range(0, len(compiled), max(1, batch_size)):
+        batch = [(node, dict(ob, tag=f'out-{j}')) for j, (node, ob) in enumerate(compiled[i:i + batch_size])]
+        accepted, rejected = bisect_outbounds(batch, xray_path=xray_path)
+        report['ok'] += len(accepted)
+        report['invalid'].extend(rejected)
+    return report
+
+
+def _spawn_xray(cfg, xray_path, wait_port, start_timeout=5, prefix='xray-client-'):
+    """Write cfg to a temp dir, start xray and wait until `wait_port` accepts connections.
+    Returns (proc, tmpdir) or (None, None) on failure.
+    """
+    tempdir = tempfile.mkdtemp(prefix=prefix)
+    cfg_path = os.path.join(tempdir, 'config.json')
+    try:
+        with open(cfg_path, 'w', encoding='utf-8') as fh:
+            json.dump(cfg, fh)
+        proc = subprocess.Popen([xray_path, '-config', cfg_path], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        # wait a bit for the process to become ready
+        t0 = time.time()
+        while time.time() - t0 < start_timeout:
+            if proc.poll() is not None:
+                break
+            # try to connect to socks port
+            try:
+                s = socket.create_connection(('127.0.0.1', wait_port), timeout=1)
+                s.close()
+                return proc, tempdir
+            except Exception:
+                time.sleep(0.1)
+        # failed to start
+        proc.kill()
+    except Exception:
+        pass
+    try:
+        shutil.rmtree(tempdir)
+    except Exception:
+        pass
+    return None, None
+
+
+def run_xray_for_node(node, xray_path='xray', start_timeout=5, address=None):
+    """Try to start xray with a minimal client config for this single outbound node.
+    Returns: {'proc': Popen, 'socks': 'socks5://127.0.0.1:PORT', 'http': 'http://127.0.0.1:PORT'} or None on failure.
+    `address` overrides the server address (e.g. an IP from the resolver stage).
+
+    Nodes that build_xray_outbound cannot translate (e.g. ss with a SIP003 plugin) give None.
+    Use --xray-path to set binary path.
+    """
+    outbound = build_xray_outbound(node, address=address)
+    if outbound is None:
+        return None
+
+    # prepare ports
+    socks_port = get_free_port()
+    http_port = get_free_port()
+
+    cfg = {
+        "log": {"access":"", "error":"", "loglevel":"warning"},
+        "inbounds": [
+            {"port": socks_port, "protocol": "socks", "settings": {"udp": True}},
+            {"port": http_port, "protocol": "http", "settings": {}}
+        ],
+        "outbounds": [
+            outbound,
+            {"protocol": "freedom", "settings": {}}
+        ]
+    }
+
+    proc, tempdir = _spawn_xray(cfg, xray_path, socks_port, start_timeout=start_timeout)
+    if proc is None:
+        return None
+    return {'proc': proc, 'socks': f'socks5h://127.0.0.1:{socks_port}', 'http': f'http://127.0.0.1:{http_port}', 'tmpdir': tempdir}
 
 
 def stop_xray(x):
@@ -570,17 +2694,854 @@ def stop_xray(x):
         pass
 
 
-def test_nodes(nodes, timeout=5, workers=10, ping_count=4, tcp_retries=6, tcp_timeout=3, do_speed=False, speed_url=None, speed_duration=10, speed_concurrency=1, speed_requests=None, do_game=False, udp_target=None, game_duration=5, game_psize=60, game_interval_ms=20, expect_echo=False, start_xray=False, xray_path='xray', show_progress=True, on_node_complete=None):
+class XrayPerNode:
+    """xray provider that starts a dedicated xray process for every node (run_xray_for_node).
+
+    Providers share one interface used by test_nodes: register(node, address) -> ticket
+    in submission order, seal() once all nodes are registered, acquire(ticket) -> proxy
+    dict with 'http'/'socks' (or None), release(ticket, x), close().
+    """
+
+    def __init__(self, xray_path='xray', start_timeout=5):
+        self.xray_path = xray_path
+        self.start_timeout = start_timeout
+        self.closed = False
+
+    def register(self, node, address=None):
+        return (node, address)
+
+    def seal(self):
+        pass
+
+    def acquire(self, ticket):
+        if self.closed:
+            return None
+        node, address = ticket
+        return run_xray_for_node(node, xray_path=self.xray_path, start_timeout=self.start_timeout, address=address)
+
+    def release(self, ticket, x):
+        if x:
+            stop_xray(x)
+
+    def close(self):
+        # nodes still running keep their process until they release it
+        self.closed = True
+
+
+class XrayBatch:
+    """One xray process for several nodes: inbound pair in-i (socks+http) is routed to
+    outbound out-i, so each node gets its own local proxy ports on a shared process.
+    Before the first start the outbounds go through bisect_outbounds and the ones xray
+    rejects are dropped (their nodes get no proxy) instead of failing the whole batch.
+    A batch that still cannot start is marked failed and never spawned again.
+    """
+
+    def __init__(self, entries, xray_path='xray', start_timeout=5):
+        # entries: list of (node, address)
+        self.xray_path = xray_path
+        self.start_timeout = start_timeout
+        self.proc = None
+        self.tmpdir = None
+        self.restarts = 0
+        self.stopped = False
+        self.failed = False
+        self.validated = False
+        self.rejected = []  # (entry index, xray -test output)
+        self.outbounds = [build_xray_outbound(node, address=address, tag=f'out-{i}') for i, (node, address) in enumerate(entries)]
+        self._configure()
+        self._lock = threading.Lock()
+
+    def _configure(self):
+        ports, inbounds, outbounds, rules = [], [], [], []
+        for i, outbound in enumerate(self.outbounds):
+            if outbound is None:
+                ports.append(None)
+                continue
+            socks_port, http_port = get_free_port(), get_free_port()
+            ports.append((socks_port, http_port))
+            inbounds.append({"tag": f"in-{i}-socks", "listen": "127.0.0.1", "port": socks_port, "protocol": "socks", "settings": {"udp": True}})
+            inbounds.append({"tag": f"in-{i}-http", "listen": "127.0.0.1", "port": http_port, "protocol": "http", "settings": {}})
+            outbounds.append(outbound)
+            rules.append({"type": "field", "inboundTag": [f"in-{i}-socks", f"in-{i}-http"], "outboundTag": f"out-{i}"})
+        outbounds.append({"tag": "direct", "protocol": "freedom", "settings": {}})
+        self.cfg = {
+            "log": {"access": "", "error": "", "loglevel": "warning"},
+            "inbounds": inbounds,
+            "outbounds": outbounds,
+            "routing": {"rules": rules},
+        }
+        self.ports = ports
+
+    def _validate(self):
+        entries = [(i, ob) for i, ob in enumerate(self.outbounds) if ob is not None]
+        _, rejected = bisect_outbounds(entries, xray_path=self.xray_path)
+        if rejected:
+            self.rejected = rejected
+            for i, _ in rejected:
+                self.outbounds[i] = None
+            self._configure()
+
+    def _wait_port(self):
+        for p in self.ports:
+            if p:
+                return p[0]
+        return None
+
+    def ensure_running(self):
+        """Start the process, or restart it if it has crashed. Returns True if running."""
+        with self._lock:
+            if self.stopped or self.failed:
+                return False
+            if self.proc is not None and self.proc.poll() is None:
+                return True
+            if self.proc is not None:
+                self.restarts += 1
+                self._cleanup()
+            if not self.validated:
+                self.validated = True
+                self._validate()
+            port = self._wait_port()
+            if port is not None:
+                self.proc, self.tmpdir = _spawn_xray(self.cfg, self.xray_path, port, start_timeout=self.start_timeout, prefix='xray-batch-')
+            if self.proc is None:
+                # every later proxy_for of this batch fails fast instead of respawning
+                self.failed = True
+                return False
+            return True
+
+    def proxy_for(self, i):
+        if self.outbounds[i] is None or not self.ensure_running():
+            return None
+        p = self.ports[i]
+        if p is None:
+            return None
+        return {'socks': f'socks5h://127.0.0.1:{p[0]}', 'http': f'http://127.0.0.1:{p[1]}'}
+
+    def _cleanup(self):
+        if self.proc is not None:
+            stop_xray({'proc': self.proc, 'tmpdir': self.tmpdir})
+        self.proc = None
+        self.tmpdir = None
+
+    def stop(self):
+        with self._lock:
+            self.stopped = True
+            self._cleanup()
+
+
+class XrayBatchProvider:
+    """xray provider that groups nodes into batches of `batch_size` in submission order
+    and runs one XrayBatch process per batch. A batch starts when its first node is
+    acquired and stops when its last node is released, so process spawns drop from N
+    to N/batch_size and a crash only restarts the affected batch.
+    """
+
+    def __init__(self, xray_path='xray', batch_size=50, start_timeout=5):
+        self.xray_path = xray_path
+        self.batch_size = max(1, batch_size)
+        self.start_timeout = start_timeout
+        self._entries = []  # per batch: [(node, address), ...]
+        self._batches = {}  # batch index -> XrayBatch
+        self._remaining = {}
+        self._sealed = False
+        self._closed = False
+        self._cond = threading.Condition()
+        self.spawned = 0
+
+    def register(self, node, address=None):
+        with self._cond:
+            if not self._entries or len(self._entries[-1]) >= self.batch_size:
+                self._entries.append([])
+            b = len(self._entries) - 1
+            self._entries[b].append((node, address))
+            self._remaining[b] = self._remaining.get(b, 0) + 1
+            self._cond.notify_all()
+            return (b, len(self._entries[b]) - 1)
+
+    def seal(self):
+        with self._cond:
+            self._sealed = True
+            self._cond.notify_all()
+
+    def _batch(self, b):
+        with self._cond:
+            # a batch is built once it is full (or no more nodes will come)
+            while len(self._entries[b]) < self.batch_size and not self._sealed and b == len(self._entries) - 1:
+                self._cond.wait()
+            if self._closed:
+                return None
+            batch = self._batches.get(b)
+            if batch is None:
+                batch = XrayBatch(self._entries[b], xray_path=self.xray_path, start_timeout=self.start_timeout)
+                self._batches[b] = batch
+                self.spawned += 1
+            return batch
+
+    def acquire(self, ticket):
+        b, i = ticket
+        batch = self._batch(b)
+        return batch.proxy_for(i) if batch else None
+
+    def release(self, ticket, x):
+        b, _ = ticket
+        with self._cond:
+            self._remaining[b] -= 1
+            done = self._remaining[b] <= 0
+            batch = self._batches.pop(b, None) if done else None
+            if done:
+                self._entries[b] = []
+        if batch:
+            batch.stop()
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._sealed = True
+            batches = list(self._batches.values())
+            self._batches.clear()
+            self._cond.notify_all()
+        for batch in batches:
+            batch.stop()
+
+
+# ---------------------------------------------------------------------------
+# xray HandlerService: AddOutbound/RemoveOutbound over gRPC without spawning `xray api`
+# ---------------------------------------------------------------------------
+
+_HANDLER_SERVICE = '/xray.app.proxyman.command.HandlerService/'
+
+
+def _pb_varint(n):
+    out = bytearray()
+    while True:
+        b = n & 0x7f
+        n >>= 7
+        if n:
+            out.append(b | 0x80)
+        else:
+            out.append(b)
+            return bytes(out)
+
+
+def _pb_bytes(field, data):
+    """Length-delimited protobuf field."""
+    return _pb_varint(field << 3 | 2) + _pb_varint(len(data)) + data
+
+
+def _pb_fields(buf):
+    """Yield (field, wire type, value, raw bytes of the whole field) of a protobuf message.
+    Values: int for varint/fixed, bytes for length-delimited. Raises ValueError if malformed.
+    """
+    i, n = 0, len(buf)
+
+    def varint():
+        nonlocal i
+        shift = value = 0
+        while True:
+            if i >= n or shift > 63:
+                raise ValueError('truncated varint')
+            b = buf[i]
+            i += 1
+            value |= (b & 0x7f) << shift
+            shift += 7
+            if not b & 0x80:
+                return value
+
+    while i < n:
+        start = i
+        key = varint()
+        field, wire = key >> 3, key & 7
+        if wire == 0:
+            value = varint()
+        elif wire == 1:
+            value, i = int.from_bytes(buf[i:i + 8], 'little'), i + 8
+        elif wire == 2:
+            size = varint()
+            value, i = bytes(buf[i:i + size]), i + size
+        elif wire == 5:
+            value, i = int.from_bytes(buf[i:i + 4], 'little'), i + 4
+        else:
+            raise ValueError(f'unsupported wire type {wire}')
+        if i > n:
+            raise ValueError('truncated field')
+        yield field, wire, value, bytes(buf[start:i])
+
+
+def retag_outbound_pb(handler_config, tag):
+    """OutboundHandlerConfig bytes with field 1 (tag) replaced by `tag`."""
+    rest = b''.join(raw for field, _, _, raw in _pb_fields(handler_config) if field != 1)
+    return _pb_bytes(1, tag.encode('utf-8')) + rest
+
+
+def convert_outbounds_pb(outbounds, xray_path='xray', timeout=15):
+    """Compile tagged JSON outbounds to OutboundHandlerConfig protobuf with one
+    `xray convert pb` run. Returns {tag: bytes}; raises RuntimeError on failure.
+    """
+    tempdir = tempfile.mkdtemp(prefix='xray-pb-')
+    path = os.path.join(tempdir, 'outbounds.json')
+    try:
+        with open(path, 'w', encoding='utf-8') as fh:
+            json.dump({"outbounds": list(outbounds)}, fh)
+        proc = subprocess.run([xray_path, 'convert', 'pb', path], stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=timeout)
+        if proc.returncode != 0 or not proc.stdout:
+            raise RuntimeError(proc.stderr.decode('utf-8', errors='replace').strip() or f'exit code {proc.returncode}')
+        converted = {}
+        # core.Config: field 2 = repeated OutboundHandlerConfig (field 1 = tag)
+        for field, wire, value, _ in _pb_fields(proc.stdout):
+            if field == 2 and wire == 2:
+                tag = next((v for f, w, v, _ in _pb_fields(value) if f == 1 and w == 2), b'')
+                converted[tag.decode('utf-8', errors='replace')] = value
+        return converted
+    except (OSError, ValueError, subprocess.SubprocessError) as e:
+        raise RuntimeError(str(e))
+    finally:
+        shutil.rmtree(tempdir, ignore_errors=True)
+
+
+def _hpack_int(value, prefix_bits, flags=0):
+    limit = (1 << prefix_bits) - 1
+    if value < limit:
+        return bytes([flags | value])
+    out = bytearray([flags | limit])
+    value -= limit
+    while value >= 0x80:
+        out.append(value & 0x7f | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def _hpack_str(s):
+    data = s.encode('utf-8')
+    return _hpack_int(len(data), 7) + data
+
+
+class H2GrpcChannel:
+    """Minimal gRPC client over one cleartext HTTP/2 connection (h2c, prior knowledge),
+    enough for xray's unary HandlerService calls: requests are HPACK literals without
+    Huffman coding and calls run one at a time. A call succeeds when the server sends a
+    response message; gRPC errors arrive as trailers-only responses without one, so
+    response headers never need decoding.
+    """
+
+    PREFACE = b'PRI * HTTP/2.0\r\n\r\nSM\r\n\r\n'
+    DATA, HEADERS, RST_STREAM, SETTINGS, PING, GOAWAY, WINDOW_UPDATE = 0, 1, 3, 4, 6, 7, 8
+    END_STREAM, ACK, END_HEADERS = 0x1, 0x1, 0x4
+
+    def __init__(self, host, port, timeout=5):
+        self.authority = f'{host}:{port}'
+        self.address = (host, port)
+        self.timeout = timeout
+        self.sock = None
+        self._buf = b''
+        self._next_stream = 1
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        self.sock = socket.create_connection(self.address, timeout=self.timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._buf = b''
+        self._next_stream = 1
+        self.sock.sendall(self.PREFACE + self._frame(self.SETTINGS, 0, 0, b''))
+
+    def _frame(self, ftype, flags, stream, payload):
+        return len(payload).to_bytes(3, 'big') + bytes([ftype, flags]) + stream.to_bytes(4, 'big') + payload
+
+    def _read(self, size):
+        while len(self._buf) < size:
+            chunk = self.sock.recv(65536)
+            if not chunk:
+                raise ConnectionError('connection closed by the API server')
+            self._buf += chunk
+        data, self._buf = self._buf[:size], self._buf[size:]
+        return data
+
+    def _read_frame(self):
+        head = self._read(9)
+        size = int.from_bytes(head[:3], 'big')
+        return head[3], head[4], int.from_bytes(head[5:9], 'big') & 0x7fffffff, self._read(size)
+
+    def call(self, path, payload):
+        """Unary call. Returns (True, response message) or (False, None) for a gRPC error;
+        raises OSError if the connection fails (it is reopened on the next call).
+        """
+        with self._lock:
+            try:
+                if self.sock is None:
+                    self._connect()
+                return self._call(path, payload)
+            except (OSError, ValueError):
+                self.close()
+                raise ConnectionError(f'HTTP/2 call to {self.authority}{path} failed')
+
+    def _call(self, path, payload):
+        stream = self._next_stream
+        self._next_stream += 2
+        headers = (b'\x83\x86'  # :method POST, :scheme http (static table)
+                   + b'\x04' + _hpack_str(path)
+                   + b'\x01' + _hpack_str(self.authority)
+                   + b'\x0f\x10' + _hpack_str('application/grpc')
+                   + b'\x00' + _hpack_str('te') + _hpack_str('trailers'))
+        message = b'\x00' + len(payload).to_bytes(4, 'big') + payload
+        self.sock.sendall(self._frame(self.HEADERS, self.END_HEADERS, stream, headers)
+                          + self._frame(self.DATA, self.END_STREAM, stream, message))
+        body = b''
+        while True:
+            ftype, flags, sid, data = self._read_frame()
+            if ftype == self.SETTINGS and not flags & self.ACK:
+                self.sock.sendall(self._frame(self.SETTINGS, self.ACK, 0, b''))
+            elif ftype == self.PING and not flags & self.ACK:
+                self.sock.sendall(self._frame(self.PING, self.ACK, 0, data))
+            elif ftype == self.GOAWAY:
+                raise ConnectionError('GOAWAY')
+            elif sid != stream:
+                continue
+            elif ftype == self.RST_STREAM:
+                return False, None
+            elif ftype == self.DATA:
+                if flags & 0x8:  # PADDED
+                    data = data[1:len(data) - data[0]]
+                body += data
+                if data:
+                    # give the connection window back; streams are never reused
+                    self.sock.sendall(self._frame(self.WINDOW_UPDATE, 0, 0, len(data).to_bytes(4, 'big')))
+            if sid == stream and ftype in (self.DATA, self.HEADERS) and flags & self.END_STREAM:
+                if len(body) < 5:
+                    return False, None
+                return True, body[5:5 + int.from_bytes(body[1:5], 'big')]
+
+    def close(self):
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except OSError:
+                pass
+        self.sock = None
+
+
+class HandlerClient:
+    """xray HandlerService client for the outbound swaps of XrayWorker: grpcio when it
+    is installed, otherwise H2GrpcChannel. Methods return True/False for the call's
+    outcome and None when the API cannot be reached.
+    """
+
+    def __init__(self, port, host='127.0.0.1', timeout=5):
+        self.timeout = timeout
+        self._grpc = grpc.insecure_channel(f'{host}:{port}') if grpc is not None else None
+        self._h2 = None if self._grpc is not None else H2GrpcChannel(host, port, timeout=timeout)
+
+    def _call(self, method, payload):
+        try:
+            if self._grpc is not None:
+                self._grpc.unary_unary(_HANDLER_SERVICE + method)(payload, timeout=self.timeout)
+                return True
+            return self._h2.call(_HANDLER_SERVICE + method, payload)[0]
+        except OSError:
+            return None
+        except Exception as e:
+            if grpc is not None and isinstance(e, grpc.RpcError):
+                return None if e.code() in (grpc.StatusCode.UNAVAILABLE, grpc.StatusCode.DEADLINE_EXCEEDED) else False
+            return None
+
+    def add_outbound(self, handler_config):
+        """AddOutboundRequest{outbound: OutboundHandlerConfig (protobuf bytes)}."""
+        return self._call('AddOutbound', _pb_bytes(1, handler_config))
+
+    def remove_outbound(self, tag):
+        """RemoveOutboundRequest{tag}."""
+        return self._call('RemoveOutbound', _pb_bytes(1, tag.encode('utf-8')))
+
+    def close(self):
+        if self._grpc is not None:
+            self._grpc.close()
+        if self._h2 is not None:
+            self._h2.close()
+
+
+class XrayWorker:
+    """Long-lived xray process with a local socks/http inbound routed to the outbound
+    tagged 'node'. The outbound is swapped at runtime through xray's HandlerService:
+    RemoveOutbound/AddOutbound calls over a persistent connection to the worker's API
+    port when the outbound is available as protobuf, `xray api rmo` / `xray api ado`
+    otherwise, so switching to another node needs no process restart.
+    """
+
+    def __init__(self, xray_path='xray', start_timeout=5, api_timeout=5):
+        self.xray_path = xray_path
+        self.start_timeout = start_timeout
+        self.api_timeout = api_timeout
+        self.proc = None
+        self.tmpdir = None
+        self.api = None
+        self.uses = 0
+
+    def start(self):
+        self.stop()
+        self.api_port, self.socks_port, self.http_port = get_free_port(), get_free_port(), get_free_port()
+        cfg = {
+            "log": {"access": "", "error": "", "loglevel": "warning"},
+            "api": {"tag": "api", "services": ["HandlerService"]},
+            "inbounds": [
+                {"tag": "api-in", "listen": "127.0.0.1", "port": self.api_port, "protocol": "dokodemo-door", "settings": {"address": "127.0.0.1"}},
+                {"tag": "in-socks", "listen": "127.0.0.1", "port": self.socks_port, "protocol": "socks", "settings": {"udp": True}},
+                {"tag": "in-http", "listen": "127.0.0.1", "port": self.http_port, "protocol": "http", "settings": {}},
+            ],
+            "outbounds": [
+                {"tag": "node", "protocol": "blackhole", "settings": {}},
+                {"tag": "direct", "protocol": "freedom", "settings": {}},
+            ],
+            "routing": {"rules": [
+                {"type": "field", "inboundTag": ["api-in"], "outboundTag": "api"},
+                {"type": "field", "inboundTag": ["in-socks", "in-http"], "outboundTag": "node"},
+            ]},
+        }
+        self.proc, self.tmpdir = _spawn_xray(cfg, self.xray_path, self.socks_port, start_timeout=self.start_timeout, prefix='xray-pool-')
+        self.api = HandlerClient(self.api_port, timeout=self.api_timeout) if self.proc is not None else None
+        self.uses = 0
+        return self.proc is not None
+
+    def healthy(self):
+        if self.proc is None or self.proc.poll() is not None:
+            return False
+        try:
+            socket.create_connection(('127.0.0.1', self.socks_port), timeout=1).close()
+            return True
+        except Exception:
+            return False
+
+    def _api(self, *args):
+        cmd = [self.xray_path, 'api', *args[:1], f'--server=127.0.0.1:{self.api_port}', *args[1:]]
+        try:
+            return subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=self.api_timeout).returncode == 0
+        except Exception:
+            return False
+
+    def swap(self, outbound, outbound_pb=None):
+        """Replace the 'node' outbound; `outbound_pb` is the same outbound as
+        OutboundHandlerConfig protobuf (any tag). Returns True on success.
+        """
+        if outbound_pb is not None and self.api is not None:
+            self.api.remove_outbound('node')
+            ok = self.api.add_outbound(retag_outbound_pb(outbound_pb, 'node'))
+            if ok is not None:
+                if ok:
+                    self.uses += 1
+                return ok
+        path = os.path.join(self.tmpdir, 'outbound.json')
+        with open(path, 'w', encoding='utf-8') as fh:
+            json.dump({"outbounds": [dict(outbound, tag='node')]}, fh)
+        self._api('rmo', 'node')
+        if not self._api('ado', path):
+            return False
+        self.uses += 1
+        return True
+
+    def proxies(self):
+        return {'socks': f'socks5h://127.0.0.1:{self.socks_port}', 'http': f'http://127.0.0.1:{self.http_port}'}
+
+    def stop(self):
+        if self.api is not None:
+            self.api.close()
+            self.api = None
+        if self.proc is not None:
+            stop_xray({'proc': self.proc, 'tmpdir': self.tmpdir})
+        self.proc = None
+        self.tmpdir = None
+
+
+class XrayPoolProvider:
+    """xray provider with `size` pre-warmed XrayWorker processes that nodes lease.
+
+    Leasing swaps the worker's outbound via the API instead of spawning xray, so xray
+    cold start never falls inside a measurement. Workers are health-checked on lease,
+    restarted if dead or if a swap fails, and recycled after `recycle_after` nodes.
+    Outbounds are compiled to protobuf for the HandlerService calls `convert_batch` at a
+    time (registered nodes that have not been leased yet), one `xray convert pb` each;
+    if conversion fails the swaps fall back to the `xray api` CLI.
+    """
+
+    def __init__(self, xray_path='xray', size=10, recycle_after=100, start_timeout=5, convert_batch=64):
+        self.xray_path = xray_path
+        self.convert_batch = max(1, convert_batch)
+        self._pending = collections.OrderedDict()  # registered, not yet converted: key -> (node, address)
+        self._pb = {}  # key -> OutboundHandlerConfig bytes, or None if it could not be converted
+        self._pb_lock = threading.Lock()
+        self._inflight = {}  # key -> Future of the conversion that includes it
+        self._convert = True
+        self._converted = False
+        self._convert_failures = 0
+        self.recycle_after = max(1, recycle_after)
+        self.workers = [XrayWorker(xray_path=xray_path, start_timeout=start_timeout) for _ in range(max(1, size))]
+        self._idle = queue.Queue()
+        self.restarts = 0
+        self.closed = False
+        with ThreadPoolExecutor(max_workers=len(self.workers)) as ex:
+            list(ex.map(lambda w: w.start(), self.workers))
+        for w in self.workers:
+            self._idle.put(w)
+
+    def register(self, node, address=None):
+        if self._convert:
+            with self._pb_lock:
+                self._pending[(node.get('raw') or node_key(node), address)] = (node, address)
+        return (node, address)
+
+    def seal(self):
+        pass
+
+    def _outbound_pb(self, node, address):
+        """Protobuf of the node's outbound, converting it together with other pending nodes.
+        The lock only guards the bookkeeping: the `xray convert pb` run happens outside it,
+        and leases of nodes in a batch being converted wait for that batch alone.
+        """
+        key = (node.get('raw') or node_key(node), address)
+        while True:
+            with self._pb_lock:
+                if key in self._pb or not self._convert:
+                    return self._pb.get(key)
+                fut = self._inflight.get(key)
+                if fut is None:
+                    self._pending.pop(key, None)
+                    todo = [(key, (node, address))]
+                    while self._pending and len(todo) < self.convert_batch:
+                        todo.append(self._pending.popitem(last=False))
+                    fut = Future()
+                    for k, _ in todo:
+                        self._inflight[k] = fut
+                    break
+            fut.result()
+        futs = [fut]
+        converted = None
+        try:
+            converted = self._convert_pb(todo)
+            if converted is None and len(todo) > 1:
+                # one outbound may spoil the batch: this node alone, the rest on their own turn
+                with self._pb_lock:
+                    for k, entry in reversed(todo[1:]):
+                        self._inflight.pop(k, None)
+                        self._pending[k] = entry
+                        self._pending.move_to_end(k, last=False)
+                    fut = self._inflight[key] = Future()
+                    futs.append(fut)
+                futs[0].set_result(None)
+                todo = todo[:1]
+                converted = self._convert_pb(todo)
+        finally:
+            with self._pb_lock:
+                if converted is None:
+                    self._convert_failures += 1
+                    if not self._converted and self._convert_failures >= 3:
+                        # conversion never worked (e.g. no `convert pb` in this xray): CLI only
+                        self._convert = False
+                        self._pending.clear()
+                    converted = {}
+                else:
+                    self._converted = True
+                for k, _ in todo:
+                    self._pb[k] = converted.get(k)
+                    self._inflight.pop(k, None)
+                result = self._pb.get(key)
+            for f in futs:
+                if not f.done():
+                    f.set_result(None)
+        return result
+
+    def _convert_pb(self, todo):
+        """{key: protobuf} for [(key, (node, address))], or None if xray refused the batch."""
+        outbounds, keys = [], {}
+        for i, (k, (n, a)) in enumerate(todo):
+            ob = build_xray_outbound(n, address=a, tag=f'out-{i}')
+            if ob is not None:
+                outbounds.append(ob)
+                keys[f'out-{i}'] = k
+        if not outbounds:
+            return {}
+        try:
+            converted = convert_outbounds_pb(outbounds, xray_path=self.xray_path)
+        except RuntimeError:
+            return None
+        return {keys[tag]: pb for tag, pb in converted.items() if tag in keys}
+
+    def _restart(self, w):
+        self.restarts += 1
+        return w.start()
+
+    def acquire(self, ticket):
+        node, address = ticket
+        outbound = build_xray_outbound(node, address=address)
+        if outbound is None:
+            return None
+        outbound_pb = self._outbound_pb(node, address)
+        w = self._idle.get()
+        if self.closed:
+            self._idle.put(w)
+            return None
+        try:
+            if w.uses >= self.recycle_after or not w.healthy():
+                if not self._restart(w):
+                    self._idle.put(w)
+                    return None
+            if not w.swap(outbound, outbound_pb):
+                # the API may be wedged: one fresh process, one more try
+                if not (self._restart(w) and w.swap(outbound, outbound_pb)):
+                    self._idle.put(w)
+                    return None
+        except Exception:
+            self._idle.put(w)
+            return None
+        return dict(w.proxies(), worker=w)
+
+    def release(self, ticket, x):
+        node, address = ticket
+        with self._pb_lock:
+            self._pb.pop((node.get('raw') or node_key(node), address), None)
+        if x:
+            self._idle.put(x['worker'])
+
+    def close(self):
+        self.closed = True
+        for w in self.workers:
+            w.stop()
+
+
+def make_xray_provider(mode='node', xray_path='xray', batch_size=50, pool_size=10, recycle_after=100):
+    if mode == 'batch':
+        return XrayBatchProvider(xray_path=xray_path, batch_size=batch_size)
+    if mode == 'pool':
+        return XrayPoolProvider(xray_path=xray_path, size=pool_size, recycle_after=recycle_after)
+    return XrayPerNode(xray_path=xray_path)
+
+
+class OncePerKey:
+    """Run a probe once per key (e.g. endpoint) and share the result with every caller;
+    concurrent callers for the same key wait for the first one instead of probing again.
+    """
+
+    def __init__(self):
+        self._futs = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, fn):
+        with self._lock:
+            fut = self._futs.get(key)
+            owner = fut is None
+            if owner:
+                fut = self._futs[key] = Future()
+        if owner:
+            try:
+                fut.set_result(fn())
+            except Exception as exc:
+                fut.set_exception(exc)
+        return fut.result()
+
+
+def _fan_out(res):
+    """Per-node copy of a probe result shared by several nodes."""
+    return dict(res) if isinstance(res, dict) else res
+
+
+def iter_windows(nodes, size=256):
+    """Yield nodes in lists of up to `size`. A list/tuple is yielded whole; any other
+    iterable (e.g. iter_nodes over a streamed download) is consumed lazily.
+    """
+    if isinstance(nodes, (list, tuple)):
+        if nodes:
+            yield list(nodes)
+        return
+    it = iter(nodes)
+    while True:
+        window = list(itertools.islice(it, max(1, size)))
+        if not window:
+            return
+        yield window
+
+
+def resolve_hosts(nodes, udp_target=None, dns_cache=None):
+    """Resolver stage run before probing: resolve each unique node host (and the UDP target) once."""
+    hosts = [n.get('add') for n in nodes if n.get('add')]
+    if udp_target:
+        hosts.append(udp_target.split(':', 1)[0])
+    try:
+        return (dns_cache or DNS_CACHE).resolve_many(hosts)
+    except Exception:
+        return {}
+
+
+def dns_metric(entry):
+    """Per-node 'dns' result: resolved IP, resolution time and whether it came from the cache."""
+    if not entry:
+        return None
+    return {'ip': entry.get('ip'), 'resolve_ms': entry.get('resolve_ms'), 'cached': entry.get('cached'), 'error': entry.get('error')}
+
+
+def test_nodes(nodes, timeout=5, workers=10, ping_count=4, tcp_retries=6, tcp_timeout=3, do_speed=False, speed_url=None, speed_duration=10, speed_concurrency=1, speed_requests=None, do_game=False, udp_target=None, game_duration=5, game_psize=60, game_interval_ms=20, expect_echo=False, start_xray=False, xray_path='xray', show_progress=True, on_node_complete=None, engine='thread', concurrency=512, stage_limits=None, tcp_batch=False, tcp_max_inflight=1024, ping_method='auto', resolve=True, dns_cache=None, xray_mode='node', xray_batch_size=50, xray_recycle_after=100, stream_window=256, group_endpoints=True, compact=False, adaptive=False, reach=True, speed_warmup=1.0, do_upload=False, upload_url=None, game_batch=0, do_latency=False, latency_url=None, latency_count=5, keep_results=True):
+    if engine == 'async':
+        return asyncio.run(async_test_nodes(nodes, timeout=timeout, workers=workers, ping_count=ping_count, tcp_retries=tcp_retries, tcp_timeout=tcp_timeout, do_speed=do_speed, speed_url=speed_url, speed_duration=speed_duration, speed_concurrency=speed_concurrency, speed_requests=speed_requests, do_game=do_game, udp_target=udp_target, game_duration=game_duration, game_psize=game_psize, game_interval_ms=game_interval_ms, expect_echo=expect_echo, start_xray=start_xray, xray_path=xray_path, show_progress=show_progress, on_node_complete=on_node_complete, concurrency=concurrency, stage_limits=stage_limits, tcp_batch=tcp_batch, tcp_max_inflight=tcp_max_inflight, ping_method=ping_method, resolve=resolve, dns_cache=dns_cache, xray_mode=xray_mode, xray_batch_size=xray_batch_size, xray_recycle_after=xray_recycle_after, stream_window=stream_window, group_endpoints=group_endpoints, compact=compact, adaptive=adaptive, reach=reach, speed_warmup=speed_warmup, do_upload=do_upload, upload_url=upload_url, game_batch=game_batch, do_latency=do_latency, latency_url=latency_url, latency_count=latency_count, keep_results=keep_results))
     results = []
 
-    def worker(node):
-        add = node.get('add')
-        port = node.get('port')
+    # per-window pre-passes fill these; nodes may be a list or a (streaming) iterator
+    dns = {}
+    tcp_batch_res = {}
+    ping_batch_res = {}
+
+    def target_of(host):
+        entry = dns.get(host)
+        return entry['ip'] if entry else host
+
+    game_batcher = None
+
+    def prepare(window):
+        nonlocal game_batcher
+        # resolver stage: every unique host is resolved once, probes then use the IP;
+        # hosts that failed to resolve are not probed at all (their node gets ping/tcp None)
+        if resolve:
+            dns.update(resolve_hosts(window, udp_target, dns_cache))
+        # game tests of concurrent workers share udp_game_batch runs
+        if game_batch and do_game and udp_target and game_batcher is None:
+            target_host, target_port = udp_target.split(':', 1)
+            game_batcher = GameBatcher(batch_size=game_batch, target_host=target_of(target_host), target_port=int(target_port), duration=game_duration, psize=game_psize, interval_ms=game_interval_ms, expect_echo=expect_echo)
+        if not reach:
+            return
+        # with tcp_batch all TCP probes run up front on one selector loop
+        if tcp_batch:
+            endpoints = [(target_of(n.get('add')), int(n.get('port'))) for n in window if target_of(n.get('add')) and n.get('port')]
+            tcp_batch_res.update(batch_tcp_test(endpoints, retries=tcp_retries, timeout=tcp_timeout, max_inflight=tcp_max_inflight, adaptive=adaptive, dns_cache=dns_cache))
+        # in-process ICMP: all hosts are pinged up front over one socket (missing -> system ping)
+        if ping_method == 'auto':
+            try:
+                ping_batch_res.update(icmp_ping_many([target_of(n.get('add')) for n in window if target_of(n.get('add'))], count=ping_count, timeout_ms=max(200, int(timeout*1000)), adaptive=adaptive) or {})
+            except Exception:
+                pass
+
+    xray = make_xray_provider(xray_mode, xray_path=xray_path, batch_size=xray_batch_size, pool_size=workers, recycle_after=xray_recycle_after) if start_xray else None
+
+    # ping once per host and TCP once per (host, port); nodes sharing an endpoint get copies
+    ping_once = OncePerKey()
+    tcp_once = OncePerKey()
+
+    # optional caps for the expensive stages on top of `workers` (--stage-limit speed=N)
+    gates = {stage: threading.BoundedSemaphore(n) for stage, n in (stage_limits or {}).items() if stage in ('speed', 'game')}
+
+    def gate(stage):
+        return gates.get(stage) or contextlib.nullcontext()
+
+    # set on Ctrl+C/SIGTERM: running nodes skip their remaining stages and their results are dropped
+    stopping = threading.Event()
+
+    def worker(node, ticket):
         node_res = {**node}
+        if resolve and reach:
+            node_res['dns'] = dns_metric(dns.get(node.get('add')))
+        add = target_of(node.get('add'))
+        port = node.get('port')
 
-        steps = ['ping', 'tcp']
+        steps = ['ping', 'tcp'] if reach else []
+        if do_latency:
+            steps.append('latency')
         if do_speed:
             steps.append('speed')
+        if do_upload:
+            steps.append('upload')
         if do_game:
             steps.append('game')
 
@@ -594,27 +3555,44 @@ def test_nodes(nodes, timeout=5, workers=10, ping_count=4, tcp_retries=6, tcp_ti
         # optionally start xray proxy for this node
         x = None
         proxy_http = None
-        if start_xray:
-            x = run_xray_for_node(node, xray_path=xray_path)
+        proxy_socks = None
+        if xray and not stopping.is_set():
+            x = xray.acquire(ticket)
             if x:
                 proxy_http = x.get('http')
+                proxy_socks = x.get('socks')
 
-        # Ping test (always do if we have a host)
-        if add:
+        # Ping test (always do if we have a host); reach=False keeps the node's own ping/tcp
+        if not reach:
+            pass
+        elif add:
             try:
-                ping_stats = ping_host(add, count=ping_count, timeout_ms=max(200, int(timeout*1000)))
-                node_res['ping'] = ping_stats
+                if add in ping_batch_res:
+                    ping_stats = ping_batch_res[add]
+                elif group_endpoints:
+                    ping_stats = ping_once.get(add, lambda: ping_host(add, count=ping_count, timeout_ms=max(200, int(timeout*1000)), method='system'))
+                else:
+                    ping_stats = ping_host(add, count=ping_count, timeout_ms=max(200, int(timeout*1000)), method='system')
+                node_res['ping'] = _fan_out(ping_stats)
             except Exception:
                 node_res['ping'] = {'sent': ping_count, 'received': 0, 'loss_percent': 100.0, 'rtts': []}
         else:
             node_res['ping'] = None
-        if pbar_local:
+        if pbar_local and reach:
             pbar_local.update(1)
 
         # TCP repeated test if port is known
-        if add and port:
+        if not reach:
+            pass
+        elif add and port:
             try:
-                tcp_stats = repeated_tcp_test(add, int(port), retries=tcp_retries, timeout=tcp_timeout)
+                if tcp_batch:
+                    tcp_stats = tcp_batch_res[(add, int(port))]
+                elif group_endpoints:
+                    tcp_stats = tcp_once.get((add, int(port)), lambda: repeated_tcp_test(add, int(port), retries=tcp_retries, timeout=tcp_timeout, adaptive=adaptive))
+                else:
+                    tcp_stats = repeated_tcp_test(add, int(port), retries=tcp_retries, timeout=tcp_timeout, adaptive=adaptive)
+                tcp_stats = _fan_out(tcp_stats)
                 node_res['tcp'] = tcp_stats
                 node_res['reachable'] = tcp_stats['successes'] > 0
             except Exception:
@@ -623,239 +3601,1720 @@ def test_nodes(nodes, timeout=5, workers=10, ping_count=4, tcp_retries=6, tcp_ti
         else:
             node_res['tcp'] = None
             node_res['reachable'] = False
-        if pbar_local:
+        if pbar_local and reach:
             pbar_local.update(1)
 
-        # Speed test
-        if do_speed:
-            try:
-                proxy = proxy_http
-                res = http_download_test(speed_url, proxy=proxy, duration=speed_duration, concurrency=speed_concurrency)
-                node_res['speed'] = res
-            except Exception:
-                node_res['speed'] = None
-            if pbar_local:
-                pbar_local.update(1)
+        # HTTP round trips through the node: does it really forward traffic?
+        if do_latency and not stopping.is_set():
+            try:
+                node_res['latency'] = http_latency_test(latency_url, proxy=proxy_http, count=latency_count, timeout=timeout)
+            except Exception:
+                node_res['latency'] = None
+            if pbar_local:
+                pbar_local.update(1)
+
+        # Speed test
+        if do_speed and not stopping.is_set():
+            try:
+                proxy = proxy_http
+                with gate('speed'):
+                    res = http_download_test(speed_url, proxy=proxy, duration=speed_duration, concurrency=speed_concurrency, adaptive=adaptive, warmup=speed_warmup)
+                node_res['speed'] = res
+            except Exception:
+                node_res['speed'] = None
+            if pbar_local:
+                pbar_local.update(1)
+
+        # Upload test (shares the 'speed' stage limit: both load the same link)
+        if do_upload and not stopping.is_set():
+            try:
+                with gate('speed'):
+                    node_res['upload'] = http_upload_test(upload_url, proxy=proxy_http, duration=speed_duration, concurrency=speed_concurrency, adaptive=adaptive, warmup=speed_warmup)
+            except Exception:
+                node_res['upload'] = None
+            if pbar_local:
+                pbar_local.update(1)
+
+        # Game UDP test
+        if do_game and udp_target and not stopping.is_set():
+            try:
+                # through the node's xray socks inbound (UDP ASSOCIATE) when it runs
+                target_host, target_port = udp_target.split(':', 1)
+                with gate('game'):
+                    if game_batcher:
+                        res = game_batcher.run(proxy_socks)
+                    else:
+                        res = udp_game_test(target_of(target_host), int(target_port), duration=game_duration, psize=game_psize, interval_ms=game_interval_ms, expect_echo=expect_echo, proxy=proxy_socks)
+                node_res['game'] = res
+            except Exception:
+                node_res['game'] = None
+            if pbar_local:
+                pbar_local.update(1)
+
+        # stop xray
+        if xray:
+            try:
+                xray.release(ticket, x)
+            except Exception:
+                pass
+        if pbar_local:
+            pbar_local.close()
+
+        if compact:
+            return NodeResult.from_result(node, node_res)
+        return node_res
+
+    # run with progress bar (if available)
+    pbar = None
+    if show_progress and tqdm:
+        pbar = tqdm(total=len(nodes) if hasattr(nodes, '__len__') else None, desc='Checking nodes')
+
+    collect_lock = threading.Lock()
+    # nodes submitted but not finished; the next node (and window) is pulled only when
+    # a slot frees up, so a streamed subscription is never queued (or xray-registered) in full
+    # (an xray batch only starts once it is full, so room for one batch is added)
+    slots = threading.Semaphore(max(1, workers) * 2 + (xray_batch_size if start_xray and xray_mode == 'batch' else 0))
+
+    def collect(f):
+        slots.release()
+        if f.cancelled():
+            return
+        try:
+            r = f.result()
+        except Exception:
+            r = None
+        with collect_lock:
+            if r is not None and not stopping.is_set():
+                if keep_results:
+                    results.append(r)
+                if on_node_complete:
+                    try:
+                        on_node_complete(r)
+                    except Exception:
+                        pass
+            if pbar:
+                pbar.update(1)
+
+    # nodes are pulled window by window, so probing starts while a streamed
+    # subscription is still being downloaded and parsed
+    ex = ThreadPoolExecutor(max_workers=workers)
+    try:
+        try:
+            for window in iter_windows(nodes, stream_window):
+                prepare(window)
+                for n in window:
+                    slots.acquire()
+                    ex.submit(worker, n, xray.register(n, target_of(n.get('add'))) if xray else None).add_done_callback(collect)
+        finally:
+            if xray:
+                xray.seal()
+        ex.shutdown(wait=True)
+    except BaseException:
+        # interrupted: queued nodes are never started and nodes already running are
+        # not reported, so a --resume checkpoint only holds complete results
+        stopping.set()
+        ex.shutdown(wait=False, cancel_futures=True)
+        raise
+    finally:
+        if xray:
+            xray.close()
+        if pbar:
+            pbar.close()
+    return results
+
+
+# ---------------------------------------------------------------------------
+# asyncio engine: ping/tcp/udp probes as coroutines, blocking tests in a pool
+# ---------------------------------------------------------------------------
+
+# default per-stage concurrency limits for the async engine (overridable via --stage-limit)
+ASYNC_STAGE_LIMITS = {'ping': 256, 'tcp': 512, 'latency': 256, 'game': 64, 'speed': 4, 'proxy': 10}
+
+
+def parse_stage_limits(items):
+    """Parse ['ping=100', 'tcp=300'] into a dict of per-stage limits."""
+    limits = {}
+    for item in items or []:
+        stage, _, value = item.partition('=')
+        stage = stage.strip().lower()
+        if stage not in ASYNC_STAGE_LIMITS:
+            raise ValueError(f"Unknown stage '{stage}' (expected one of: {', '.join(ASYNC_STAGE_LIMITS)})")
+        limits[stage] = max(1, int(value))
+    return limits
+
+
+async def async_ping_host(host, count=4, timeout_ms=1000):
+    """Coroutine version of ping_host: the system ping runs without holding a thread."""
+    cmd = _ping_cmd(host, count, timeout_ms)
+    try:
+        proc = await asyncio.create_subprocess_exec(*cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        try:
+            out, _ = await asyncio.wait_for(proc.communicate(), timeout=(count * (timeout_ms/1000.0) + 5))
+        except asyncio.TimeoutError:
+            proc.kill()
+            await proc.wait()
+            return _ping_failed(count)
+    except Exception:
+        return _ping_failed(count)
+    return parse_ping_output(out.decode('utf-8', errors='ignore'), count)
+
+
+async def async_tcp_connect_test(host, port, timeout=5):
+    start = time.perf_counter()
+    try:
+        _, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout=timeout)
+    except Exception:
+        return False, None
+    rtt = time.perf_counter() - start
+    writer.close()
+    try:
+        await writer.wait_closed()
+    except Exception:
+        pass
+    return True, rtt
+
+
+async def async_repeated_tcp_test(host, port, retries=6, timeout=3, adaptive=None):
+    settings = adaptive_settings(adaptive)
+    attempts = 0
+    successes = 0
+    streak = 0
+    rtts = []
+    for i in range(retries):
+        attempts += 1
+        ok, rtt = await async_tcp_connect_test(host, port, timeout=timeout)
+        if ok and rtt is not None:
+            successes += 1
+            streak = 0
+            rtts.append(rtt * 1000.0)
+        else:
+            streak += 1
+        if settings and probe_settled(attempts, successes, rtts, streak, settings):
+            break
+        await asyncio.sleep(0.05)
+    return tcp_stats(attempts, successes, rtts)
+
+
+async def async_udp_game_test(target_host, target_port, duration=5, psize=60, interval_ms=20, expect_echo=False, grace=1.0, proxy=None):
+    """Coroutine version of udp_game_test (same header, schedule, proxy and result dict)."""
+    loop = asyncio.get_running_loop()
+    stats = _GameStats(psize)
+    interval = max(interval_ms, 0.01) / 1000.0
+    assoc = None
+    prefix = b''
+    dest = (target_host, int(target_port))
+    if proxy:
+        try:
+            assoc = await loop.run_in_executor(None, Socks5UdpAssociation, proxy)
+        except Exception:
+            return None
+        dest = assoc.relay
+        prefix = assoc.header(target_host, target_port)
+
+    class _Proto(asyncio.DatagramProtocol):
+        def datagram_received(self, data, addr):
+            if prefix:
+                data = Socks5UdpAssociation.unwrap(data)
+                if data is None:
+                    return
+            stats.on_datagram(data)
+
+        def error_received(self, exc):
+            pass
+
+    try:
+        transport, _ = await loop.create_datagram_endpoint(_Proto, remote_addr=dest)
+    except Exception:
+        if assoc:
+            assoc.close()
+        raise
+    try:
+        start = time.perf_counter()
+        end = start + duration
+        next_send = start
+        while True:
+            now = time.perf_counter()
+            if now >= end:
+                # wall time of the send phase (see udp_game_batch)
+                elapsed = now - start
+                break
+            if now - next_send > max(_GAME_MAX_LAG[0] * interval, _GAME_MAX_LAG[1]):
+                next_send = now
+            while next_send <= now and next_send < end:
+                try:
+                    transport.sendto(prefix + stats.packet())
+                except Exception:
+                    stats.send_errors += 1
+                next_send += interval
+            await asyncio.sleep(max(0.0, min(next_send, end) - time.perf_counter()))
+        if expect_echo:
+            # grace period for in-flight echoes
+            while not stats.all_received() and time.perf_counter() < end + grace:
+                await asyncio.sleep(0.01)
+    finally:
+        transport.close()
+        if assoc:
+            assoc.close()
+    res = stats.result(elapsed, interval_ms, expect_echo)
+    res['via'] = 'proxy' if prefix else 'direct'
+    return res
+
+
+async def _async_open_http_conn(url, proxy=None, timeout=10):
+    """Coroutine version of _open_http_conn. Returns (reader, writer, request target)."""
+    u = urlparse(url)
+    https = u.scheme == 'https'
+    host, port = u.hostname, u.port or (443 if https else 80)
+    target = (u.path or '/') + (f'?{u.query}' if u.query else '')
+    px = _parse_proxy(proxy)
+    reader, writer = await asyncio.wait_for(asyncio.open_connection(*((px[1], px[2]) if px else (host, port))), timeout)
+    try:
+        if px and px[0] == 'socks5':
+            writer.write(b'\x05\x01\x00')
+            if await reader.readexactly(2) != b'\x05\x00':
+                raise ConnectionError('socks5: no acceptable auth method')
+            writer.write(b'\x05\x01\x00' + _socks5_addr(host) + struct.pack('!H', port))
+            rep = await reader.readexactly(4)
+            if rep[1] != 0:
+                raise ConnectionError(f'socks5: connect failed (code {rep[1]})')
+            skip = {1: 4, 4: 16}.get(rep[3])
+            if skip is None:
+                skip = (await reader.readexactly(1))[0]
+            await reader.readexactly(skip + 2)
+        elif px and https:
+            writer.write(f'CONNECT {host}:{port} HTTP/1.1\r\nHost: {host}:{port}\r\n\r\n'.encode())
+            status, _ = _parse_http_head((await reader.readuntil(b'\r\n\r\n'))[:-4])
+            if status != 200:
+                raise ConnectionError(f'proxy CONNECT failed ({status})')
+        elif px:
+            target = url
+        if https:
+            await writer.start_tls(ssl.create_default_context(), server_hostname=host)
+    except Exception:
+        writer.close()
+        raise
+    return reader, writer, target
+
+
+async def async_http_latency_test(url, proxy=None, count=5, timeout=5):
+    """Coroutine version of http_latency_test (same result dict); many nodes' probes
+    run interleaved on one event loop.
+    """
+    host = urlparse(url).netloc
+    rtts = []
+    errors = 0
+    reconnects = 0
+    status_codes = {}
+    connect_ms = ttfb_ms = None
+    conn = None
+    done = 0
+    start = time.perf_counter()
+    try:
+        for i in range(max(1, count)):
+            try:
+                if conn is None:
+                    if i:
+                        reconnects += 1
+                    conn = await _async_open_http_conn(url, proxy, timeout=timeout)
+                    if connect_ms is None:
+                        connect_ms = (time.perf_counter() - start) * 1000.0
+                reader, writer, target = conn
+                sent_at = time.perf_counter()
+                writer.write(f'GET {target} HTTP/1.1\r\nHost: {host}\r\nUser-Agent: sub-checker\r\n\r\n'.encode())
+                head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), timeout)
+                now = time.perf_counter()
+                status, headers = _parse_http_head(head[:-4])
+                done += 1
+                status_codes[status] = status_codes.get(status, 0) + 1
+                if ttfb_ms is None:
+                    ttfb_ms = (now - start) * 1000.0
+                else:
+                    rtts.append((now - sent_at) * 1000.0)
+                left = _response_body_left(status, headers, b'')
+                if left:
+                    await asyncio.wait_for(reader.readexactly(left), timeout)
+                if left is None or not _keeps_alive(headers):
+                    writer.close()
+                    conn = None
+            except Exception:
+                errors += 1
+                if conn is not None:
+                    conn[1].close()
+                    conn = None
+                if ttfb_ms is None:
+                    # the first request failed: the node does not forward traffic
+                    break
+    finally:
+        if conn is not None:
+            conn[1].close()
+    return _latency_result(url, 'proxy' if proxy else 'direct', connect_ms, ttfb_ms, rtts, done, errors, reconnects, status_codes)
+
+
+async def async_test_nodes(nodes, timeout=5, workers=10, ping_count=4, tcp_retries=6, tcp_timeout=3, do_speed=False, speed_url=None, speed_duration=10, speed_concurrency=1, speed_requests=None, do_game=False, udp_target=None, game_duration=5, game_psize=60, game_interval_ms=20, expect_echo=False, start_xray=False, xray_path='xray', show_progress=True, on_node_complete=None, concurrency=512, stage_limits=None, tcp_batch=False, tcp_max_inflight=1024, ping_method='auto', resolve=True, dns_cache=None, xray_mode='node', xray_batch_size=50, xray_recycle_after=100, stream_window=256, group_endpoints=True, compact=False, adaptive=False, reach=True, speed_warmup=1.0, do_upload=False, upload_url=None, game_batch=0, do_latency=False, latency_url=None, latency_count=5, keep_results=True):
+    """asyncio counterpart of test_nodes: same arguments and per-node result dicts.
+
+    Nodes are scheduled as soon as their window is pulled from `nodes`; `concurrency` bounds how many are in flight and
+    `stage_limits` (see ASYNC_STAGE_LIMITS) bounds each stage separately. Ping, TCP and
+    UDP probes are coroutines; xray and the HTTP speed test are blocking and run in a
+    thread pool sized by the 'proxy'/'speed' limits. Ping and TCP for a node run concurrently.
+    `game_batch` is ignored: game tests already share the event loop.
+    """
+    loop = asyncio.get_running_loop()
+    limits = dict(ASYNC_STAGE_LIMITS)
+    limits['proxy'] = max(1, workers)
+    limits.update(stage_limits or {})
+    node_sem = asyncio.Semaphore(max(1, concurrency))
+    sems = {k: asyncio.Semaphore(v) for k, v in limits.items()}
+    blocking_pool = ThreadPoolExecutor(max_workers=max(limits['proxy'], limits['speed']))
+    results = []
+
+    pbar = None
+    if show_progress and tqdm:
+        pbar = tqdm(total=len(nodes) if hasattr(nodes, '__len__') else None, desc='Checking nodes')
+
+    # per-window pre-passes fill these; nodes may be a list or a (streaming) iterator
+    dns = {}
+    ping_futs = {}  # target host -> future of the window's icmp_ping_many
+    tcp_futs = {}  # (target host, port) -> future of the window's batch_tcp_test
+
+    def target_of(host):
+        entry = dns.get(host)
+        return entry['ip'] if entry else host
+
+    async def prepare(window):
+        if resolve:
+            dns.update(await loop.run_in_executor(None, lambda: resolve_hosts(window, udp_target, dns_cache)))
+        if not reach:
+            return
+        if ping_method == 'auto':
+            hosts = [target_of(n.get('add')) for n in window if target_of(n.get('add'))]
+            fut = loop.run_in_executor(None, lambda: icmp_ping_many(hosts, count=ping_count, timeout_ms=max(200, int(timeout*1000)), adaptive=adaptive))
+            ping_futs.update((h, fut) for h in hosts)
+        if tcp_batch:
+            endpoints = [(target_of(n.get('add')), int(n.get('port'))) for n in window if target_of(n.get('add')) and n.get('port')]
+            fut = loop.run_in_executor(None, lambda: batch_tcp_test(endpoints, retries=tcp_retries, timeout=tcp_timeout, max_inflight=tcp_max_inflight, adaptive=adaptive, dns_cache=dns_cache))
+            tcp_futs.update((ep, fut) for ep in endpoints)
+
+    async def ping_probe(add):
+        fut = ping_futs.get(add)
+        if fut is not None:
+            try:
+                batch = await fut
+            except Exception:
+                batch = None
+            if batch is not None and add in batch:
+                return batch[add]
+        async with sems['ping']:
+            try:
+                return await async_ping_host(add, count=ping_count, timeout_ms=max(200, int(timeout*1000)))
+            except Exception:
+                return {'sent': ping_count, 'received': 0, 'loss_percent': 100.0, 'rtts': []}
+
+    async def tcp_probe(add, port):
+        fut = tcp_futs.get((add, int(port)))
+        if fut is not None:
+            try:
+                return (await fut)[(add, int(port))]
+            except Exception:
+                return None
+        async with sems['tcp']:
+            try:
+                return await async_repeated_tcp_test(add, int(port), retries=tcp_retries, timeout=tcp_timeout, adaptive=adaptive)
+            except Exception:
+                return None
+
+    # ping once per host and TCP once per (host, port); nodes sharing an endpoint get copies
+    endpoint_tasks = {}
+
+    async def once(key, make):
+        if not group_endpoints:
+            return await make()
+        task = endpoint_tasks.get(key)
+        if task is None:
+            task = endpoint_tasks[key] = asyncio.ensure_future(make())
+        return _fan_out(await task)
+
+    async def ping_stage(add):
+        return await once(('ping', add), lambda: ping_probe(add))
+
+    async def tcp_stage(add, port):
+        return await once(('tcp', add, int(port)), lambda: tcp_probe(add, port))
+
+    xray = make_xray_provider(xray_mode, xray_path=xray_path, batch_size=xray_batch_size, pool_size=limits['proxy'], recycle_after=xray_recycle_after) if start_xray else None
+
+    async def heavy_stages(node, node_res, ticket):
+        x = None
+        proxy_http = None
+        proxy_socks = None
+        if xray:
+            acquiring = blocking_pool.submit(xray.acquire, ticket)
+            try:
+                x = await asyncio.wrap_future(acquiring)
+            except asyncio.CancelledError:
+                # the acquire goes on in its thread: hand back whatever it returns
+                acquiring.add_done_callback(lambda f: f.cancelled() or f.exception() or xray.release(ticket, f.result()))
+                raise
+            if x:
+                proxy_http = x.get('http')
+                proxy_socks = x.get('socks')
+        cancelled = False
+        try:
+            if do_latency:
+                async with sems['latency']:
+                    try:
+                        node_res['latency'] = await async_http_latency_test(latency_url, proxy=proxy_http, count=latency_count, timeout=timeout)
+                    except Exception:
+                        node_res['latency'] = None
+            if do_speed:
+                async with sems['speed']:
+                    try:
+                        node_res['speed'] = await loop.run_in_executor(blocking_pool, lambda: http_download_test(speed_url, proxy=proxy_http, duration=speed_duration, concurrency=speed_concurrency, adaptive=adaptive, warmup=speed_warmup))
+                    except Exception:
+                        node_res['speed'] = None
+            if do_upload:
+                async with sems['speed']:
+                    try:
+                        node_res['upload'] = await loop.run_in_executor(blocking_pool, lambda: http_upload_test(upload_url, proxy=proxy_http, duration=speed_duration, concurrency=speed_concurrency, adaptive=adaptive, warmup=speed_warmup))
+                    except Exception:
+                        node_res['upload'] = None
+            if do_game and udp_target:
+                async with sems['game']:
+                    try:
+                        target_host, target_port = udp_target.split(':', 1)
+                        node_res['game'] = await async_udp_game_test(target_of(target_host), int(target_port), duration=game_duration, psize=game_psize, interval_ms=game_interval_ms, expect_echo=expect_echo, proxy=proxy_socks)
+                    except Exception:
+                        node_res['game'] = None
+        except asyncio.CancelledError:
+            cancelled = True
+            raise
+        finally:
+            if xray:
+                if cancelled:
+                    # shutting down: release inline rather than queue behind running tests
+                    xray.release(ticket, x)
+                else:
+                    await loop.run_in_executor(blocking_pool, xray.release, ticket, x)
+
+    async def run_node(node, ticket):
+        async with node_sem:
+            node_res = {**node}
+            if resolve and reach:
+                node_res['dns'] = dns_metric(dns.get(node.get('add')))
+            add = target_of(node.get('add'))
+            port = node.get('port')
+            if reach:
+                probes = [ping_stage(add) if add else None, tcp_stage(add, port) if add and port else None]
+                done = await asyncio.gather(*[p for p in probes if p is not None])
+                node_res['ping'] = done.pop(0) if probes[0] is not None else None
+                node_res['tcp'] = done.pop(0) if probes[1] is not None else None
+                node_res['reachable'] = bool(node_res['tcp'] and node_res['tcp']['successes'] > 0)
+            if do_latency or do_speed or do_upload or (do_game and udp_target):
+                if start_xray:
+                    async with sems['proxy']:
+                        await heavy_stages(node, node_res, ticket)
+                else:
+                    await heavy_stages(node, node_res, ticket)
+            if compact:
+                return NodeResult.from_result(node, node_res)
+            return node_res
+
+    def collect(task):
+        tasks.discard(task)
+        if task.cancelled():
+            return
+        try:
+            r = task.result()
+        except Exception:
+            r = None
+        if r is not None:
+            if keep_results:
+                results.append(r)
+            if on_node_complete:
+                try:
+                    on_node_complete(r)
+                except Exception:
+                    pass
+        if pbar:
+            pbar.update(1)
+
+    tasks = set()
+    windows = iter_windows(nodes, stream_window)
+    backlog = max(concurrency, stream_window) + (xray_batch_size if start_xray and xray_mode == 'batch' else 0)
+    try:
+        try:
+            while True:
+                # the iterator may block on a streamed download: pull it off the loop
+                window = await loop.run_in_executor(None, next, windows, None)
+                if window is None:
+                    break
+                await prepare(window)
+                for n in window:
+                    task = asyncio.ensure_future(run_node(n, xray.register(n, target_of(n.get('add'))) if xray else None))
+                    task.add_done_callback(collect)
+                    tasks.add(task)
+                # pull the next window only once the backlog is down to one window
+                while len(tasks) > backlog:
+                    await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            if xray:
+                xray.seal()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    except BaseException:
+        # interrupted: cancel the nodes in flight (their results are dropped) and let
+        # them release their xray proxies before the provider is closed
+        pending = list(tasks)
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        raise
+    finally:
+        if xray:
+            xray.close()
+        blocking_pool.shutdown(wait=False, cancel_futures=True)
+        if pbar:
+            pbar.close()
+    return results
+
+
+# ---------------------------------------------------------------------------
+# funnel scheduling: cheap reachability pass first, heavy tests for survivors
+# ---------------------------------------------------------------------------
+
+def funnel_rank_key(r):
+    """Sort key for survivors of the reachability pass: TCP p95, then avg, then ping."""
+    tcp = r.get('tcp') or {}
+    ping = r.get('ping') or {}
+    for v in (tcp.get('p95'), tcp.get('avg'), ping.get('avg')):
+        if v is not None:
+            return v
+    return float('inf')
+
+
+def funnel_test_nodes(nodes, on_node_complete=None, top_k=None, reach_workers=128, **kwargs):
+    """test_nodes in two phases so that dead nodes cost one cheap probe round.
+
+    Phase 1 runs only DNS/ping/TCP for every node with `reach_workers` threads (the
+    async engine keeps its `concurrency`). Phase 2 runs latency, speed, upload, game and xray with the
+    regular `workers`/`stage_limits` on the reachable nodes, optionally only on the
+    `top_k` fastest by TCP p95. Every result carries 'funnel': 'full' (both phases),
+    'unreachable' or 'cut' (outside top-K); the latter two are reported as soon as
+    they are known. Accepts the same keyword arguments as test_nodes.
+    """
+    heavy = kwargs.get('do_latency') or kwargs.get('do_speed') or kwargs.get('do_upload') or (kwargs.get('do_game') and kwargs.get('udp_target'))
+    compact = kwargs.get('compact')
+    keep = kwargs.get('keep_results', True)
+    results = []
+    lock = threading.Lock()
+
+    def done(r):
+        if keep:
+            with lock:
+                results.append(r)
+        if on_node_complete:
+            try:
+                on_node_complete(r)
+            except Exception:
+                pass
+
+    def finish(node, r, mode):
+        r['funnel'] = mode
+        done(NodeResult.from_result(node, r) if compact else r)
+
+    # phase 1: reachability only, wide
+    originals = {}
+    survivors = []
+
+    def on_reach(r):
+        key = node_key(r)
+        if r.get('reachable') and heavy:
+            with lock:
+                survivors.append(r)
+        else:
+            finish(originals.get(key, r), r, 'full' if r.get('reachable') else 'unreachable')
+
+    def remember(it):
+        for n in it:
+            originals[node_key(n)] = n
+            yield n
+
+    reach_kwargs = dict(kwargs, do_latency=False, do_speed=False, do_upload=False, do_game=False, start_xray=False, compact=False, keep_results=False)
+    if kwargs.get('engine') != 'async':
+        reach_kwargs['workers'] = max(reach_workers, kwargs.get('workers', 10))
+    test_nodes(remember(nodes) if compact else nodes, on_node_complete=on_reach, **reach_kwargs)
+    if not survivors:
+        return results
+
+    # phase 2: heavy stages on survivors (fastest first), reusing their phase-1 ping/tcp
+    survivors.sort(key=funnel_rank_key)
+    if top_k and top_k > 0:
+        for r in survivors[top_k:]:
+            finish(originals.get(node_key(r), r), r, 'cut')
+        survivors = survivors[:top_k]
+
+    def on_heavy(r):
+        finish(originals.get(node_key(r), r), r, 'full')
+
+    test_nodes(survivors, on_node_complete=on_heavy, **dict(kwargs, reach=False, compact=False, keep_results=False))
+    return results
+
+
+# ---------------------------------------------------------------------------
+# result history (SQLite) and incremental re-check scheduling
+# ---------------------------------------------------------------------------
+
+class HistoryStore:
+    """SQLite store of probe results keyed by node_key (canonical node identity).
+
+    `nodes` keeps one row per node with its health state (last OK, consecutive
+    failures, next due re-check); `results` keeps every recorded result with a
+    timestamp. Safe to use from several threads.
+    """
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS nodes (
+        key TEXT PRIMARY KEY,
+        protocol TEXT, host TEXT, port INTEGER, ps TEXT,
+        first_seen REAL, last_tested REAL, last_full REAL, last_ok REAL,
+        consecutive_failures INTEGER DEFAULT 0,
+        next_check REAL
+    );
+    CREATE TABLE IF NOT EXISTS results (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        key TEXT NOT NULL, ts REAL NOT NULL, mode TEXT,
+        reachable INTEGER, tcp_p95 REAL, tcp_loss REAL, ping_loss REAL, speed_avg_bps REAL,
+        result TEXT
+    );
+    CREATE INDEX IF NOT EXISTS results_key_ts ON results (key, ts);
+    """
+
+    def __init__(self, path, backoff_base=900, backoff_max=86400):
+        import sqlite3
+        self.path = path
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.executescript(self.SCHEMA)
+
+    def record(self, result, mode='full', ts=None):
+        """Store one test result and update the node's health state."""
+        r = as_result_dict(result)
+        key = node_key(r)
+        ts = ts or time.time()
+        tcp = r.get('tcp') or {}
+        ping = r.get('ping') or {}
+        speed = r.get('speed') or {}
+        ok = bool(r.get('reachable'))
+        with self._lock:
+            row = self._db.execute('SELECT consecutive_failures, first_seen FROM nodes WHERE key = ?', (key,)).fetchone()
+            failures = 0 if ok else ((row[0] if row else 0) + 1)
+            if ok:
+                next_check = None
+            else:
+                # exponential back-off for nodes that keep failing
+                next_check = ts + min(self.backoff_max, self.backoff_base * (2 ** (failures - 1)))
+            self._db.execute(
+                'INSERT INTO nodes (key, protocol, host, port, ps, first_seen, last_tested, last_full, last_ok, consecutive_failures, next_check) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?) '
+                'ON CONFLICT(key) DO UPDATE SET protocol=excluded.protocol, host=excluded.host, port=excluded.port, ps=excluded.ps, '
+                'last_tested=excluded.last_tested, last_full=COALESCE(excluded.last_full, nodes.last_full), '
+                'last_ok=COALESCE(excluded.last_ok, nodes.last_ok), consecutive_failures=excluded.consecutive_failures, next_check=excluded.next_check',
+                (key, r.get('protocol'), r.get('add'), r.get('port'), r.get('ps'), row[1] if row else ts, ts,
+                 ts if mode == 'full' else None, ts if ok else None, failures, next_check))
+            self._db.execute(
+                'INSERT INTO results (key, ts, mode, reachable, tcp_p95, tcp_loss, ping_loss, speed_avg_bps, result) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (key, ts, mode, int(ok), tcp.get('p95'), tcp.get('loss_percent'), ping.get('loss_percent'), speed.get('avg_bps'),
+                 json.dumps(r, ensure_ascii=False)))
+            self._db.commit()
+
+    def state(self, key):
+        """Health state of a node as a dict, or None if it was never tested."""
+        with self._lock:
+            cur = self._db.execute('SELECT last_tested, last_full, last_ok, consecutive_failures, next_check FROM nodes WHERE key = ?', (key,))
+            row = cur.fetchone()
+        if not row:
+            return None
+        return dict(zip(('last_tested', 'last_full', 'last_ok', 'consecutive_failures', 'next_check'), row))
+
+    def last_result(self, key, mode=None):
+        """Most recent stored result dict for a node (optionally of a given mode)."""
+        q = 'SELECT result FROM results WHERE key = ?' + (' AND mode = ?' if mode else '') + ' ORDER BY ts DESC LIMIT 1'
+        with self._lock:
+            row = self._db.execute(q, (key, mode) if mode else (key,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+def plan_incremental(nodes, store, now=None, healthy_window=3600, full_interval=21600):
+    """Split nodes by history into 'skip', 'light' and 'full' lists.
+
+    - never tested, or last full test older than `full_interval` -> full
+    - reachable and last OK within `healthy_window` -> light (1 TCP probe, 1 ping)
+    - failing and not yet due (back-off) -> skip (previous result is reused)
+    - failing and due -> light; escalated to full if it turns out alive
+    """
+    now = now or time.time()
+    plan = {'skip': [], 'light': [], 'full': []}
+    for node in nodes:
+        st = store.state(node_key(node))
+        if st is None or not st['last_full'] or now - st['last_full'] > full_interval:
+            plan['full'].append(node)
+        elif st['consecutive_failures']:
+            if st['next_check'] and now < st['next_check']:
+                plan['skip'].append(node)
+            else:
+                plan['light'].append(node)
+        elif st['last_ok'] and now - st['last_ok'] <= healthy_window:
+            plan['light'].append(node)
+        else:
+            plan['full'].append(node)
+    return plan
+
+
+def incremental_test_nodes(nodes, store, on_node_complete=None, policy=None, runner=None, **kwargs):
+    """test_nodes driven by the history store: re-test cost follows what changed.
+
+    Skipped nodes reuse their last stored result (marked 'incremental': 'skip'),
+    light nodes get a single ping/TCP probe and keep their previous latency/speed/upload/game
+    results, and full nodes (plus light ones that came back alive after failing,
+    or failed after being healthy) get the complete test. Every tested node is
+    recorded in the store. Full tests go through `runner` (default test_nodes, e.g.
+    a funnel_test_nodes partial). Accepts the same keyword arguments as test_nodes.
+    """
+    policy = dict(policy or {})
+    store.backoff_base = policy.pop('backoff_base', store.backoff_base)
+    store.backoff_max = policy.pop('backoff_max', store.backoff_max)
+    nodes = list(nodes)
+    plan = plan_incremental(nodes, store, **policy)
+    compact = kwargs.get('compact')
+    keep = kwargs.get('keep_results', True)
+    results = []
+    lock = threading.Lock()
+
+    def done(r, mode):
+        store.record(r, mode=mode)
+        if keep:
+            with lock:
+                results.append(r)
+        if on_node_complete:
+            try:
+                on_node_complete(r)
+            except Exception:
+                pass
+
+    for node in plan['skip']:
+        prev = store.last_result(node_key(node))
+        r = dict(prev or {**node, 'reachable': False}, incremental='skip')
+        if keep:
+            with lock:
+                results.append(r)
+        if on_node_complete:
+            try:
+                on_node_complete(r)
+            except Exception:
+                pass
+
+    escalate = []
+    if plan['light']:
+        light_kwargs = dict(kwargs, tcp_retries=1, ping_count=1, do_latency=False, do_speed=False, do_upload=False, do_game=False, start_xray=False, compact=False, keep_results=False)
+        light_nodes = {node_key(n): n for n in plan['light']}
+        states = {k: store.state(k) for k in light_nodes}
+
+        def on_light(r):
+            key = node_key(r)
+            was_failing = bool((states.get(key) or {}).get('consecutive_failures'))
+            if bool(r.get('reachable')) == was_failing:
+                # state changed (dead -> alive or alive -> dead): confirm with a full test
+                escalate.append(light_nodes[key])
+                return
+            prev = store.last_result(key, mode='full') or {}
+            for stage in ('latency', 'speed', 'upload', 'game'):
+                if stage in prev:
+                    r.setdefault(stage, prev[stage])
+            r['incremental'] = 'light'
+            done(NodeResult.from_result(light_nodes[key], r) if compact else r, 'light')
+
+        test_nodes(plan['light'], on_node_complete=on_light, **light_kwargs)
+
+    full = plan['full'] + escalate
+    if full:
+        (runner or test_nodes)(full, on_node_complete=lambda r: done(r, 'full'), **dict(kwargs, keep_results=False))
+    return results
+
+
+# ---------------------------------------------------------------------------
+# streaming result output: one JSON line per node, written as results arrive
+# ---------------------------------------------------------------------------
+
+class NdjsonWriter:
+    """Append-only JSON Lines sink usable as on_node_complete: one line per result.
+
+    Lines are buffered until `buffer_records` lines or `buffer_bytes` bytes have
+    accumulated, then written out; a timer flushes a buffer that is older than
+    `max_delay` seconds, so a slow sweep does not hold results back.
+    fsync: 'always' (every record), 'batch' (every buffer flush) or 'never' (leave
+    it to the OS). A crash loses at most one buffer. Thread-safe.
+    """
+
+    def __init__(self, path, buffer_records=64, buffer_bytes=1 << 20, max_delay=1.0, fsync='batch', append=False):
+        if fsync not in ('always', 'batch', 'never'):
+            raise ValueError(f'fsync must be always, batch or never, not {fsync!r}')
+        self.path = path
+        self.buffer_records = max(1, buffer_records)
+        self.buffer_bytes = buffer_bytes
+        self.max_delay = max_delay
+        self.fsync = fsync
+        self.count = 0
+        self._fh = open(path, 'a' if append else 'w', encoding='utf-8')
+        self._buf = []
+        self._size = 0
+        self._since = 0.0
+        self._timer = None
+        self._lock = threading.Lock()
+
+    def __call__(self, result):
+        self.write(result)
+
+    def write(self, result):
+        line = json.dumps(as_result_dict(result), ensure_ascii=False, separators=(',', ':'), default=str) + '\n'
+        with self._lock:
+            if not self._buf:
+                self._since = time.monotonic()
+                if self.max_delay and self.max_delay > 0 and self._timer is None:
+                    self._timer = threading.Timer(self.max_delay, self._on_timer)
+                    self._timer.daemon = True
+                    self._timer.start()
+            self._buf.append(line)
+            self._size += len(line)
+            self.count += 1
+            if (self.fsync == 'always' or len(self._buf) >= self.buffer_records or self._size >= self.buffer_bytes
+                    or time.monotonic() - self._since >= self.max_delay):
+                self._flush()
+
+    def _on_timer(self):
+        with self._lock:
+            self._timer = None
+            if self._fh.closed or not self._buf:
+                return
+            wait = self.max_delay - (time.monotonic() - self._since)
+            if wait > 0:
+                # the buffer was flushed and refilled since this timer was armed
+                self._timer = threading.Timer(wait, self._on_timer)
+                self._timer.daemon = True
+                self._timer.start()
+                return
+            try:
+                self._flush()
+            except (OSError, ValueError):
+                pass
+
+    def _flush(self):
+        if self._buf:
+            self._fh.write(''.join(self._buf))
+            self._buf.clear()
+            self._size = 0
+        self._fh.flush()
+        if self.fsync != 'never':
+            os.fsync(self._fh.fileno())
+
+    def flush(self):
+        with self._lock:
+            if not self._fh.closed:
+                self._flush()
+
+    def close(self):
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            if not self._fh.closed:
+                self._flush()
+                self._fh.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def iter_ndjson(path):
+    """Result dicts from an NDJSON file; a torn last line (crash mid-write) is skipped."""
+    with open(path, 'r', encoding='utf-8') as fh:
+        for line in fh:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line)
+            except ValueError:
+                continue
+
+
+class NdjsonResults:
+    """Re-iterable view of an NDJSON result file: every pass re-reads the file, so the
+    report writers run in flat memory however many nodes were tested.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def __iter__(self):
+        return iter_ndjson(self.path)
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+
+def load_checkpoint(path):
+    """node_keys of the results already in a --resume checkpoint (an NDJSON result file).
+    A torn last line left by a crash is cut off, so appended results start on a fresh line.
+    """
+    done = set()
+    if not os.path.exists(path):
+        return done
+    good = 0
+    with open(path, 'rb+') as fh:
+        for line in fh:
+            if not line.endswith(b'\n'):
+                break
+            good += len(line)
+            try:
+                done.add(node_key(json.loads(line)))
+            except ValueError:
+                continue
+        fh.truncate(good)
+    return done
+
+
+def skip_done(nodes, done):
+    """Nodes whose node_key is not in `done` (lists stay lists, streams stay lazy)."""
+    if isinstance(nodes, list):
+        return [n for n in nodes if node_key(n) not in done]
+    return (n for n in nodes if node_key(n) not in done)
+
+
+def result_summary(n):
+    """The flat per-node record written to --output without --detailed."""
+    tcp = n.get('tcp') or {}
+    ping = n.get('ping') or {}
+    speed = n.get('speed') or {}
+    game = n.get('game') or {}
+    return {
+        'ps': n.get('ps'),
+        'add': n.get('add'),
+        'port': n.get('port'),
+        'reachable': n.get('reachable'),
+        'tcp_successes': tcp.get('successes'),
+        'tcp_attempts': tcp.get('attempts'),
+        'tcp_loss_percent': tcp.get('loss_percent'),
+        'tcp_p95_ms': tcp.get('p95'),
+        'ping_loss_percent': ping.get('loss_percent'),
+        'avg_speed_bps': speed.get('avg_bps'),
+        'avg_upload_bps': (n.get('upload') or {}).get('avg_bps'),
+        'latency_ttfb_ms': (n.get('latency') or {}).get('ttfb_ms'),
+        'latency_rtt_ms': (n.get('latency') or {}).get('p50'),
+        'pps': game.get('pps'),
+        'game_loss_percent': game.get('loss_percent'),
+        'game_jitter_ms': game.get('jitter_ms'),
+    }
+
+
+def write_results_json(path, tested, report_path=None, detailed=False, top=None):
+    """Write the --output JSON document node by node (full results with `detailed`,
+    result_summary records otherwise) instead of building it as one string. `top`
+    ({group: [records]}) is written as the 'top' section.
+    """
+    with open(path, 'w', encoding='utf-8') as fo:
+        meta = {'generated_at': datetime.utcnow().isoformat(), 'report': report_path}
+        if top is not None:
+            meta['top'] = top
+        head = json.dumps(meta, ensure_ascii=False, default=str)
+        fo.write(head[:-1] + ', "nodes": [')
+        for i, n in enumerate(tested):
+            rec = as_result_dict(n) if detailed else result_summary(n)
+            fo.write(('\n  ' if i == 0 else ',\n  ') + json.dumps(rec, ensure_ascii=False, default=str))
+        fo.write('\n]}\n')
+
+
+# HTML report: the page is static; the results are embedded once as a JSON dataset
+# (rows in _report_row order) and rendered client-side, so the DOM holds only the
+# rows on screen and charts exist only for those rows and the selected node.
+_REPORT_HTML = """<!doctype html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>VPN Check Report</title>
+<style>
+body{font:13px sans-serif;margin:16px}
+#bar{margin:8px 0}
+#q{width:260px}
+#view{height:70vh;overflow-y:auto;position:relative;border:1px solid #ddd}
+#head,.row{display:grid;grid-template-columns:var(--cols);align-items:center;height:26px}
+#head{position:sticky;top:0;z-index:1;background:#f4f4f4;font-weight:bold;cursor:pointer;user-select:none;border-bottom:1px solid #ccc}
+#head div,.row div{padding:0 6px;overflow:hidden;white-space:nowrap;text-overflow:ellipsis}
+.row{position:absolute;left:0;right:0;border-bottom:1px solid #eee;cursor:pointer}
+.row:hover{background:#f5f8ff}
+.row.sel{background:#e3ecff}
+.row.down{color:#b00}
+#detail canvas{border:1px solid #eee;margin:4px 8px 4px 0}
+</style>
+</head>
+<body>
+<h2>VPN Check Report</h2>
+<div id="bar"><input type="text" id="q" placeholder="filter by name or host"> <label><input type="checkbox" id="okonly"> reachable only</label> <span id="count"></span></div>
+<div id="view"><div id="head"></div><div id="spacer"></div></div>
+<div id="detail"></div>
+<script id="data" type="application/json">%%DATA%%</script>
+<script>
+"use strict";
+const D = JSON.parse(document.getElementById('data').textContent);
+// [title, decimals (null = text), grid width]; indices match the dataset rows, the last column is the ping sparkline
+const COLS = [['#', 0, '50px'], ['Name', null, 'minmax(120px,2fr)'], ['Host', null, 'minmax(100px,1fr)'], ['Port', 0, '60px'],
+  ['State', null, '60px'], ['Loss%', 1, '64px'], ['p95 ms', 1, '70px'], ['PingLoss%', 1, '84px'], ['HTTP RTT ms', 1, '96px'],
+  ['Speed MB/s', 2, '90px'], ['Upload MB/s', 2, '96px'], ['PPS', 1, '64px'], ['Ping RTT', null, '112px']];
+const SERIES = [['ping', 'Ping RTT (ms)'], ['lat', 'HTTP RTT (ms)'], ['down', 'Download MB/s'], ['up', 'Upload MB/s']];
+const RH = 26, OVERSCAN = 10;
+const view = document.getElementById('view'), spacer = document.getElementById('spacer');
+let rows = D.rows, sortCol = -1, sortDir = 1, selected = -1, pending = false;
+const drawn = new Map();
+
+document.documentElement.style.setProperty('--cols', COLS.map(c => c[2]).join(' '));
+
+function fmt(v, c) {
+  if (v === null || v === undefined || v === '') return '';
+  if (c === 4) return v ? 'OK' : 'DOWN';
+  return COLS[c][1] === null || typeof v !== 'number' ? String(v) : v.toFixed(COLS[c][1]);
+}
+
+// minimal canvas line plotter: a sparkline, or a framed chart with title and min/max labels
+function plot(cv, values, title) {
+  const g = cv.getContext('2d'), w = cv.width, h = cv.height;
+  const L = title ? 44 : 1, T = title ? 16 : 2, R = 4, B = title ? 6 : 2;
+  let lo = Math.min(0, ...values), hi = Math.max(...values);
+  if (hi === lo) hi = lo + 1;
+  const x = i => L + (values.length > 1 ? i * (w - L - R) / (values.length - 1) : (w - L - R) / 2);
+  const y = v => T + (hi - v) * (h - T - B) / (hi - lo);
+  g.clearRect(0, 0, w, h);
+  if (title) {
+    g.fillStyle = '#555';
+    g.font = '11px sans-serif';
+    g.fillText(title, L, 11);
+    g.fillText(String(+hi.toFixed(2)), 2, T + 8);
+    g.fillText(String(+lo.toFixed(2)), 2, h - B);
+    g.strokeStyle = '#ddd';
+    g.strokeRect(L, T, w - L - R, h - T - B);
+  }
+  g.strokeStyle = g.fillStyle = '#2a7fd4';
+  g.lineWidth = 1.5;
+  g.beginPath();
+  values.forEach((v, i) => i ? g.lineTo(x(i), y(v)) : g.moveTo(x(i), y(v)));
+  g.stroke();
+  if (values.length === 1) {
+    g.beginPath();
+    g.arc(x(0), y(values[0]), 2.5, 0, 2 * Math.PI);
+    g.fill();
+  }
+}
+
+function makeRow(r) {
+  const el = document.createElement('div');
+  el.className = 'row' + (r[0] === selected ? ' sel' : '') + (r[4] ? '' : ' down');
+  for (let c = 0; c < COLS.length - 1; c++) {
+    const cell = document.createElement('div');
+    cell.textContent = fmt(r[c], c);
+    if (c === 1) cell.title = r[c];
+    el.appendChild(cell);
+  }
+  const spark = document.createElement('div');
+  const ping = r[12] && r[12].ping;
+  if (ping && ping.length) {
+    const cv = document.createElement('canvas');
+    cv.width = 100;
+    cv.height = 20;
+    spark.appendChild(cv);
+    plot(cv, ping);
+  }
+  el.appendChild(spark);
+  el.onclick = () => { selected = r[0]; render(true); detail(r); };
+  return el;
+}
+
+// only rows in (or near) the viewport exist in the DOM
+function render(force) {
+  pending = false;
+  const first = Math.max(0, Math.floor(view.scrollTop / RH) - 1 - OVERSCAN);
+  const last = Math.min(rows.length, Math.ceil((view.scrollTop + view.clientHeight) / RH) + OVERSCAN);
+  for (const [k, el] of drawn) {
+    if (force || k < first || k >= last) {
+      el.remove();
+      drawn.delete(k);
+    }
+  }
+  for (let k = first; k < last; k++) {
+    if (drawn.has(k)) continue;
+    const el = makeRow(rows[k]);
+    el.style.top = (k + 1) * RH + 'px';
+    view.appendChild(el);
+    drawn.set(k, el);
+  }
+}
+
+function detail(r) {
+  const box = document.getElementById('detail'), s = r[12] || {};
+  box.textContent = '';
+  const h = document.createElement('h3');
+  h.textContent = r[0] + ' - ' + r[1] + ' (' + r[2] + ':' + r[3] + ')';
+  box.appendChild(h);
+  for (const [key, title] of SERIES) {
+    if (!s[key] || !s[key].length) continue;
+    const cv = document.createElement('canvas');
+    cv.width = 420;
+    cv.height = 120;
+    box.appendChild(cv);
+    plot(cv, s[key], title);
+  }
+  if (box.children.length === 1) box.appendChild(document.createTextNode('No samples recorded for this node.'));
+}
+
+function compare(c) {
+  return (a, b) => {
+    const x = a[c], y = b[c];
+    if (x === y) return 0;
+    // empty cells sort last in both directions
+    if (x === null || x === '') return 1;
+    if (y === null || y === '') return -1;
+    return (x < y ? -1 : 1) * sortDir;
+  };
+}
+
+function apply() {
+  const q = document.getElementById('q').value.toLowerCase(), okOnly = document.getElementById('okonly').checked;
+  rows = D.rows.filter(r => (!okOnly || r[4]) && (!q || (r[1] + ' ' + r[2]).toLowerCase().includes(q)));
+  if (sortCol >= 0) rows.sort(compare(sortCol));
+  document.getElementById('count').textContent = rows.length + ' / ' + D.rows.length + ' nodes, generated ' + D.generated + ' UTC';
+  spacer.style.height = rows.length * RH + 'px';
+  render(true);
+}
+
+COLS.forEach(([title], c) => {
+  const cell = document.createElement('div');
+  cell.textContent = title;
+  if (c < COLS.length - 1) {
+    cell.onclick = () => {
+      sortDir = sortCol === c ? -sortDir : 1;
+      sortCol = c;
+      document.querySelectorAll('#head div').forEach((el, i) => { el.textContent = COLS[i][0] + (i === c ? (sortDir > 0 ? ' \\u25b2' : ' \\u25bc') : ''); });
+      apply();
+    };
+  }
+  document.getElementById('head').appendChild(cell);
+});
+view.addEventListener('scroll', () => {
+  if (!pending) {
+    pending = true;
+    requestAnimationFrame(() => render(false));
+  }
+});
+window.addEventListener('resize', () => render(false));
+document.getElementById('q').addEventListener('input', apply);
+document.getElementById('okonly').addEventListener('change', apply);
+apply();
+</script>
+</body>
+</html>
+"""
+
+
+def _report_row(i, n):
+    """One row of the HTML report dataset: [#, name, host, port, reachable, TCP loss%,
+    TCP p95, ping loss%, HTTP RTT p50, download MB/s, upload MB/s, pps, series], where
+    series holds the per-node samples for the charts ({} becomes 0).
+    """
+    def num(v, digits):
+        return round(v, digits) if isinstance(v, (int, float)) and not isinstance(v, bool) else None
+
+    mb = 1024 * 1024
+    tcp = n.get('tcp') or {}
+    ping = n.get('ping') or {}
+    speed = n.get('speed') or {}
+    upload = n.get('upload') or {}
+    series = {}
+    for key, stage, field, scale in (('ping', 'ping', 'rtts', 1), ('lat', 'latency', 'rtts', 1), ('down', 'speed', 'timeline', mb), ('up', 'upload', 'timeline', mb)):
+        res = n.get(stage) or {}
+        # throughput timeline per sampling interval (just the average for old results)
+        values = list(res.get(field) or []) or ([res['avg_bps']] if field == 'timeline' and res.get('avg_bps') else [])
+        values = [round(v / scale, 2) for v in values if isinstance(v, (int, float))]
+        if values:
+            series[key] = values
+    return [
+        i,
+        (n.get('ps') or n.get('raw') or '')[:60],
+        n.get('add') or '',
+        n.get('port') or '',
+        bool(n.get('reachable')),
+        num(tcp.get('loss_percent'), 1),
+        num(tcp.get('p95'), 1),
+        num(ping.get('loss_percent'), 1),
+        num((n.get('latency') or {}).get('p50'), 1),
+        num(speed['avg_bps'] / mb, 2) if speed.get('avg_bps') is not None else None,
+        num(upload['avg_bps'] / mb, 2) if upload.get('avg_bps') is not None else None,
+        num((n.get('game') or {}).get('pps'), 1),
+        series or 0,
+    ]
+
+
+def generate_html_report(tested, out_html='report.html'):
+    """Write a self-contained HTML report (no CDN, works offline). Results are streamed
+    from `tested` into one embedded JSON dataset; the page renders it as a virtualized,
+    sortable and filterable table and draws charts only for visible rows and the
+    selected node, so opening it costs the same for 50 or 50k nodes.
+    """
+    head, tail = _REPORT_HTML.split('%%DATA%%')
+    with open(out_html, 'w', encoding='utf-8') as fh:
+        fh.write(head)
+        fh.write('{"generated":%s,"rows":[' % json.dumps(datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')))
+        for i, n in enumerate(tested):
+            row = json.dumps(_report_row(i, as_result_dict(n)), ensure_ascii=False, separators=(',', ':'))
+            # keep '</script>' in a node name from closing the data block
+            fh.write((',\n' if i else '\n') + row.replace('</', '<\\/'))
+        fh.write('\n]}')
+        fh.write(tail)
+
+
+# ---------------------------------------------------------------------------
+# ranking: configurable score and a best-first index per node group
+# ---------------------------------------------------------------------------
+
+RANK_WEIGHTS = {'p95': 1.0, 'loss': 1.0, 'speed': 1.0, 'jitter': 1.0}
+# reference level per metric: TCP p95 ms, TCP loss %, download bytes/s, game jitter ms
+RANK_REFERENCE = {'p95': 100.0, 'loss': 5.0, 'speed': 10 * 1024 * 1024, 'jitter': 10.0}
+
+
+def parse_rank_weights(text):
+    """Parse 'p95=1,loss=2,speed=0.5' into a dict of score weights."""
+    weights = {}
+    for item in (text or '').split(','):
+        if not item.strip():
+            continue
+        name, _, value = item.partition('=')
+        name = name.strip().lower()
+        if name not in RANK_WEIGHTS:
+            raise ValueError(f"Unknown rank metric '{name}' (expected one of: {', '.join(RANK_WEIGHTS)})")
+        weights[name] = float(value)
+    return weights
+
+
+def make_scorer(weights=None, reference=None):
+    """Score function for RankingIndex: lower is better, None for unreachable nodes.
+
+    Each metric adds weight * badness: value / reference for TCP p95, TCP loss and game
+    jitter, reference / avg_bps (capped at 10) for download speed. A metric that was not
+    measured counts as its reference (badness 1), so it neither helps nor hurts.
+    """
+    weights = dict(RANK_WEIGHTS, **(weights or {}))
+    reference = dict(RANK_REFERENCE, **(reference or {}))
+
+    def score(r):
+        if not r.get('reachable'):
+            return None
+        tcp = r.get('tcp') or {}
+        values = {
+            'p95': tcp.get('p95'),
+            'loss': tcp.get('loss_percent'),
+            'speed': (r.get('speed') or {}).get('avg_bps'),
+            'jitter': (r.get('game') or {}).get('jitter_ms'),
+        }
+        total = 0.0
+        for name, weight in weights.items():
+            if not weight:
+                continue
+            v = values[name]
+            if v is None:
+                bad = 1.0
+            elif name == 'speed':
+                bad = min(10.0, reference['speed'] / v) if v > 0 else 10.0
+            else:
+                bad = v / reference[name]
+            total += weight * bad
+        return total
+
+    return score
+
+
+_FLAG_RE = re.compile('([\U0001F1E6-\U0001F1FF]{2})')
+_REGION_RE = re.compile(r'^([A-Z]{2})(?=$|[\s\-_|.,:\d])')
+_TAG_RE = re.compile(r'\[([^\]]+)\]')
+
+
+def node_groups(r):
+    """Index groups of a result besides 'all': 'protocol:<p>', 'region:<CC>' (from a flag
+    emoji or a leading country code in the name) and 'tag:<t>' (a 'tags' list on the
+    node, or [bracketed] words in its name).
+    """
+    groups = []
+    if r.get('protocol'):
+        groups.append(f"protocol:{r.get('protocol')}")
+    name = (r.get('ps') or '').strip()
+    m = _FLAG_RE.search(name)
+    if m:
+        groups.append('region:' + ''.join(chr(ord(c) - 0x1F1E6 + ord('A')) for c in m.group(1)))
+    else:
+        m = _REGION_RE.match(name)
+        if m:
+            groups.append(f'region:{m.group(1)}')
+    tags = r.get('tags') or _TAG_RE.findall(name)
+    groups.extend(f'tag:{t.strip().lower()}' for t in tags if t.strip())
+    return groups
+
+
+class RankingIndex:
+    """Best-first index of results, usable as on_node_complete. Every group ('all' plus
+    node_groups) keeps a list sorted by (score, node_key) that is updated with bisect as
+    results arrive, so top(n, group) is a slice and never re-sorts the full set. A
+    re-tested node leaves its old position first; unreachable nodes are not ranked.
+    """
+
+    def __init__(self, score=None, groups=node_groups):
+        self.score = score or make_scorer()
+        self.groups = groups
+        self._lists = collections.defaultdict(list)
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, r):
+        self.update(r)
+
+    def update(self, r):
+        key = node_key(r)
+        s = self.score(r)
+        groups = ('all', *self.groups(r)) if s is not None else ()
+        with self._lock:
+            self._remove(key)
+            if s is not None:
+                self._entries[key] = (s, groups, r)
+                for g in groups:
+                    bisect.insort(self._lists[g], (s, key))
+
+    def discard(self, key):
+        with self._lock:
+            self._remove(key)
+
+    def _remove(self, key):
+        old = self._entries.pop(key, None)
+        if old is None:
+            return
+        s, groups, _ = old
+        for g in groups:
+            lst = self._lists[g]
+            i = bisect.bisect_left(lst, (s, key))
+            if i < len(lst) and lst[i] == (s, key):
+                del lst[i]
+            if not lst:
+                del self._lists[g]
+
+    def top(self, n=10, group='all'):
+        """[(key, score, result)] of the n best nodes in `group`."""
+        with self._lock:
+            return [(key, s, self._entries[key][2]) for s, key in self._lists.get(group, [])[:max(0, n)]]
+
+    def group_sizes(self):
+        with self._lock:
+            return {g: len(lst) for g, lst in self._lists.items()}
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def best_nodes(results, n=10, group='all', weights=None):
+    """The n best results in `group` from any iterable of results (list, test_nodes
+    output, NdjsonResults), as [(key, score, result)]. For repeated queries over live
+    results keep a RankingIndex and feed it from on_node_complete instead.
+    """
+    index = RankingIndex(score=make_scorer(weights))
+    for r in results:
+        index.update(r)
+    return index.top(n, group)
+
+
+# ---------------------------------------------------------------------------
+# daemon mode: periodic sweeps behind a local HTTP API
+# ---------------------------------------------------------------------------
+
+class LiveResults:
+    """Latest result per node (by node_key) for the serve-mode API, fed from
+    on_node_complete, plus a RankingIndex over them. `version` changes on every update,
+    so rendered responses can be reused until the next result arrives. Nodes not seen in
+    a finished sweep (removed from the subscription) are dropped.
+    """
 
-        # Game UDP test
-        if do_game and udp_target:
-            try:
-                target_host, target_port = udp_target.split(':', 1)
-                res = udp_game_test(target_host, int(target_port), duration=game_duration, psize=game_psize, interval_ms=game_interval_ms, expect_echo=expect_echo)
-                node_res['game'] = res
-            except Exception:
-                node_res['game'] = None
-            if pbar_local:
-                pbar_local.update(1)
+    def __init__(self, index=None):
+        self.index = index or RankingIndex()
+        self._results = {}
+        self._seen = set()
+        self._lock = threading.Lock()
+        self.version = 0
+        self.sweeps = 0
+        self.sweeping = False
+        self.last_sweep = None
+        self.failed_sweeps = 0
+        self.last_error = None
 
-        # stop xray
-        if x:
-            try:
-                stop_xray(x)
-            except Exception:
-                pass
-        if pbar_local:
-            pbar_local.close()
+    def update(self, r):
+        key = node_key(r)
+        self.index.update(r)
+        with self._lock:
+            self._results[key] = r
+            self._seen.add(key)
+            self.version += 1
 
-        return node_res
+    def get(self, key):
+        with self._lock:
+            return self._results.get(key)
 
-    # run with progress bar (if available)
-    pbar = None
-    if show_progress and tqdm:
-        pbar = tqdm(total=len(nodes), desc='Checking nodes')
+    def items(self):
+        with self._lock:
+            return list(self._results.items())
 
-    with ThreadPoolExecutor(max_workers=workers) as ex:
-        futures = [ex.submit(worker, n) for n in nodes]
-        for f in as_completed(futures):
-            try:
-                r = f.result()
-                results.append(r)
-                if on_node_complete:
-                    try:
-                        on_node_complete(r)
-                    except Exception:
-                        pass
-            except Exception:
-                pass
-            if pbar:
-                pbar.update(1)
-    if pbar:
-        pbar.close()
-    return results
+    def __len__(self):
+        return len(self._results)
 
+    def begin_sweep(self):
+        with self._lock:
+            self.sweeping = True
+            self._seen = set()
+            self._started = time.time()
+            self.version += 1
 
-def generate_html_report(tested, out_html='report.html'):
-    """Generate a simple HTML report with table and charts (Chart.js via CDN)."""
-    rows = []
-    charts_js = []
-    for i, n in enumerate(tested):
-        name = (n.get('ps') or n.get('raw'))[:60]
-        host = n.get('add') or ''
-        port = n.get('port') or ''
-        reach = 'OK' if n.get('reachable') else 'DOWN'
-        tcp = n.get('tcp') or {}
-        p95 = tcp.get('p95')
-        loss = tcp.get('loss_percent') if tcp else None
-        ping = n.get('ping') or {}
-        ping_p = ping.get('loss_percent') if ping else None
-        speed = n.get('speed') or {}
-        avg_bps = speed.get('avg_bps') if speed else None
-        game = n.get('game') or {}
-        pps = game.get('pps') if game else None
-        rows.append((i, name, host, port, reach, loss, p95, ping_p, avg_bps, pps))
+    def end_sweep(self):
+        with self._lock:
+            for key in set(self._results) - self._seen:
+                del self._results[key]
+                self.index.discard(key)
+            finished = time.time()
+            self.sweeps += 1
+            self.sweeping = False
+            self.last_sweep = {'started': self._started, 'finished': finished, 'duration': finished - self._started, 'nodes': len(self._seen)}
+            self.version += 1
 
-    html = ["""
-<!doctype html>
-<html>
-<head>
-  <meta charset="utf-8">
-  <title>VPN Check Report</title>
-  <script src="https://cdn.jsdelivr.net/npm/chart.js"></script>
-  <style>table{border-collapse:collapse;width:100%}td,th{border:1px solid #ddd;padding:8px}</style>
-</head>
-<body>
-<h2>VPN Check Report</h2>
-<table>
-<thead><tr><th>#</th><th>Name</th><th>Host</th><th>Port</th><th>State</th><th>Loss%</th><th>p95 ms</th><th>PingLoss%</th><th>Speed MB/s</th><th>PPS</th></tr></thead>
-<tbody>
-"""
+    def fail_sweep(self, error):
+        """End a sweep that raised: results of the nodes it did test are kept, nothing is pruned."""
+        with self._lock:
+            self.failed_sweeps += 1
+            self.sweeping = False
+            self.last_error = {'time': time.time(), 'error': error}
+            self.version += 1
+
+    def best(self, n=10, group='all'):
+        """[(key, score, result)] of the n best nodes in `group` (see RankingIndex)."""
+        return self.index.top(n, group)
+
+
+def _prom_label(v):
+    return str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+# (metric, help, value getter) per node; values in Prometheus base units
+_NODE_METRICS = (
+    ('vpncheck_node_up', 'Node reachable in its latest test (1) or not (0).', lambda r: 1 if r.get('reachable') else 0),
+    ('vpncheck_node_tcp_connect_p95_seconds', 'TCP connect time, 95th percentile.', lambda r: _scaled((r.get('tcp') or {}).get('p95'), 1e-3)),
+    ('vpncheck_node_tcp_loss_ratio', 'Failed TCP connects / attempts.', lambda r: _scaled((r.get('tcp') or {}).get('loss_percent'), 1e-2)),
+    ('vpncheck_node_ping_loss_ratio', 'Lost ICMP echoes / sent.', lambda r: _scaled((r.get('ping') or {}).get('loss_percent'), 1e-2)),
+    ('vpncheck_node_http_rtt_seconds', 'Median HTTP round trip through the node.', lambda r: _scaled((r.get('latency') or {}).get('p50'), 1e-3)),
+    ('vpncheck_node_download_bytes_per_second', 'Average download throughput.', lambda r: (r.get('speed') or {}).get('avg_bps')),
+    ('vpncheck_node_upload_bytes_per_second', 'Average upload throughput.', lambda r: (r.get('upload') or {}).get('avg_bps')),
+    ('vpncheck_node_game_jitter_seconds', 'UDP game test interarrival jitter (RFC 3550).', lambda r: _scaled((r.get('game') or {}).get('jitter_ms'), 1e-3)),
+    ('vpncheck_node_game_loss_ratio', 'UDP game test packet loss.', lambda r: _scaled((r.get('game') or {}).get('loss_percent'), 1e-2)),
+)
+
+
+def _scaled(v, factor):
+    return None if v is None else v * factor
+
+
+def render_metrics(live):
+    """Prometheus text exposition of the latest result of every node plus sweep stats."""
+    items = live.items()
+    out = []
+    for name, help_text, value in _NODE_METRICS:
+        out.append(f'# HELP {name} {help_text}')
+        out.append(f'# TYPE {name} gauge')
+        for key, r in items:
+            v = value(r)
+            if v is None:
+                continue
+            labels = f'key="{key}",name="{_prom_label(r.get("ps") or "")}",protocol="{_prom_label(r.get("protocol") or "")}",host="{_prom_label(r.get("add") or "")}",port="{_prom_label(r.get("port") or "")}"'
+            out.append(f'{name}{{{labels}}} {v:g}')
+    up = sum(1 for _, r in items if r.get('reachable'))
+    out += [
+        '# HELP vpncheck_nodes Nodes with a result, by state.',
+        '# TYPE vpncheck_nodes gauge',
+        f'vpncheck_nodes{{state="up"}} {up}',
+        f'vpncheck_nodes{{state="down"}} {len(items) - up}',
+        '# HELP vpncheck_sweeps_total Completed sweeps.',
+        '# TYPE vpncheck_sweeps_total counter',
+        f'vpncheck_sweeps_total {live.sweeps}',
+        '# HELP vpncheck_sweep_failures_total Sweeps aborted by an error.',
+        '# TYPE vpncheck_sweep_failures_total counter',
+        f'vpncheck_sweep_failures_total {live.failed_sweeps}',
     ]
-    for r in rows:
-        html.append(f"<tr><td>{r[0]}</td><td>{r[1]}</td><td>{r[2]}</td><td>{r[3]}</td><td>{r[4]}</td><td>{r[5] or ''}</td><td>{r[6] or ''}</td><td>{r[7] or ''}</td><td>{(f'{(r[8]/1024/1024):.2f}' if r[8] is not None else '')}</td><td>{r[9] or ''}</td></tr>")
+    if live.last_sweep:
+        out += [
+            '# HELP vpncheck_last_sweep_duration_seconds Duration of the last completed sweep.',
+            '# TYPE vpncheck_last_sweep_duration_seconds gauge',
+            f"vpncheck_last_sweep_duration_seconds {live.last_sweep['duration']:.3f}",
+            '# HELP vpncheck_last_sweep_timestamp_seconds End of the last completed sweep (unix time).',
+            '# TYPE vpncheck_last_sweep_timestamp_seconds gauge',
+            f"vpncheck_last_sweep_timestamp_seconds {live.last_sweep['finished']:.3f}",
+        ]
+    return '\n'.join(out) + '\n'
 
-    html.append("</tbody></table>\n")
 
-    # add per-node charts for ping rtts and speed if available
-    html.append('<h3>Per-node charts</h3>')
-    for i, n in enumerate(tested):
-        ping = n.get('ping') or {}
-        rtts = ping.get('rtts') or []
-        speed = n.get('speed') or {}
-        avg = speed.get('avg_bps') or 0
-        html.append(f'<div style="margin-bottom:24px"><h4>{i} - {(n.get("ps") or n.get("raw")[:40])}</h4>')
-        if rtts:
-            html.append(f'<canvas id="c_ping_{i}" width="400" height="100"></canvas>')
-            charts_js.append((f'c_ping_{i}', rtts, 'RTT (ms)'))
-        if avg:
-            html.append(f'<canvas id="c_speed_{i}" width="400" height="80"></canvas>')
-            charts_js.append((f'c_speed_{i}', [avg], 'Avg Bps'))
-        html.append('</div>')
-
-    # script
-    html.append('<script>')
-    html.append('const labels = (n) => n.map((_,i)=> i+1);')
-    for cid, data, lab in charts_js:
-        data_json = json.dumps(data)
-        html.append(f"new Chart(document.getElementById('{cid}').getContext('2d'), {{type: 'line', data: {{labels: labels({data_json}), datasets:[{{label:'{lab}', data:{data_json}, borderColor:'rgb(75, 192, 192)', tension:0.2}}]}}, options:{{responsive:true}}}});")
-    html.append('</script>')
-    html.append('</body></html>')
+def start_api_server(live, host='127.0.0.1', port=8080):
+    """Serve `live` (LiveResults) over keep-alive HTTP. Returns the running server.
 
-    with open(out_html, 'w', encoding='utf-8') as fh:
-        fh.write('\n'.join(html))
+    - GET /health: 200 once a sweep has completed, 503 before
+    - GET /best?n=10[&group=region:DE]: the n best nodes by RankingIndex score
+      (result_summary records + 'key' and 'score'); /groups: ranked nodes per group
+    - GET /nodes[?detailed=1]: latest result of every node; /nodes/<key>: one full result
+    - GET /metrics: Prometheus text format
+    Bodies are rendered once per LiveResults version and reused until the next result.
+    """
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
+    cache = {}
+    cache_lock = threading.Lock()
 
-def main():
-    parser = argparse.ArgumentParser(description='VPN subscription parser + basic tests')
-    parser.add_argument('--url', '-u', help='Subscription URL')
-    parser.add_argument('--file', '-f', help='File with subscription content')
-    parser.add_argument('--output', '-o', help='Output JSON file', default='nodes.json')
-    parser.add_argument('--timeout', type=int, default=5, help='Socket timeout seconds')
-    parser.add_argument('--workers', type=int, default=10, help='Parallel workers for tests')
-    parser.add_argument('--ping-count', type=int, default=4, help='ICMP ping count')
-    parser.add_argument('--tcp-retries', type=int, default=10, help='Number of TCP connect attempts per node')
-    parser.add_argument('--tcp-timeout', type=int, default=3, help='TCP connect timeout seconds per attempt')
-    parser.add_argument('--detailed', action='store_true', help='Write more detailed JSON output')
-    parser.add_argument('--do-speed', action='store_true', help='Run HTTP download speed test to --speed-url')
-    parser.add_argument('--speed-url', default='http://speedtest.tele2.net/5MB.zip', help='URL for download speed test')
-    parser.add_argument('--speed-duration', type=int, default=10, help='Duration sec for speed test')
-    parser.add_argument('--speed-concurrency', type=int, default=1, help='Concurrent workers for speed test')
-    parser.add_argument('--do-game', action='store_true', help='Run UDP gaming simulation (requires --udp-target host:port)')
-    parser.add_argument('--udp-target', help='UDP target host:port for gaming test')
-    parser.add_argument('--game-duration', type=int, default=5, help='Duration sec for game test')
-    parser.add_argument('--game-psize', type=int, default=60, help='Packet size for game test (bytes)')
-    parser.add_argument('--game-interval', type=int, default=20, help='Interval ms between game packets')
-    parser.add_argument('--no-progress', action='store_true', help='Disable progress bar output')
-    parser.add_argument('--start-xray', action='store_true', help='Start xray locally and proxy tests through it (requires --xray-path)')
-    parser.add_argument('--xray-path', default='xray', help='Path to xray binary')
-    parser.add_argument('--html-output', help='Generate HTML report (path). If a filename only is passed, it will be written into --reports-dir', default=None)
-    parser.add_argument('--reports-dir', default='reports', help='Directory to save timestamped reports when --html-output is not provided')
-    parser.add_argument('--open-report', action='store_true', help='Open generated HTML report in the default browser')
-    parser.add_argument('--no-html', action='store_true', help='Do not generate an HTML report')
-    parser.add_argument('--serve-speed-size', type=int, default=0, help='Create local file of given MB and serve it for speed tests')
-    parser.add_argument('--speed-file', help='Path to a local file to serve for speed tests (overrides --speed-url)')
-    parser.add_argument('--no-summary', action='store_true', help='Do not print overall progress summary')
-    args = parser.parse_args()
+    def summary(key, r):
+        return dict(result_summary(r), key=key)
 
-    text = ''
-    if args.url:
-        print(f'Fetching {args.url}...')
-        text = fetch_url(args.url, timeout=max(15, args.timeout))
-    elif args.file:
-        with open(args.file, 'r', encoding='utf-8') as fh:
-            text = fh.read()
-    else:
-        print('Please provide --url or --file', file=sys.stderr)
-        sys.exit(1)
+    def render(path, qs):
+        if path == '/health':
+            ready = live.sweeps > 0
+            body = {'status': 'ok' if ready else 'starting', 'sweeps': live.sweeps, 'sweeping': live.sweeping,
+                    'nodes': len(live), 'last_sweep': live.last_sweep, 'failed_sweeps': live.failed_sweeps, 'last_error': live.last_error}
+            return (200 if ready else 503), 'application/json', json.dumps(body)
+        if path == '/metrics':
+            return 200, 'text/plain; version=0.0.4', render_metrics(live)
+        if path == '/best':
+            n = int(qs.get('n', ['10'])[0])
+            best = live.best(n, qs.get('group', ['all'])[0])
+            return 200, 'application/json', json.dumps([dict(summary(k, r), score=s) for k, s, r in best], ensure_ascii=False)
+        if path == '/groups':
+            return 200, 'application/json', json.dumps(live.index.group_sizes(), ensure_ascii=False)
+        if path == '/nodes':
+            detailed = qs.get('detailed', ['0'])[0] not in ('0', '')
+            rows = [dict(as_result_dict(r), key=k) if detailed else summary(k, r) for k, r in live.items()]
+            return 200, 'application/json', json.dumps(rows, ensure_ascii=False, default=str)
+        if path.startswith('/nodes/'):
+            r = live.get(path[len('/nodes/'):])
+            if r is None:
+                return 404, 'application/json', json.dumps({'error': 'unknown node'})
+            return 200, 'application/json', json.dumps(as_result_dict(r), ensure_ascii=False, default=str)
+        return 404, 'application/json', json.dumps({'error': 'not found', 'endpoints': ['/best', '/groups', '/nodes', '/metrics', '/health']})
 
-    nodes = gather_nodes_from_text(text)
-    print(f'Found {len(nodes)} nodes')
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        # headers and body go out in separate writes: without this, Nagle plus
+        # delayed ACK adds ~40 ms to every keep-alive response
+        disable_nagle_algorithm = True
 
-    # prepare local speed server if requested
-    local_server = None
-    served_temp = None
-    if args.serve_speed_size and args.serve_speed_size > 0:
-        # create temp file of specified MB
-        tmpd = tempfile.mkdtemp(prefix='speed-file-')
-        fname = f'speed_{args.serve_speed_size}MB.bin'
-        fpath = os.path.join(tmpd, fname)
-        mb = 1024 * 1024
-        with open(fpath, 'wb') as fh:
-            chunk = b'\0' * (1024 * 1024)
-            for i in range(args.serve_speed_size):
-                fh.write(chunk)
-        httpd, url = start_local_http_server(fpath)
-        local_server = httpd
-        served_temp = tmpd
-        print(f'Serving local speed file at {url}')
-        args.speed_url = url
-    elif args.speed_file:
-        if os.path.exists(args.speed_file):
-            httpd, url = start_local_http_server(args.speed_file)
-            local_server = httpd
-            served_temp = None
-            print(f'Serving provided file at {url}')
-            args.speed_url = url
-        else:
-            print('Specified --speed-file does not exist, falling back to --speed-url')
+        def do_GET(self):
+            u = urlparse(self.path)
+            path = u.path.rstrip('/') or '/'
+            version = live.version
+            with cache_lock:
+                hit = cache.get((path, u.query))
+            if hit and hit[0] == version:
+                status, ctype, body = hit[1]
+            else:
+                try:
+                    status, ctype, text = render(path, parse_qs(u.query))
+                except ValueError as e:
+                    status, ctype, text = 400, 'application/json', json.dumps({'error': str(e)})
+                body = text.encode('utf-8')
+                with cache_lock:
+                    if len(cache) > 1024:
+                        cache.clear()
+                    cache[(path, u.query)] = (version, (status, ctype, body))
+            self.send_response(status)
+            self.send_header('Content-Type', ctype)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
 
-    # overall progress monitoring
-    total = len(nodes)
-    completed = {'count': 0}
-    lock = threading.Lock()
+        def log_message(self, *args):
+            pass
 
-    def on_node(r):
-        with lock:
-            completed['count'] += 1
+    class Server(ThreadingHTTPServer):
+        daemon_threads = True
+        allow_reuse_address = True
 
-    monitor_thread = None
-    stop_monitor = {'stop': False}
-    def monitor():
-        while not stop_monitor['stop']:
-            with lock:
-                c = completed['count']
-            print(f'Progress: {c}/{total}', end='\r', flush=True)
-            if c >= total:
-                break
-            time.sleep(1)
-        print()  # newline at the end
+    httpd = Server((host, port), Handler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    return httpd
 
-    if not args.no_summary:
-        monitor_thread = threading.Thread(target=monitor, daemon=True)
-        monitor_thread.start()
 
-    # run tests
-    tested = test_nodes(
-        nodes,
+def serve(args, urls, nodes, runner, test_kwargs):
+    """--serve: keep the process alive, re-sweep every --sweep-interval seconds and
+    answer the HTTP API from the latest results. Subscriptions are re-fetched each
+    cycle through the subscription cache; with --history --incremental the sweeps
+    reuse the incremental scheduler. A sweep that fails is logged and the API keeps
+    serving the previous results until the next interval. Stops on Ctrl-C or SIGTERM.
+    """
+    host, _, port = args.serve.rpartition(':')
+    live = LiveResults(RankingIndex(score=make_scorer(parse_rank_weights(args.rank_weights))))
+    httpd = start_api_server(live, host or '127.0.0.1', int(port))
+    print(f'API on http://{httpd.server_address[0]}:{httpd.server_address[1]}/ (/best, /nodes, /metrics, /health)')
+    history = HistoryStore(args.history) if args.history else None
+    kwargs = dict(test_kwargs, keep_results=False, show_progress=False)
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+
+    def on_tested(r):
+        if history:
+            history.record(r)
+        live.update(r)
+
+    try:
+        while True:
+            started = time.monotonic()
+            live.begin_sweep()
+            try:
+                if nodes is None:
+                    nodes = load_nodes(args, urls)
+                if isinstance(nodes, list) and not nodes:
+                    # every subscription failed: do not prune the previous results
+                    raise RuntimeError('no nodes loaded')
+                if history and args.incremental:
+                    incremental_test_nodes(nodes, history, on_node_complete=live.update, policy=incremental_policy_from_args(args), runner=runner, **kwargs)
+                else:
+                    runner(nodes, on_node_complete=on_tested, **kwargs)
+            except Exception as e:
+                live.fail_sweep(f'{type(e).__name__}: {e}')
+                print(f'Sweep failed: {type(e).__name__}: {e}', file=sys.stderr)
+            else:
+                live.end_sweep()
+                up = sum(1 for _, r in live.items() if r.get('reachable'))
+                print(f"Sweep {live.sweeps}: {live.last_sweep['nodes']} nodes, {up} reachable, {live.last_sweep['duration']:.1f}s")
+            nodes = None
+            time.sleep(max(0.0, args.sweep_interval - (time.monotonic() - started)))
+    except KeyboardInterrupt:
+        print('Stopping')
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+        if history:
+            history.close()
+
+
+def test_kwargs_from_args(args, stage_limits=None):
+    """test_nodes keyword arguments from parsed CLI args (everything but nodes/callback)."""
+    return dict(
         timeout=args.timeout,
         workers=args.workers,
         ping_count=args.ping_count,
@@ -865,35 +5324,107 @@ def main():
         speed_url=args.speed_url,
         speed_duration=args.speed_duration,
         speed_concurrency=args.speed_concurrency,
+        speed_warmup=args.speed_warmup,
+        do_upload=args.do_upload,
+        upload_url=args.upload_url,
         do_game=args.do_game,
         udp_target=args.udp_target,
         game_duration=args.game_duration,
         game_psize=args.game_psize,
         game_interval_ms=args.game_interval,
-        expect_echo=False,
+        game_batch=args.game_batch,
+        do_latency=args.do_latency,
+        latency_url=args.latency_url,
+        latency_count=args.latency_count,
+        keep_results=not args.ndjson,
+        expect_echo=args.expect_echo,
         start_xray=args.start_xray,
         xray_path=args.xray_path,
         show_progress=not args.no_progress,
-        on_node_complete=on_node,
+        engine=args.engine,
+        concurrency=args.concurrency,
+        stage_limits=stage_limits,
+        tcp_batch=args.tcp_batch,
+        tcp_max_inflight=args.tcp_max_inflight,
+        ping_method=args.ping_method,
+        resolve=not args.no_resolve,
+        xray_mode=args.xray_mode,
+        xray_batch_size=args.xray_batch_size,
+        xray_recycle_after=args.xray_recycle_after,
+        stream_window=args.stream_window,
+        group_endpoints=not args.no_group_endpoints,
+        compact=args.compact,
+        adaptive=adaptive_from_args(args),
     )
 
-    stop_monitor['stop'] = True
-    if monitor_thread:
-        monitor_thread.join(timeout=2)
 
-    # stop local server if we started
-    if local_server:
-        stop_local_http_server(local_server)
-        if served_temp:
-            try:
-                shutil.rmtree(served_temp)
-            except Exception:
-                pass
+def adaptive_from_args(args):
+    """The `adaptive` argument for test_nodes: False, or ADAPTIVE_DEFAULTS overrides."""
+    if not args.adaptive:
+        return False
+    return {'fail_streak': args.adaptive_fail_streak, 'speed_tol': args.adaptive_speed_tol / 100.0}
+
+
+def load_nodes(args, urls):
+    """Nodes from --url/--url-list (`urls`) or --file as the CLI options ask: streamed or
+    fetched through the subscription cache, optionally compacted and deduplicated.
+    Returns a list, or a lazy iterator with --stream.
+    """
+    if args.stream:
+        # nodes are parsed while downloading and fed straight into test_nodes
+        if urls:
+            print(f'Streaming {len(urls)} subscription(s)...')
+            session = make_session(pool_size=1)
+            cache = None if args.no_sub_cache else SubscriptionCache(args.sub_cache)
+            nodes = itertools.chain.from_iterable(stream_subscription(session, u, cache=cache, timeout=max(15, args.timeout)) for u in dict.fromkeys(urls))
+        else:
+            nodes = iter_nodes(iter_file_chunks(args.file))
+    elif urls:
+        print(f'Fetching {len(urls)} subscription(s)...')
+        nodes = []
+        for sub in fetch_subscriptions(urls, cache_dir=None if args.no_sub_cache else args.sub_cache, workers=args.fetch_workers, timeout=max(15, args.timeout)):
+            msg = f"  {sub['url']}: {sub['status']}, {len(sub['nodes'])} nodes"
+            if sub['error']:
+                msg += f" ({sub['error']})"
+            print(msg)
+            nodes.extend(sub['nodes'])
+        print(f'Found {len(nodes)} nodes')
+    else:
+        with open(args.file, 'r', encoding='utf-8') as fh:
+            text = fh.read()
+        nodes = gather_nodes_from_text(text)
+        print(f'Found {len(nodes)} nodes')
+
+    if args.compact:
+        nodes = list(compact_nodes(nodes)) if isinstance(nodes, list) else compact_nodes(nodes)
+
+    if not args.no_dedup:
+        if isinstance(nodes, list):
+            before = len(nodes)
+            nodes = dedup_nodes(nodes)
+            if len(nodes) != before:
+                print(f'Removed {before - len(nodes)} duplicate nodes, {len(nodes)} unique')
+        else:
+            nodes = iter_dedup(nodes)
+    return nodes
+
+
+def incremental_policy_from_args(args):
+    """The `policy` argument for incremental_test_nodes."""
+    return {'healthy_window': args.healthy_window, 'full_interval': args.full_interval, 'backoff_base': args.dead_backoff, 'backoff_max': args.dead_backoff_max}
+
 
+def report_results(args, tested, index=None):
+    """Speed diagnostics, HTML report, --output JSON and the summary table for `tested`
+    (a list or a re-iterable such as NdjsonResults). With --top, the best nodes come
+    from `index` (a RankingIndex fed during the run), or one built from `tested`.
+    """
     # quick diagnostics for speed test results
     if args.do_speed:
         for n in tested:
             sp = n.get('speed')
+            if not sp and n.get('funnel') in ('unreachable', 'cut'):
+                continue
             if not sp:
                 print(f"Warning: speed test missing for node {n.get('ps') or n.get('raw')[:30]}")
                 continue
@@ -909,6 +5440,7 @@ def main():
                 print(msg)
 
     # generate html report unless disabled
+    report_path = None
     if not args.no_html:
         # determine html output path
         reports_dir = Path(args.reports_dir)
@@ -924,46 +5456,31 @@ def main():
             html_path = str(reports_dir / f"report-{ts}.html")
         try:
             generate_html_report(tested, html_path)
-            abs_path = os.path.abspath(html_path)
-            print(f'Wrote HTML report to {abs_path}')
+            report_path = os.path.abspath(html_path)
+            print(f'Wrote HTML report to {report_path}')
             if args.open_report:
                 try:
-                    webbrowser.open('file://' + abs_path)
+                    webbrowser.open('file://' + report_path)
                 except Exception as oe:
                     print(f'Failed to open report in browser: {oe}')
         except Exception as e:
             print(f'Failed to write HTML report: {e}')
 
+    # best nodes overall or per --top-by group
+    top = None
+    if args.top:
+        if index is None:
+            index = RankingIndex(score=make_scorer(parse_rank_weights(args.rank_weights)))
+            for n in tested:
+                index.update(n)
+        if args.top_by == 'all':
+            groups = ['all']
+        else:
+            groups = sorted(g for g in index.group_sizes() if g.startswith(args.top_by + ':'))
+        top = {g: [dict(result_summary(r), key=k, score=s) for k, s, r in index.top(args.top, g)] for g in groups}
+
     # write results (include report path if available)
-    report_path = locals().get('abs_path', None)
-    if args.detailed:
-        meta = {'generated_at': datetime.utcnow().isoformat(), 'report': report_path, 'nodes': tested}
-        with open(args.output, 'w', encoding='utf-8') as fo:
-            json.dump(meta, fo, ensure_ascii=False, indent=2)
-    else:
-        # simplified summary
-        summary = []
-        for n in tested:
-            tcp = n.get('tcp') or {}
-            ping = n.get('ping') or {}
-            speed = n.get('speed') or {}
-            game = n.get('game') or {}
-            summary.append({
-                'ps': n.get('ps'),
-                'add': n.get('add'),
-                'port': n.get('port'),
-                'reachable': n.get('reachable'),
-                'tcp_successes': tcp.get('successes'),
-                'tcp_attempts': tcp.get('attempts'),
-                'tcp_loss_percent': tcp.get('loss_percent'),
-                'tcp_p95_ms': tcp.get('p95'),
-                'ping_loss_percent': ping.get('loss_percent'),
-                'avg_speed_bps': speed.get('avg_bps'),
-                'pps': game.get('pps'),
-            })
-        out = {'generated_at': datetime.utcnow().isoformat(), 'report': report_path, 'nodes': summary}
-        with open(args.output, 'w', encoding='utf-8') as fo:
-            json.dump(out, fo, ensure_ascii=False, indent=2)
+    write_results_json(args.output, tested, report_path=report_path, detailed=args.detailed, top=top)
 
     # print summary table
     for n in tested:
@@ -983,10 +5500,277 @@ def main():
         speed = n.get('speed') or {}
         avg_bps = speed.get('avg_bps')
         avg_speed = f"{avg_bps/1024/1024:.2f} MB/s" if (avg_bps is not None) else '-'
+        up_bps = (n.get('upload') or {}).get('avg_bps')
+        avg_up = f"{up_bps/1024/1024:.2f} MB/s" if (up_bps is not None) else '-'
+        lat_rtt = (n.get('latency') or {}).get('p50')
+        lat = f"{lat_rtt:.1f} ms" if lat_rtt is not None else '-'
         game = n.get('game') or {}
         pps = f"{game.get('pps', 0):.1f}" if game and (game.get('pps') is not None) else '-'
-        print(f"{name:40.40} {host:20} {str(port):6} {reach:6} loss:{loss:6} tcp:{ratio:8} p95:{p95s:10} ping:{ping_summary:6} speed:{avg_speed:10} pps:{pps:6}")
+        print(f"{name:40.40} {host:20} {str(port):6} {reach:6} loss:{loss:6} tcp:{ratio:8} p95:{p95s:10} ping:{ping_summary:6} rtt:{lat:10} speed:{avg_speed:10} up:{avg_up:10} pps:{pps:6}")
+
+    for group, rows in (top or {}).items():
+        print(f"\nTop {len(rows)} nodes{'' if group == 'all' else ' in ' + group} (score: lower is better)")
+        for rank, rec in enumerate(rows, 1):
+            p95 = f"{rec['tcp_p95_ms']:.1f} ms" if rec['tcp_p95_ms'] is not None else '-'
+            speed = f"{rec['avg_speed_bps']/1024/1024:.2f} MB/s" if rec['avg_speed_bps'] is not None else '-'
+            jitter = f"{rec['game_jitter_ms']:.1f} ms" if rec['game_jitter_ms'] is not None else '-'
+            print(f"{rank:3}. {rec['score']:7.3f} {(rec['ps'] or '')[:40]:40.40} {str(rec['add']):20} {str(rec['port']):6} p95:{p95:10} speed:{speed:10} jitter:{jitter}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='VPN subscription parser + basic tests')
+    parser.add_argument('--url', '-u', nargs='+', action='extend', help='Subscription URL(s); may be repeated')
+    parser.add_argument('--url-list', help='File with subscription URLs, one per line')
+    parser.add_argument('--sub-cache', default='.sub-cache', help='Directory for the subscription cache (ETag/Last-Modified + parsed nodes)')
+    parser.add_argument('--no-sub-cache', action='store_true', help='Always download and parse subscriptions in full')
+    parser.add_argument('--fetch-workers', type=int, default=8, help='Concurrent subscription downloads')
+    parser.add_argument('--file', '-f', help='File with subscription content')
+    parser.add_argument('--stream', action='store_true', help='Parse the subscription while it downloads and start probing nodes as they arrive')
+    parser.add_argument('--stream-window', type=int, default=256, help='Nodes per scheduling window in --stream mode')
+    parser.add_argument('--output', '-o', help='Output JSON file', default='nodes.json')
+    parser.add_argument('--ndjson', help='Also append every result to this JSON Lines file as it completes (results are not kept in memory; reports are built from the file)')
+    parser.add_argument('--ndjson-fsync', choices=['always', 'batch', 'never'], default='batch', help='--ndjson durability: fsync every record, every buffer flush, or never')
+    parser.add_argument('--ndjson-buffer', type=int, default=64, help='--ndjson: results buffered before a write (also flushed after 1 s)')
+    parser.add_argument('--resume', metavar='CHECKPOINT', help='Checkpoint file (NDJSON): nodes already in it are skipped, new results are appended, reports cover both')
+    parser.add_argument('--from-ndjson', help='Do not test: build --output, the HTML report and the summary from an existing --ndjson file')
+    parser.add_argument('--timeout', type=int, default=5, help='Socket timeout seconds')
+    parser.add_argument('--workers', type=int, default=10, help='Parallel workers for tests')
+    parser.add_argument('--engine', choices=['thread', 'async'], default='thread', help='Probe engine: thread pool (one worker per node) or asyncio (thousands of nodes from one thread)')
+    parser.add_argument('--concurrency', type=int, default=512, help='Max nodes in flight for --engine async')
+    parser.add_argument('--stage-limit', action='append', default=[], metavar='STAGE=N', help=f"Per-stage concurrency, repeatable (stages: {', '.join(ASYNC_STAGE_LIMITS)}; the thread engine honours speed and game)")
+    parser.add_argument('--schedule', choices=['flat', 'funnel'], default='flat', help='flat: every test for every node; funnel: reachability pass for all nodes first, speed/game/xray only for reachable ones')
+    parser.add_argument('--reach-workers', type=int, default=128, help='Funnel: threads for the reachability pass (thread engine)')
+    parser.add_argument('--top-k', type=int, default=0, help='Funnel: run the heavy tests only on the K reachable nodes with the lowest TCP p95 (0 = all)')
+    parser.add_argument('--ping-count', type=int, default=4, help='ICMP ping count')
+    parser.add_argument('--no-resolve', action='store_true', help='Do not pre-resolve hosts; pass hostnames to every probe')
+    parser.add_argument('--dns-ttl', type=int, default=300, help='Resolver cache TTL seconds (used when record TTLs are unavailable)')
+    parser.add_argument('--dns-negative-ttl', type=int, default=30, help='How long failed lookups are cached (seconds)')
+    parser.add_argument('--ping-method', choices=['auto', 'system'], default='auto', help='auto: in-process ICMP socket for all hosts (falls back to system ping); system: fork ping per node')
+    parser.add_argument('--tcp-retries', type=int, default=10, help='Number of TCP connect attempts per node')
+    parser.add_argument('--tcp-timeout', type=int, default=3, help='TCP connect timeout seconds per attempt')
+    parser.add_argument('--no-dedup', action='store_true', help='Keep duplicate nodes (same server listed several times)')
+    parser.add_argument('--no-group-endpoints', action='store_true', help='Probe every node separately even when nodes share host/port')
+    parser.add_argument('--tcp-batch', action='store_true', help='Run all TCP connect tests up front on one non-blocking selector loop')
+    parser.add_argument('--tcp-max-inflight', type=int, default=1024, help='Max simultaneously pending connects for --tcp-batch')
+    parser.add_argument('--detailed', action='store_true', help='Write more detailed JSON output')
+    parser.add_argument('--compact', action='store_true', help='Keep nodes and results in compact slotted records (lower memory on huge runs)')
+    parser.add_argument('--do-speed', action='store_true', help='Run HTTP download speed test to --speed-url')
+    parser.add_argument('--speed-url', default='http://speedtest.tele2.net/5MB.zip', help='URL for download speed test')
+    parser.add_argument('--speed-duration', type=int, default=10, help='Duration sec for speed test')
+    parser.add_argument('--speed-concurrency', type=int, default=1, help='Concurrent workers for speed test')
+    parser.add_argument('--do-latency', action='store_true', help='Measure HTTP round trips through each node (first-request TTFB and steady RTT on one kept-alive connection)')
+    parser.add_argument('--latency-url', default='http://www.gstatic.com/generate_204', help='Small (ideally 204) endpoint for --do-latency')
+    parser.add_argument('--latency-count', type=int, default=5, help='Requests per node for --do-latency (the first one pays the handshake)')
+    parser.add_argument('--latency-local', action='store_true', help='Start the local speed server and use its /204 endpoint for --do-latency (offline testing)')
+    parser.add_argument('--do-upload', action='store_true', help='Run HTTP upload speed test to --upload-url (same duration/concurrency as the download test)')
+    parser.add_argument('--upload-url', default='http://speedtest.tele2.net/upload.php', help='URL that accepts POST bodies for the upload test (the local speed server is used when it runs)')
+    parser.add_argument('--speed-warmup', type=float, default=1.0, help='Seconds at the start of the speed test left out of avg/peak (TCP slow start)')
+    parser.add_argument('--adaptive', action='store_true', help='Stop probing a node once its verdict is settled (dead after a failure streak, or stable loss/p95; speed stops when throughput converges)')
+    parser.add_argument('--adaptive-fail-streak', type=int, default=ADAPTIVE_DEFAULTS['fail_streak'], help='Adaptive: consecutive failures (with no success) that mark a node dead')
+    parser.add_argument('--adaptive-speed-tol', type=float, default=ADAPTIVE_DEFAULTS['speed_tol'] * 100, help='Adaptive: stop the speed test when recent throughput samples agree within this percent')
+    parser.add_argument('--do-game', action='store_true', help='Run UDP gaming simulation (requires --udp-target host:port)')
+    parser.add_argument('--udp-target', help='UDP target host:port for gaming test')
+    parser.add_argument('--game-duration', type=int, default=5, help='Duration sec for game test')
+    parser.add_argument('--game-psize', type=int, default=60, help='Packet size for game test (bytes)')
+    parser.add_argument('--game-interval', type=float, default=20, help='Interval ms between game packets (fractions allowed for high packet rates)')
+    parser.add_argument('--game-batch', type=int, default=0, help='Thread engine: run the game tests of up to N concurrent workers in one shared UDP loop (0 = each worker on its own)')
+    parser.add_argument('--expect-echo', action='store_true', help='The --udp-target echoes packets back: measure RTT, loss, jitter and reordering')
+    parser.add_argument('--udp-echo-server', action='store_true', help='Start a local UDP echo server and use it as --udp-target (implies --expect-echo)')
+    parser.add_argument('--no-progress', action='store_true', help='Disable progress bar output')
+    parser.add_argument('--start-xray', action='store_true', help='Start xray locally and proxy tests through it (requires --xray-path)')
+    parser.add_argument('--xray-path', default='xray', help='Path to xray binary')
+    parser.add_argument('--xray-mode', choices=['node', 'batch', 'pool'], default='node', help='node: one xray process per node; batch: one shared process per --xray-batch-size nodes; pool: --workers pre-warmed processes, outbound swapped via the xray API')
+    parser.add_argument('--xray-recycle-after', type=int, default=100, help='Restart a pooled xray worker after this many nodes (--xray-mode pool)')
+    parser.add_argument('--check-outbounds', action='store_true', help='Translate every node to an xray outbound, validate them with `xray run -test` (--xray-path) and exit')
+    parser.add_argument('--xray-batch-size', type=int, default=50, help='Nodes per shared xray process for --xray-mode batch')
+    parser.add_argument('--html-output', help='Generate HTML report (path). If a filename only is passed, it will be written into --reports-dir', default=None)
+    parser.add_argument('--reports-dir', default='reports', help='Directory to save timestamped reports when --html-output is not provided')
+    parser.add_argument('--open-report', action='store_true', help='Open generated HTML report in the default browser')
+    parser.add_argument('--no-html', action='store_true', help='Do not generate an HTML report')
+    parser.add_argument('--serve-speed-size', type=int, default=0, help='Serve a synthetic payload of given MB from memory for speed tests (0 = off)')
+    parser.add_argument('--speed-file', help='Path to a local file to serve for speed tests (overrides --speed-url)')
+    parser.add_argument('--history', help='SQLite file to record every result in (keyed by canonical node identity)')
+    parser.add_argument('--incremental', action='store_true', help='Use --history to skip or lighten tests for nodes whose state is known')
+    parser.add_argument('--healthy-window', type=int, default=3600, help='Incremental: nodes OK within this many seconds get a single TCP probe')
+    parser.add_argument('--full-interval', type=int, default=21600, help='Incremental: always fully re-test a node after this many seconds')
+    parser.add_argument('--dead-backoff', type=int, default=900, help='Incremental: first re-check delay for a failing node (doubles per failure)')
+    parser.add_argument('--dead-backoff-max', type=int, default=86400, help='Incremental: maximum re-check delay for a failing node')
+    parser.add_argument('--top', type=int, default=0, help='Print (and add to --output) the N best nodes by score')
+    parser.add_argument('--top-by', choices=['all', 'protocol', 'region', 'tag'], default='all', help='--top: rank overall or separately per protocol, region (flag/country code in the name) or [tag]')
+    parser.add_argument('--rank-weights', default='', metavar='METRIC=W,...', help=f"Score weights (metrics: {', '.join(RANK_WEIGHTS)}; default 1 each, 0 disables a metric)")
+    parser.add_argument('--serve', metavar='[HOST:]PORT', help='Daemon mode: sweep every --sweep-interval seconds and serve /best, /nodes, /metrics and /health on this address')
+    parser.add_argument('--sweep-interval', type=int, default=600, help='--serve: seconds between sweep starts')
+    parser.add_argument('--no-summary', action='store_true', help='Do not print overall progress summary')
+    args = parser.parse_args()
+    try:
+        stage_limits = parse_stage_limits(args.stage_limit)
+    except ValueError as e:
+        parser.error(str(e))
+    if args.incremental and not args.history:
+        parser.error('--incremental requires --history')
+    try:
+        parse_rank_weights(args.rank_weights)
+    except ValueError as e:
+        parser.error(str(e))
+    if args.serve and (args.resume or args.from_ndjson):
+        parser.error('--serve cannot be combined with --resume or --from-ndjson')
+    if args.resume:
+        if args.ndjson and args.ndjson != args.resume:
+            parser.error('--resume writes its own NDJSON checkpoint; drop --ndjson or pass the same file')
+        args.ndjson = args.resume
+    DNS_CACHE.ttl = args.dns_ttl
+    DNS_CACHE.negative_ttl = args.dns_negative_ttl
+
+    urls = list(args.url or [])
+    if args.url_list:
+        urls.extend(read_url_list(args.url_list))
+    if args.from_ndjson:
+        report_results(args, NdjsonResults(args.from_ndjson))
+        return
+    if not (urls or args.file):
+        print('Please provide --url, --url-list, --file or --from-ndjson', file=sys.stderr)
+        sys.exit(1)
+    nodes = load_nodes(args, urls)
+
+    if args.resume:
+        done_keys = load_checkpoint(args.resume)
+        if done_keys:
+            nodes = skip_done(nodes, done_keys)
+            print(f'Resuming from {args.resume}: {len(done_keys)} nodes already tested')
+        # preemption (SIGTERM) unwinds like Ctrl-C so the checkpoint gets flushed
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+
+    if args.check_outbounds:
+        report = check_outbounds(nodes, xray_path=args.xray_path)
+        for node in report['unsupported']:
+            print(f"unsupported: {node.get('protocol')} {(node.get('ps') or node.get('raw') or '')[:60]}")
+        for node, output in report['invalid']:
+            print(f"invalid: {(node.get('ps') or node.get('raw') or '')[:60]}: {output.splitlines()[-1] if output else ''}")
+        print(f"Outbounds: {report['ok']} ok, {len(report['unsupported'])} unsupported, {len(report['invalid'])} rejected by xray")
+        return
+
+    # prepare local speed server if requested
+    local_server = None
+    if args.serve_speed_size and args.serve_speed_size > 0:
+        # synthetic body of the given MB, generated in memory (no file on disk)
+        httpd, url = start_speed_server(size=args.serve_speed_size * 1024 * 1024)
+        local_server = httpd
+        print(f'Serving local speed payload at {url}')
+        args.speed_url = url
+        args.upload_url = urljoin(url, '/upload')
+    elif args.speed_file:
+        if os.path.exists(args.speed_file):
+            httpd, url = start_local_http_server(args.speed_file)
+            local_server = httpd
+            print(f'Serving provided file at {url}')
+            args.speed_url = url
+            args.upload_url = urljoin(url, '/upload')
+        else:
+            print('Specified --speed-file does not exist, falling back to --speed-url')
+    if args.latency_local:
+        if local_server is None:
+            local_server, url = start_speed_server()
+            print(f'Serving local latency endpoint at {url}')
+        args.latency_url = urljoin(url, '/204')
+
+    # local UDP echo target for the game test
+    echo_server = None
+    if args.udp_echo_server:
+        echo_server, args.udp_target = start_udp_echo_server()
+        args.expect_echo = True
+        print(f'UDP echo server on {args.udp_target}')
+
+    test_kwargs = test_kwargs_from_args(args, stage_limits)
+    if args.schedule == 'funnel':
+        runner = functools.partial(funnel_test_nodes, top_k=args.top_k, reach_workers=args.reach_workers)
+    else:
+        runner = test_nodes
 
+    if args.serve:
+        try:
+            serve(args, urls, nodes, runner, test_kwargs)
+        finally:
+            if local_server:
+                stop_local_http_server(local_server)
+            if echo_server:
+                echo_server.close()
+        return
+
+    # overall progress monitoring (total is unknown while streaming)
+    total = len(nodes) if isinstance(nodes, list) else None
+    completed = {'count': 0}
+    lock = threading.Lock()
+    writer = NdjsonWriter(args.ndjson, buffer_records=args.ndjson_buffer, fsync=args.ndjson_fsync, append=bool(args.resume)) if args.ndjson else None
+    # resumed runs rank from the whole checkpoint in report_results instead
+    index = RankingIndex(score=make_scorer(parse_rank_weights(args.rank_weights))) if args.top and not args.resume else None
+
+    def on_node(r):
+        if writer:
+            writer.write(r)
+        if index is not None:
+            index.update(r)
+        with lock:
+            completed['count'] += 1
+
+    monitor_thread = None
+    stop_monitor = {'stop': False}
+    def monitor():
+        while not stop_monitor['stop']:
+            with lock:
+                c = completed['count']
+            print(f'Progress: {c}/{total if total is not None else "?"}', end='\r', flush=True)
+            if total is not None and c >= total:
+                break
+            time.sleep(1)
+        print()  # newline at the end
+
+    if not args.no_summary:
+        monitor_thread = threading.Thread(target=monitor, daemon=True)
+        monitor_thread.start()
+
+    # run tests
+    history = HistoryStore(args.history) if args.history else None
+    try:
+        if history and args.incremental:
+            tested = incremental_test_nodes(nodes, history, on_node_complete=on_node, policy=incremental_policy_from_args(args), runner=runner, **test_kwargs)
+        else:
+            def on_tested(r):
+                if history:
+                    history.record(r)
+                on_node(r)
+            tested = runner(nodes, on_node_complete=on_tested, **test_kwargs)
+    except KeyboardInterrupt:
+        stop_monitor['stop'] = True
+        kept = f'; finished nodes are in {args.ndjson}' if writer else ''
+        if monitor_thread:
+            print()  # end the progress line
+        print(f"Interrupted after {completed['count']} nodes{kept}", file=sys.stderr)
+        sys.exit(130)
+    finally:
+        # an interrupted run keeps everything that finished
+        if writer:
+            writer.close()
+        if history:
+            history.close()
+        # stop local servers if we started them
+        if local_server:
+            stop_local_http_server(local_server)
+        if echo_server:
+            echo_server.close()
+    if writer:
+        tested = NdjsonResults(args.ndjson)
+
+    stop_monitor['stop'] = True
+    if monitor_thread:
+        monitor_thread.join(timeout=2)
+    if args.stream:
+        print(f'Tested {len(tested)} nodes')
+
+    report_results(args, tested, index=index)
 
 if __name__ == '__main__':
-    main()
+    try:
+        main()
+    except KeyboardInterrupt:
+        print('Interrupted', file=sys.stderr)
+        sys.exit(130)
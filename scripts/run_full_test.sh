@@ -14,8 +14,18 @@ if [ "$#" -lt 1 ]; then
 fi
 
 URL="$1"
-UDP_TARGET="${2:-}"
-OUTPUT="${3:-nodes_full.json}"
+shift
+# optional positionals stop at the first option, the rest goes to main.py
+UDP_TARGET=""
+if [ "$#" -gt 0 ] && [[ $1 != -* ]]; then
+  UDP_TARGET="$1"
+  shift
+fi
+OUTPUT="nodes_full.json"
+if [ "$#" -gt 0 ] && [[ $1 != -* ]]; then
+  OUTPUT="$1"
+  shift
+fi
 HTML_OUTPUT="report.html"
 
 CMD=("$PYTHON_BIN" "$MAIN" --url "$URL" --output "$OUTPUT" --do-speed --speed-duration "${SPEED_DURATION:-10}" --speed-concurrency "${SPEED_CONCURRENCY:-1}" --start-xray --html-output "$HTML_OUTPUT" --open-report)
@@ -15,7 +15,12 @@ fi
 
 URL="$1"
 UDP_TARGET="$2"
-OUTPUT="${3:-nodes_game.json}"
+shift 2
+OUTPUT="nodes_game.json"
+if [ "$#" -gt 0 ] && [[ $1 != -* ]]; then
+  OUTPUT="$1"
+  shift
+fi
 GAME_DURATION="${GAME_DURATION:-5}"
 GAME_PSIZE="${GAME_PSIZE:-60}"
 GAME_INTERVAL="${GAME_INTERVAL:-20}"
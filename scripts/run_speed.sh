@@ -17,7 +17,12 @@ if [ "$#" -lt 1 ]; then
 fi
 
 URL="$1"
-OUTPUT="${2:-nodes_speed.json}"
+shift
+OUTPUT="nodes_speed.json"
+if [ "$#" -gt 0 ] && [[ $1 != -* ]]; then
+  OUTPUT="$1"
+  shift
+fi
 SPEED_URL="${SPEED_URL:-http://speedtest.tele2.net/5MB.zip}"
 SPEED_DURATION="${SPEED_DURATION:-10}"
 SPEED_CONCURRENCY="${SPEED_CONCURRENCY:-1}"
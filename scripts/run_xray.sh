@@ -15,6 +15,11 @@ if [ "$#" -lt 1 ]; then
 fi
 
 URL="$1"
-OUTPUT="${2:-nodes_xray.json}"
+shift
+OUTPUT="nodes_xray.json"
+if [ "$#" -gt 0 ] && [[ $1 != -* ]]; then
+  OUTPUT="$1"
+  shift
+fi
 
 exec "$PYTHON_BIN" "$MAIN" --url "$URL" --output "$OUTPUT" --start-xray --xray-path "$XRAY_PATH" "$@"
@@ -15,6 +15,11 @@ fi
 
 URL="$1"
 MB="$2"
-OUTPUT="${3:-nodes_speed_local.json}"
+shift 2
+OUTPUT="nodes_speed_local.json"
+if [ "$#" -gt 0 ] && [[ $1 != -* ]]; then
+  OUTPUT="$1"
+  shift
+fi
 
 exec "$PYTHON_BIN" "$MAIN" --url "$URL" --output "$OUTPUT" --do-speed --serve-speed-size "$MB" --speed-duration "${SPEED_DURATION:-10}" --speed-concurrency "${SPEED_CONCURRENCY:-1}" "$@"
@@ -0,0 +1,244 @@
+import socket
+import sys
+import threading
+
+import pytest
+
+import main
+
+
+def frame(ftype, flags, stream, payload):
+    return len(payload).to_bytes(3, 'big') + bytes([ftype, flags]) + stream.to_bytes(4, 'big') + payload
+
+
+def hpack_literal(name, value):
+    return b'\x00' + bytes([len(name)]) + name + bytes([len(value)]) + value
+
+
+def decode_request_headers(block):
+    """Decode the HPACK forms H2GrpcChannel emits (static indexed and non-Huffman literals)."""
+    static = {1: ':authority', 3: (':method', 'POST'), 4: ':path', 6: (':scheme', 'http'), 31: 'content-type'}
+    headers, i = {}, 0
+
+    def string():
+        nonlocal i
+        size = block[i] & 0x7f
+        i += 1
+        value = block[i:i + size].decode()
+        i += size
+        return value
+
+    while i < len(block):
+        b = block[i]
+        if b & 0x80:
+            name, value = static[b & 0x7f]
+            i += 1
+        else:
+            index = b & 0x0f
+            i += 1
+            if index == 15:
+                index += block[i]
+                i += 1
+            name = static[index] if index else string()
+            value = string()
+        headers[name] = value
+    return headers
+
+
+class HandlerStub:
+    """Loopback h2c server speaking just enough gRPC for HandlerService unary calls."""
+
+    def __init__(self, fail=()):
+        self.fail = set(fail)
+        self.calls = []
+        self.pings_acked = 0
+        self.listener = socket.create_server(('127.0.0.1', 0))
+        self.port = self.listener.getsockname()[1]
+        threading.Thread(target=self._serve, daemon=True).start()
+
+    def _serve(self):
+        while True:
+            try:
+                conn, _ = self.listener.accept()
+            except OSError:
+                return
+            threading.Thread(target=self._conn, args=(conn,), daemon=True).start()
+
+    def _conn(self, conn):
+        buf = b''
+
+        def read(n):
+            nonlocal buf
+            while len(buf) < n:
+                chunk = conn.recv(65536)
+                if not chunk:
+                    raise ConnectionError
+                buf += chunk
+            data, buf = buf[:n], buf[n:]
+            return data
+
+        try:
+            assert read(24) == main.H2GrpcChannel.PREFACE
+            # server SETTINGS and a PING the client has to answer
+            conn.sendall(frame(4, 0, 0, b'\x00\x03\x00\x00\x00\x64') + frame(6, 0, 0, b'12345678'))
+            headers = {}
+            while True:
+                head = read(9)
+                size, ftype, flags = int.from_bytes(head[:3], 'big'), head[3], head[4]
+                stream = int.from_bytes(head[5:9], 'big')
+                payload = read(size)
+                if ftype == 6 and flags & 1:
+                    self.pings_acked += 1
+                elif ftype == 1:
+                    headers[stream] = decode_request_headers(payload)
+                elif ftype == 0 and flags & 1:
+                    h = headers.pop(stream)
+                    method = h[':path'].rsplit('/', 1)[1]
+                    self.calls.append((method, payload[5:5 + int.from_bytes(payload[1:5], 'big')], h))
+                    if method in self.fail:
+                        conn.sendall(frame(1, 0x5, stream, b'\x88' + hpack_literal(b'grpc-status', b'2') + hpack_literal(b'grpc-message', b'failed')))
+                    else:
+                        conn.sendall(frame(1, 0x4, stream, b'\x88' + hpack_literal(b'content-type', b'application/grpc'))
+                                     + frame(0, 0, stream, b'\x00\x00\x00\x00\x00')
+                                     + frame(1, 0x5, stream, hpack_literal(b'grpc-status', b'0')))
+        except (OSError, AssertionError):
+            pass
+        finally:
+            conn.close()
+
+    def close(self):
+        self.listener.close()
+
+
+@pytest.fixture
+def stub():
+    server = HandlerStub()
+    yield server
+    server.close()
+
+
+@pytest.fixture(autouse=True)
+def no_grpcio(monkeypatch):
+    # exercise the built-in HTTP/2 client even where grpcio is installed
+    monkeypatch.setattr(main, 'grpc', None)
+
+
+OUTBOUND_PB = main._pb_bytes(1, b'out-7') + main._pb_bytes(3, main._pb_bytes(1, b'xray.proxy.vless.outbound.Config') + main._pb_bytes(2, b'\x01\x02'))
+
+
+def test_remove_and_add_outbound(stub):
+    client = main.HandlerClient(stub.port)
+    assert client.remove_outbound('node') is True
+    assert client.add_outbound(main.retag_outbound_pb(OUTBOUND_PB, 'node')) is True
+    client.close()
+    (m1, p1, h1), (m2, p2, h2) = stub.calls
+    assert (m1, p1) == ('RemoveOutbound', b'\x0a\x04node')
+    assert m2 == 'AddOutbound'
+    (field, _, handler, _), = main._pb_fields(p2)
+    assert field == 1
+    fields = {f: v for f, _, v, _ in main._pb_fields(handler)}
+    assert fields[1] == b'node' and fields[3] == dict((f, v) for f, _, v, _ in main._pb_fields(OUTBOUND_PB))[3]
+    assert h2[':path'] == '/xray.app.proxyman.command.HandlerService/AddOutbound'
+    assert h2['content-type'] == 'application/grpc' and h2['te'] == 'trailers'
+    assert stub.pings_acked == 1
+
+
+def test_error_status_is_false_and_connection_reused():
+    server = HandlerStub(fail={'RemoveOutbound'})
+    try:
+        client = main.HandlerClient(server.port)
+        assert client.remove_outbound('node') is False
+        assert client.add_outbound(OUTBOUND_PB) is True
+        assert [c[0] for c in server.calls] == ['RemoveOutbound', 'AddOutbound']
+        assert server.pings_acked == 1  # one connection for both calls
+        client.close()
+    finally:
+        server.close()
+
+
+def test_unreachable_api_is_none():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    assert main.HandlerClient(port, timeout=1).remove_outbound('node') is None
+
+
+def test_worker_swap_uses_handler_api(stub, tmp_path):
+    worker = main.XrayWorker()
+    worker.tmpdir = str(tmp_path)
+    worker.api = main.HandlerClient(stub.port)
+    assert worker.swap({'protocol': 'vless', 'settings': {}}, OUTBOUND_PB) is True
+    assert worker.uses == 1
+    assert [c[0] for c in stub.calls] == ['RemoveOutbound', 'AddOutbound']
+    worker.api.close()
+
+
+def test_convert_outbounds_pb(tmp_path):
+    # `xray convert pb` stand-in: core.Config with one OutboundHandlerConfig per outbound
+    script = tmp_path / 'xray'
+    script.write_text(f"""#!{sys.executable}
+import json, sys
+sys.path.insert(0, {str(main.__file__.rsplit('/', 1)[0])!r})
+import main
+assert sys.argv[1:3] == ['convert', 'pb']
+cfg = json.load(open(sys.argv[3]))
+out = b''.join(main._pb_bytes(2, main._pb_bytes(1, ob['tag'].encode()) + main._pb_bytes(3, ob['protocol'].encode())) for ob in cfg['outbounds'])
+sys.stdout.buffer.write(main._pb_bytes(4, b'app') + out)
+""")
+    script.chmod(0o755)
+    converted = main.convert_outbounds_pb([{'tag': 'out-0', 'protocol': 'vless'}, {'tag': 'out-1', 'protocol': 'trojan'}], xray_path=str(script))
+    assert sorted(converted) == ['out-0', 'out-1']
+    assert dict((f, v) for f, _, v, _ in main._pb_fields(converted['out-1']))[3] == b'trojan'
+    with pytest.raises(RuntimeError):
+        main.convert_outbounds_pb([{'tag': 'out-0'}], xray_path=str(tmp_path / 'missing'))
+
+
+def test_pool_converts_registered_outbounds_in_batches(monkeypatch):
+    batches = []
+
+    def convert(outbounds, xray_path='xray', timeout=15):
+        batches.append([ob['tag'] for ob in outbounds])
+        return {ob['tag']: main._pb_bytes(1, ob['tag'].encode()) for ob in outbounds}
+
+    monkeypatch.setattr(main, 'convert_outbounds_pb', convert)
+    monkeypatch.setattr(main.XrayWorker, 'start', lambda self: False)
+    pool = main.XrayPoolProvider(xray_path='xray', size=1, convert_batch=4)
+    nodes = [{'protocol': 'trojan', 'add': '192.0.2.1', 'port': '443', 'password': f'pw{i}', 'net': 'tcp', 'raw': f'trojan://pw{i}@192.0.2.1:443'} for i in range(6)]
+    tickets = [pool.register(n, None) for n in nodes]
+    assert all(pool._outbound_pb(*t) for t in tickets)
+    assert [len(b) for b in batches] == [4, 2]
+
+
+def test_pool_conversion_runs_outside_the_lock(monkeypatch):
+    started, finish = threading.Event(), threading.Event()
+    calls = []
+
+    def convert(outbounds, xray_path='xray', timeout=15):
+        calls.append(len(outbounds))
+        started.set()
+        assert finish.wait(5)
+        return {ob['tag']: main._pb_bytes(1, ob['tag'].encode()) for ob in outbounds}
+
+    monkeypatch.setattr(main, 'convert_outbounds_pb', convert)
+    monkeypatch.setattr(main.XrayWorker, 'start', lambda self: False)
+    pool = main.XrayPoolProvider(xray_path='xray', size=1, convert_batch=2)
+    nodes = [{'protocol': 'trojan', 'add': '192.0.2.1', 'port': '443', 'password': f'pw{i}', 'net': 'tcp', 'raw': f'trojan://pw{i}@192.0.2.1:443'} for i in range(3)]
+    cached, first, second = [pool.register(n, None) for n in nodes]
+    pool._pb[(nodes[0]['raw'], None)] = b'cached'
+    pool._pending.pop((nodes[0]['raw'], None))
+    results = {}
+    t1 = threading.Thread(target=lambda: results.setdefault('first', pool._outbound_pb(*first)))
+    t1.start()
+    assert started.wait(5)
+    # a cache hit does not wait for the running `xray convert pb`
+    assert pool._outbound_pb(*cached) == b'cached'
+    # a node in the running batch waits for that batch instead of converting again
+    t2 = threading.Thread(target=lambda: results.setdefault('second', pool._outbound_pb(*second)))
+    t2.start()
+    t2.join(0.2)
+    assert t2.is_alive()
+    finish.set()
+    t1.join(5)
+    t2.join(5)
+    assert calls == [2]
+    assert results['first'] and results['second'] and not pool._inflight
@@ -0,0 +1,160 @@
+import asyncio
+import socket
+import threading
+from urllib.parse import urljoin, urlparse
+
+import pytest
+
+import main
+
+
+class HttpProxyStub:
+    """Loopback forward proxy for plain http: takes absolute-URI requests on a kept-alive
+    client connection and relays each one over a single upstream connection.
+    """
+
+    def __init__(self):
+        self.connections = 0
+        self.requests = []
+        self.listener = socket.create_server(('127.0.0.1', 0))
+        self.url = f'http://127.0.0.1:{self.listener.getsockname()[1]}'
+        threading.Thread(target=self._serve, daemon=True).start()
+
+    def _serve(self):
+        while True:
+            try:
+                conn, _ = self.listener.accept()
+            except OSError:
+                return
+            self.connections += 1
+            threading.Thread(target=self._session, args=(conn,), daemon=True).start()
+
+    def _session(self, conn):
+        upstream = None
+        try:
+            buf = b''
+            while True:
+                while b'\r\n\r\n' not in buf:
+                    chunk = conn.recv(4096)
+                    if not chunk:
+                        return
+                    buf += chunk
+                head, _, buf = buf.partition(b'\r\n\r\n')
+                method, url, _ = head.split(b'\r\n', 1)[0].decode().split(' ', 2)
+                self.requests.append(url)
+                u = urlparse(url)
+                if upstream is None:
+                    upstream = socket.create_connection((u.hostname, u.port), timeout=5)
+                upstream.sendall(f'{method} {u.path or "/"} HTTP/1.1\r\nHost: {u.netloc}\r\n\r\n'.encode())
+                status, headers, rest = main._read_http_head(upstream)
+                left = main._response_body_left(status, headers, rest) or 0
+                body = rest + (main._recv_exact(upstream, left) if left else b'')
+                head = f'HTTP/1.1 {status} X\r\n' + ''.join(f'{k}: {v}\r\n' for k, v in headers.items() if not k.startswith(':'))
+                conn.sendall(head.encode() + b'\r\n' + body)
+        except Exception:
+            pass
+        finally:
+            conn.close()
+            if upstream is not None:
+                upstream.close()
+
+    def close(self):
+        self.listener.close()
+
+
+class ClosingServer:
+    """Answers every request with a 204 and `Connection: close`."""
+
+    def __init__(self):
+        self.listener = socket.create_server(('127.0.0.1', 0))
+        self.url = f'http://127.0.0.1:{self.listener.getsockname()[1]}/204'
+        threading.Thread(target=self._serve, daemon=True).start()
+
+    def _serve(self):
+        while True:
+            try:
+                conn, _ = self.listener.accept()
+            except OSError:
+                return
+            with conn:
+                try:
+                    data = b''
+                    while b'\r\n\r\n' not in data:
+                        chunk = conn.recv(4096)
+                        if not chunk:
+                            raise ConnectionError('closed')
+                        data += chunk
+                    conn.sendall(b'HTTP/1.1 204 No Content\r\nConnection: close\r\n\r\n')
+                except Exception:
+                    pass
+
+    def close(self):
+        self.listener.close()
+
+
+@pytest.fixture
+def url_204():
+    httpd, url = main.start_speed_server(size=1024)
+    yield urljoin(url, '/204')
+    main.stop_local_http_server(httpd)
+
+
+@pytest.fixture
+def proxy():
+    stub = HttpProxyStub()
+    yield stub
+    stub.close()
+
+
+def check_kept_alive(res, count):
+    assert res['ok'] and res['errors'] == 0 and res['reconnects'] == 0
+    assert res['requests'] == count and res['status_codes'] == {204: count}
+    assert len(res['rtts']) == count - 1
+    assert res['connect_ms'] <= res['ttfb_ms']
+    assert res['min'] <= res['p50'] <= res['max']
+
+
+def test_direct(url_204):
+    res = main.http_latency_test(url_204, count=6)
+    assert res['via'] == 'direct'
+    check_kept_alive(res, 6)
+
+
+def test_through_http_proxy(url_204, proxy):
+    res = main.http_latency_test(url_204, proxy=proxy.url, count=5)
+    assert res['via'] == 'proxy'
+    check_kept_alive(res, 5)
+    assert proxy.connections == 1 and proxy.requests == [url_204] * 5
+
+
+def test_async_through_http_proxy(url_204, proxy):
+    res = asyncio.run(main.async_http_latency_test(url_204, proxy=proxy.url, count=4))
+    assert res['via'] == 'proxy'
+    check_kept_alive(res, 4)
+    assert proxy.connections == 1
+
+
+def test_single_request_has_no_rtts(url_204):
+    res = main.http_latency_test(url_204, count=1)
+    assert res['ok'] and res['rtts'] == [] and res['avg'] is None
+
+
+def test_reconnects_when_server_closes():
+    srv = ClosingServer()
+    try:
+        res = main.http_latency_test(srv.url, count=4)
+        assert res['ok'] and res['errors'] == 0
+        assert res['reconnects'] == 3 and len(res['rtts']) == 3
+    finally:
+        srv.close()
+
+
+def test_dead_proxy_is_not_ok(url_204):
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    for res in (main.http_latency_test(url_204, proxy=f'http://127.0.0.1:{port}', count=3, timeout=2),
+                asyncio.run(main.async_http_latency_test(url_204, proxy=f'http://127.0.0.1:{port}', count=3, timeout=2))):
+        assert not res['ok'] and res['requests'] == 0 and res['errors'] == 1
+        assert res['connect_ms'] is None and res['p95'] is None
@@ -0,0 +1,22 @@
+import main
+
+LINK = 'vless://uuid@h.example:443?type=grpc&security=reality&sni=a.example&pbk=K&sid=ab&spx=%2F&flow=xtls-rprx-vision#n1'
+
+
+def test_node_lookups():
+    node = main.Node.from_dict(main.parse_link(LINK))
+    assert node.extra == {'spx': '/'}
+    assert node['pbk'] == 'K' and node.get('spx') == '/' and node.get('path', '-') == '-'
+    assert 'sni' in node and 'spx' in node
+    assert 'path' not in node and 'plugin' not in node
+    assert node.to_dict() == {k: v for k, v in main.parse_link(LINK).items() if v is not None}
+
+
+def test_node_result_lookups():
+    node = main.Node.from_dict(main.parse_link(LINK))
+    res = main.NodeResult.from_result(node, {**node, 'ping': {'rtts': [1.0, 2.0], 'avg': 1.5}, 'tcp': None, 'reachable': True})
+    assert res['ping']['avg'] == 1.5 and res.get('ping').get('rtts') == [1.0, 2.0]
+    assert res['tcp'] is None and res.get('tcp', 'none') == 'none'
+    assert res['reachable'] is True and res['add'] == 'h.example' and res.get('speed') is None
+    other = main.NodeResult.from_result(node, {**node, 'tcp': {'ok': 1}, 'ping': None, 'reachable': False})
+    assert other['tcp']['ok'] == 1 and other['ping'] is None
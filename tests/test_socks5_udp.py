@@ -0,0 +1,151 @@
+import asyncio
+import select
+import socket
+import struct
+import threading
+
+import pytest
+
+import main
+
+
+class Socks5UdpRelayStub:
+    """Loopback SOCKS5 server that only implements UDP ASSOCIATE (no auth): the relay
+    forwards client datagrams to the address in their header and wraps the replies.
+    With `refuse` every request is answered with code 7 (command not supported).
+    """
+
+    def __init__(self, refuse=False, bound_unspecified=False):
+        self.refuse = refuse
+        self.bound_unspecified = bound_unspecified
+        self.relayed = 0
+        self.listener = socket.create_server(('127.0.0.1', 0))
+        self.port = self.listener.getsockname()[1]
+        threading.Thread(target=self._serve, daemon=True).start()
+
+    def _serve(self):
+        while True:
+            try:
+                conn, _ = self.listener.accept()
+            except OSError:
+                return
+            threading.Thread(target=self._session, args=(conn,), daemon=True).start()
+
+    def _session(self, conn):
+        relay = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        relay.bind(('127.0.0.1', 0))
+        try:
+            ver, n = conn.recv(2)
+            conn.recv(n)
+            conn.sendall(b'\x05\x00')
+            req = conn.recv(262)
+            if self.refuse or req[1] != 3:
+                conn.sendall(b'\x05\x07\x00\x01' + bytes(6))
+                return
+            bound = b'\x00\x00\x00\x00' if self.bound_unspecified else socket.inet_aton('127.0.0.1')
+            conn.sendall(b'\x05\x00\x00\x01' + bound + struct.pack('!H', relay.getsockname()[1]))
+            client = None
+            while True:
+                ready, _, _ = select.select([conn, relay], [], [], 5)
+                if conn in ready or not ready:
+                    return  # control connection closed (or idle): the association ends
+                data, addr = relay.recvfrom(65535)
+                if addr[1] != relay.getsockname()[1] and client in (None, addr) and data[:3] == b'\x00\x00\x00':
+                    client = addr
+                    payload = main.Socks5UdpAssociation.unwrap(data)
+                    host, port = self._dest(data)
+                    relay.sendto(payload, (host, port))
+                    self.relayed += 1
+                else:
+                    relay.sendto(main.Socks5UdpAssociation.header(addr[0], addr[1]) + data, client)
+        except OSError:
+            pass
+        finally:
+            relay.close()
+            conn.close()
+
+    @staticmethod
+    def _dest(data):
+        atyp = data[3]
+        if atyp == 1:
+            return socket.inet_ntoa(data[4:8]), struct.unpack('!H', data[8:10])[0]
+        if atyp == 3:
+            n = data[4]
+            return data[5:5 + n].decode(), struct.unpack('!H', data[5 + n:7 + n])[0]
+        return socket.inet_ntop(socket.AF_INET6, data[4:20]), struct.unpack('!H', data[20:22])[0]
+
+    @property
+    def url(self):
+        return f'socks5://127.0.0.1:{self.port}'
+
+    def close(self):
+        self.listener.close()
+
+
+@pytest.fixture
+def echo():
+    srv, target = main.start_udp_echo_server()
+    host, port = target.rsplit(':', 1)
+    yield host, int(port)
+    srv.close()
+
+
+@pytest.fixture
+def relay():
+    stub = Socks5UdpRelayStub()
+    yield stub
+    stub.close()
+
+
+@pytest.mark.parametrize('host', ['192.0.2.7', '2001:db8::7', 'game.example'])
+def test_header_round_trip(host):
+    datagram = main.Socks5UdpAssociation.header(host, 27015) + b'payload'
+    assert main.Socks5UdpAssociation.unwrap(datagram) == b'payload'
+    assert Socks5UdpRelayStub._dest(datagram) == (host, 27015)
+
+
+def test_unwrap_rejects_fragments_and_garbage():
+    assert main.Socks5UdpAssociation.unwrap(b'\x00\x00\x01\x01' + bytes(6) + b'x') is None
+    assert main.Socks5UdpAssociation.unwrap(b'\x00\x00') is None
+    assert main.Socks5UdpAssociation.unwrap(b'\x00\x00\x00\x09' + bytes(8)) is None
+
+
+def test_game_test_through_relay(echo, relay):
+    res = main.udp_game_test(*echo, duration=0.4, interval_ms=10, expect_echo=True, proxy=relay.url)
+    assert res['via'] == 'proxy'
+    assert res['sent'] > 0 and res['received'] == res['sent']
+    assert relay.relayed == res['sent']
+
+
+def test_unspecified_bound_address_means_proxy_host(echo):
+    stub = Socks5UdpRelayStub(bound_unspecified=True)
+    try:
+        assoc = main.Socks5UdpAssociation(stub.url)
+        assert assoc.relay[0] == '127.0.0.1'
+        assoc.close()
+        res = main.udp_game_test(*echo, duration=0.2, interval_ms=20, expect_echo=True, proxy=stub.url)
+        assert res['received'] == res['sent'] > 0
+    finally:
+        stub.close()
+
+
+def test_async_game_test_through_relay(echo, relay):
+    res = asyncio.run(main.async_udp_game_test(*echo, duration=0.3, interval_ms=10, expect_echo=True, proxy=relay.url))
+    assert res['via'] == 'proxy' and res['received'] == res['sent'] > 0
+
+
+def test_refused_association_gives_none(echo):
+    stub = Socks5UdpRelayStub(refuse=True)
+    try:
+        with pytest.raises(ConnectionError):
+            main.Socks5UdpAssociation(stub.url)
+        assert main.udp_game_test(*echo, duration=0.2, interval_ms=20, proxy=stub.url) is None
+        results = main.udp_game_batch([stub.url, None], *echo, duration=0.2, interval_ms=20, expect_echo=True)
+        assert results[0] is None and results[1]['received'] == results[1]['sent']
+    finally:
+        stub.close()
+
+
+def test_non_socks_proxy_is_rejected():
+    with pytest.raises(ValueError):
+        main.Socks5UdpAssociation('http://127.0.0.1:8080')
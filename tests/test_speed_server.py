@@ -0,0 +1,91 @@
+import json
+import socket
+
+import pytest
+
+import main
+
+
+@pytest.fixture
+def speed_server(tmp_path):
+    path = tmp_path / 'blob.bin'
+    path.write_bytes(bytes(range(256)) * 64)
+    httpd, url = main.start_speed_server(file_path=str(path))
+    yield httpd, url, path
+    main.stop_local_http_server(httpd)
+
+
+def request(port, raw):
+    """Send raw request bytes, return every response byte until the server closes."""
+    with socket.create_connection(('127.0.0.1', port), timeout=5) as s:
+        s.sendall(raw)
+        data = b''
+        while True:
+            chunk = s.recv(65536)
+            if not chunk:
+                return data
+            data += chunk
+
+
+def split_responses(data):
+    out = []
+    while data:
+        head, _, data = data.partition(b'\r\n\r\n')
+        status, headers = main._parse_http_head(head)
+        n = int(headers.get('content-length', 0))
+        out.append((status, headers, data[:n]))
+        data = data[n:]
+    return out
+
+
+def test_file_download_and_range(speed_server):
+    httpd, url, path = speed_server
+    port = httpd.server_address[1]
+    data = request(port, b'GET /blob.bin HTTP/1.1\r\nHost: x\r\n\r\n'
+                         b'GET /blob.bin HTTP/1.1\r\nHost: x\r\nRange: bytes=10-19\r\nConnection: close\r\n\r\n')
+    (s1, _, b1), (s2, h2, b2) = split_responses(data)
+    assert (s1, b1) == (200, path.read_bytes())
+    assert (s2, b2) == (206, path.read_bytes()[10:20])
+    assert h2['content-range'] == f'bytes 10-19/{path.stat().st_size}'
+
+
+def test_synthetic_payload_sizes_and_keep_alive(speed_server):
+    httpd, _, _ = speed_server
+    port = httpd.server_address[1]
+    size = 3 * main._SPEED_BLOCK // 2  # crosses the block boundary
+    data = request(port, f'GET /speed.bin?size={size} HTTP/1.1\r\nHost: x\r\n\r\n'.encode()
+                         + b'GET /204 HTTP/1.1\r\nHost: x\r\n\r\n'
+                         + b'GET /speed.bin?size=100 HTTP/1.1\r\nHost: x\r\nRange: bytes=200-\r\nConnection: close\r\n\r\n')
+    (s1, _, b1), (s2, _, b2), (s3, h3, _) = split_responses(data)
+    assert s1 == 200 and len(b1) == size and not b1.strip(b'\0')
+    assert (s2, b2) == (204, b'')
+    assert s3 == 416 and h3['content-range'] == 'bytes */100'
+
+
+def test_endless_payload_is_close_delimited(speed_server):
+    httpd, _, _ = speed_server
+    with socket.create_connection(('127.0.0.1', httpd.server_address[1]), timeout=5) as s:
+        s.sendall(b'GET /speed.bin HTTP/1.1\r\nHost: x\r\n\r\n')
+        status, headers, rest = main._read_http_head(s)
+        assert status == 200 and 'content-length' not in headers and headers['connection'] == 'close'
+        got = len(rest)
+        while got < 2 * main._SPEED_BLOCK:
+            got += len(s.recv(1 << 20))
+
+
+def test_upload_counts_body(speed_server):
+    httpd, _, _ = speed_server
+    body = b'x' * 300000
+    data = request(httpd.server_address[1], f'POST /upload HTTP/1.1\r\nHost: x\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n'.encode() + body)
+    (status, _, reply), = split_responses(data)
+    assert status == 200 and json.loads(reply) == {'received': len(body)}
+
+
+def test_download_and_upload_tests_against_local_server(speed_server):
+    httpd, _, _ = speed_server
+    base = f'http://127.0.0.1:{httpd.server_address[1]}'
+    down = main.http_download_test(base + '/speed.bin', duration=0.6, concurrency=2, warmup=0.1, interval=0.1)
+    up = main.http_upload_test(base + '/upload', duration=0.6, concurrency=2, warmup=0.1, interval=0.1)
+    for res in (down, up):
+        assert res['errors'] == 0 and res['total_bytes'] > 0 and res['avg_bps'] > 0
+        assert 0.5 <= res['duration'] < 2.0
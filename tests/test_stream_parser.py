@@ -0,0 +1,55 @@
+import base64
+
+import pytest
+
+import main
+
+LINKS = [f'vless://uuid{i}@host{i}.example:443?type=tcp#node{"x" * i}' for i in range(12)]
+
+
+def split(data, size):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+@pytest.mark.parametrize('size', [1, 2, 3, 5, 7, 64, 1 << 20])
+def test_plain_links_across_chunk_boundaries(size):
+    data = '\n'.join(LINKS).encode()
+    assert list(main.iter_links(split(data, size), sniff_size=16)) == LINKS
+
+
+@pytest.mark.parametrize('size', [1, 3, 100, 1 << 20])
+def test_base64_blob_without_padding(size):
+    data = base64.urlsafe_b64encode('\n'.join(LINKS).encode()).rstrip(b'=')
+    assert list(main.iter_links(split(data, size))) == LINKS
+
+
+@pytest.mark.parametrize('sep', [b'', b'\n', b'\r\n'])
+@pytest.mark.parametrize('size', [1, 2, 3, 5, 7, 64, 1 << 20])
+def test_concatenated_padded_base64_blobs(sep, size):
+    # every blob ends in '=' padding; the decoder must resync after each run
+    blobs = [base64.b64encode((link + '\n').encode()) for link in LINKS]
+    assert any(b.endswith(b'==') for b in blobs) and any(b.endswith(b'=') and not b.endswith(b'==') for b in blobs)
+    data = sep.join(blobs)
+    assert list(main.iter_links(split(data, size), sniff_size=16)) == LINKS
+
+
+def test_base64_with_line_wrapping():
+    data = base64.encodebytes('\n'.join(LINKS).encode())
+    assert list(main.iter_links(split(data, 13))) == LINKS
+
+
+def test_utf8_name_split_inside_a_character():
+    link = 'trojan://pw@host.example:443#Германия 🇩🇪'.replace(' ', '%20')
+    data = (link + '\n').encode()
+    assert list(main.iter_links(split(data, 1))) == [link]
+
+
+def test_empty_stream():
+    assert list(main.iter_links([])) == []
+    assert list(main.iter_links([b''])) == []
+
+
+def test_iter_nodes_parses_streamed_links():
+    nodes = list(main.iter_nodes(split('\n'.join(LINKS[:3]).encode(), 4)))
+    assert [n['protocol'] for n in nodes] == ['vless'] * 3
+    assert [n['add'] for n in nodes] == ['host0.example', 'host1.example', 'host2.example']
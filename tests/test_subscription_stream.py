@@ -0,0 +1,58 @@
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import main
+
+BODY = '\n'.join(f'trojan://pw{i}@host{i}.example:443#n{i}' for i in range(5)).encode()
+
+
+@pytest.fixture
+def sub_server():
+    hits = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            hits.append(self.headers.get('If-None-Match'))
+            if self.headers.get('If-None-Match') == '"v1"':
+                self.send_response(304)
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header('ETag', '"v1"')
+            self.send_header('Content-Length', str(len(BODY)))
+            self.end_headers()
+            self.wfile.write(BODY)
+
+        def log_message(self, *args):
+            pass
+
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    yield f'http://127.0.0.1:{httpd.server_address[1]}/sub', hits
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def test_stream_subscription_uses_etag_cache(sub_server, tmp_path):
+    url, hits = sub_server
+    session = main.make_session(pool_size=1)
+    cache = main.SubscriptionCache(tmp_path)
+    first = list(main.stream_subscription(session, url, cache=cache))
+    second = list(main.stream_subscription(session, url, cache=cache))
+    assert [n['add'] for n in first] == [f'host{i}.example' for i in range(5)]
+    assert second == first
+    assert hits == [None, '"v1"']
+
+
+def test_stream_subscription_falls_back_to_cache(sub_server, tmp_path):
+    url, _ = sub_server
+    session = main.make_session(pool_size=1)
+    cache = main.SubscriptionCache(tmp_path)
+    nodes = list(main.stream_subscription(session, url, cache=cache))
+    dead = 'http://127.0.0.1:1/sub'
+    cache.store(dead, None, None, nodes)
+    assert list(main.stream_subscription(session, dead, cache=cache, timeout=2)) == nodes
+    with pytest.raises(RuntimeError):
+        list(main.stream_subscription(session, dead, timeout=2))
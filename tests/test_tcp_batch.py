@@ -0,0 +1,36 @@
+import socket
+import threading
+
+import main
+
+
+class StubDns(main.DnsCache):
+    """DnsCache whose lookups come from a table; unknown names fail."""
+
+    def __init__(self, table):
+        super().__init__()
+        self.table = table
+        self.lookups = []
+        self.lock = threading.Lock()
+
+    def _lookup(self, host):
+        with self.lock:
+            self.lookups.append(host)
+        if host not in self.table:
+            raise OSError(f'{host}: not found')
+        return [self.table[host]], self.ttl
+
+
+def test_batch_uses_dns_cache_and_marks_unresolvable():
+    srv = socket.create_server(('127.0.0.1', 0))
+    port = srv.getsockname()[1]
+    dns = StubDns({'a.example': '127.0.0.1'})
+    try:
+        res = main.batch_tcp_test([('a.example', port), ('a.example', port), ('127.0.0.1', port), ('gone.example', port)], retries=3, timeout=2, dns_cache=dns)
+    finally:
+        srv.close()
+    assert sorted(dns.lookups) == ['a.example', 'gone.example']
+    assert res[('a.example', port)]['successes'] == 3
+    assert res[('127.0.0.1', port)]['successes'] == 3
+    gone = res[('gone.example', port)]
+    assert gone['attempts'] == 3 and gone['successes'] == 0
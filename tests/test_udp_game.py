@@ -0,0 +1,61 @@
+import asyncio
+
+import pytest
+
+import main
+
+
+@pytest.fixture
+def echo_server():
+    srv, target = main.start_udp_echo_server()
+    host, port = target.rsplit(':', 1)
+    yield host, int(port)
+    srv.close()
+
+
+def test_game_test_against_echo_server(echo_server):
+    host, port = echo_server
+    res = main.udp_game_test(host, port, duration=0.5, interval_ms=10, expect_echo=True)
+    assert res['via'] == 'direct'
+    assert res['received'] == res['sent'] > 0
+    assert res['loss_percent'] == 0.0 and res['reordered'] == 0 and res['duplicates'] == 0
+    # rates come from the real send-phase time, so they stay close to the target
+    assert res['target_pps'] == 100.0
+    assert 80.0 <= res['pps'] <= 105.0
+    assert res['rx_pps'] == pytest.approx(res['pps'])
+
+
+def test_batch_runs_one_flow_per_entry(echo_server):
+    host, port = echo_server
+    results = main.udp_game_batch([None, None, None], host, port, duration=0.3, interval_ms=20, expect_echo=True)
+    assert len(results) == 3
+    assert all(r['sent'] and r['received'] == r['sent'] for r in results)
+
+
+def test_async_game_test_against_echo_server(echo_server):
+    host, port = echo_server
+    res = asyncio.run(main.async_udp_game_test(host, port, duration=0.5, interval_ms=10, expect_echo=True))
+    assert res['received'] == res['sent'] > 0
+    assert 80.0 <= res['pps'] <= 105.0
+    assert res['rx_pps'] == pytest.approx(res['pps'])
+
+
+def test_stats_detect_reordering_duplicates_and_foreign_packets():
+    stats = main._GameStats(60)
+    packets = [bytes(stats.packet()) for _ in range(4)]
+    for seq in (0, 2, 1, 1):
+        stats.on_datagram(packets[seq])
+    stats.on_datagram(b'garbage' * 10)
+    stats.on_datagram(packets[3][:8])
+    res = stats.result(1.0, 250, True)
+    assert (res['sent'], res['received']) == (4, 3)
+    assert res['reordered'] == 1 and res['duplicates'] == 1
+    assert res['loss_percent'] == 25.0
+
+
+def test_no_echo_means_no_loss_figure():
+    srv, target = main.start_udp_echo_server()
+    host, port = target.rsplit(':', 1)
+    srv.close()
+    res = main.udp_game_test(host, int(port), duration=0.2, interval_ms=20, expect_echo=False)
+    assert res['sent'] > 0 and res['loss_percent'] is None
@@ -0,0 +1,62 @@
+import json
+
+import pytest
+
+import main
+
+
+class FakeProc:
+    def poll(self):
+        return None
+
+
+@pytest.fixture
+def fake_xray(monkeypatch):
+    state = {'tests': 0, 'spawns': 0, 'start_fails': False}
+
+    def check(cfg, xray_path='xray', timeout=15):
+        state['tests'] += 1
+        bad = any('bad' in json.dumps(ob.get('settings')) for ob in cfg['outbounds'])
+        return not bad, 'rejected' if bad else 'Configuration OK.'
+
+    def spawn(cfg, xray_path, wait_port, start_timeout=5, prefix=''):
+        state['spawns'] += 1
+        if state['start_fails'] or any('bad' in json.dumps(ob.get('settings')) for ob in cfg['outbounds']):
+            return None, None
+        return FakeProc(), None
+
+    monkeypatch.setattr(main, 'check_xray_config', check)
+    monkeypatch.setattr(main, '_spawn_xray', spawn)
+    monkeypatch.setattr(main, 'stop_xray', lambda x: None)
+    return state
+
+
+def trojan(i, password=None):
+    password = password or f'pw{i}'
+    return ({'protocol': 'trojan', 'add': '192.0.2.1', 'port': '443', 'password': password, 'net': 'tcp', 'raw': f'trojan://{password}@192.0.2.1:443#{i}'}, None)
+
+
+def test_rejected_outbounds_are_dropped_not_the_batch(fake_xray):
+    entries = [trojan(i, 'bad' if i in (2, 5) else None) for i in range(8)]
+    batch = main.XrayBatch(entries)
+    proxies = [batch.proxy_for(i) for i in range(8)]
+    assert [p is None for p in proxies] == [i in (2, 5) for i in range(8)]
+    assert sorted(i for i, _ in batch.rejected) == [2, 5]
+    assert fake_xray['spawns'] == 1
+    assert fake_xray['tests'] < 2 * 8
+
+
+def test_failed_batch_is_not_respawned(fake_xray):
+    fake_xray['start_fails'] = True
+    batch = main.XrayBatch([trojan(i) for i in range(4)])
+    assert [batch.proxy_for(i) for i in range(4)] == [None] * 4
+    assert batch.failed
+    assert fake_xray['spawns'] == 1
+
+
+def test_check_outbounds_isolates_invalid(fake_xray):
+    nodes = [trojan(i, 'bad' if i == 3 else None)[0] for i in range(6)] + [{'protocol': 'unknown', 'raw': 'x://'}]
+    report = main.check_outbounds(nodes, batch_size=4)
+    assert report['ok'] == 5
+    assert [n['raw'] for n, _ in report['invalid']] == [nodes[3]['raw']]
+    assert len(report['unsupported']) == 1
@@ -0,0 +1,93 @@
+import pytest
+
+import main
+
+
+@pytest.mark.parametrize('net, field, expected', [
+    ('ws', lambda st: st['wsSettings']['headers']['Host'], 'cdn.example.com'),
+    ('grpc', lambda st: st['grpcSettings']['authority'], 'cdn.example.com'),
+    ('h2', lambda st: st['httpSettings']['host'], ['cdn.example.com']),
+    ('httpupgrade', lambda st: st['httpupgradeSettings']['host'], 'cdn.example.com'),
+    ('xhttp', lambda st: st['xhttpSettings']['host'], 'cdn.example.com'),
+])
+def test_resolved_address_keeps_hostname(net, field, expected):
+    node = {'protocol': 'vless', 'add': 'cdn.example.com', 'port': '443', 'id': 'uuid', 'net': net, 'security': 'tls', 'raw': f'vless-{net}'}
+    outbound = main.compile_xray_outbound(node, address='192.0.2.1')
+    stream = outbound['streamSettings']
+    assert outbound['settings']['vnext'][0]['address'] == '192.0.2.1'
+    assert field(stream) == expected
+    assert stream['tlsSettings']['serverName'] == 'cdn.example.com'
+
+
+def test_explicit_host_and_sni_win():
+    node = {'protocol': 'vless', 'add': 'cdn.example.com', 'port': '443', 'id': 'uuid', 'net': 'ws', 'host': 'front.example', 'sni': 'sni.example', 'security': 'tls', 'raw': 'vless-explicit'}
+    stream = main.compile_xray_outbound(node, address='192.0.2.1')['streamSettings']
+    assert stream['wsSettings']['headers'] == {'Host': 'front.example'}
+    assert stream['tlsSettings']['serverName'] == 'sni.example'
+
+
+def test_no_override_leaves_host_empty():
+    node = {'protocol': 'vless', 'add': 'cdn.example.com', 'port': '443', 'id': 'uuid', 'net': 'ws', 'raw': 'vless-plain'}
+    assert main.compile_xray_outbound(node)['streamSettings']['wsSettings']['headers'] == {}
+
+
+def test_vmess_user_and_tcp_http_header():
+    node = {'protocol': 'vmess', 'add': 'v.example', 'port': '8080', 'id': 'uuid', 'aid': '2', 'scy': 'aes-128-gcm', 'net': 'tcp', 'type': 'http', 'host': 'a.example,b.example', 'path': '/x,/y', 'raw': 'vmess-tcp-http'}
+    outbound = main.compile_xray_outbound(node)
+    assert outbound['protocol'] == 'vmess'
+    assert outbound['settings']['vnext'][0]['users'] == [{'id': 'uuid', 'alterId': 2, 'security': 'aes-128-gcm'}]
+    stream = outbound['streamSettings']
+    assert stream['network'] == 'tcp' and 'security' not in stream
+    assert stream['tcpSettings']['header'] == {'type': 'http', 'request': {'path': ['/x', '/y'], 'headers': {'Host': ['a.example', 'b.example']}}}
+
+
+def test_trojan_defaults_to_tls():
+    node = {'protocol': 'trojan', 'add': 't.example', 'port': '443', 'password': 'secret', 'alpn': 'h2,http/1.1', 'fp': 'firefox', 'raw': 'trojan-plain'}
+    outbound = main.compile_xray_outbound(node)
+    assert outbound['settings'] == {'servers': [{'address': 't.example', 'port': 443, 'password': 'secret'}]}
+    tls = outbound['streamSettings']['tlsSettings']
+    assert outbound['streamSettings']['security'] == 'tls'
+    assert tls == {'serverName': 't.example', 'allowInsecure': False, 'fingerprint': 'firefox', 'alpn': ['h2', 'http/1.1']}
+    assert main.compile_xray_outbound(dict(node, password='')) is None
+
+
+def test_shadowsocks_and_plugin():
+    node = {'protocol': 'ss', 'add': 's.example', 'port': '8388', 'method': 'chacha20-ietf-poly1305', 'password': 'pw', 'raw': 'ss-plain'}
+    outbound = main.compile_xray_outbound(node)
+    assert outbound == {'protocol': 'shadowsocks', 'settings': {'servers': [{'address': 's.example', 'port': 8388, 'method': 'chacha20-ietf-poly1305', 'password': 'pw'}]}}
+    assert main.compile_xray_outbound(dict(node, plugin='obfs-local;obfs=http')) is None
+    assert main.build_xray_outbound(dict(node, plugin='v2ray-plugin', raw='ss-plugin'), tag='n1') is None
+
+
+def test_reality_requires_public_key():
+    node = {'protocol': 'vless', 'add': 'r.example', 'port': '443', 'id': 'uuid', 'flow': 'xtls-rprx-vision', 'security': 'reality', 'sni': 'www.example.com', 'pbk': 'PUBKEY', 'sid': 'ab', 'raw': 'vless-reality'}
+    outbound = main.compile_xray_outbound(node)
+    assert outbound['settings']['vnext'][0]['users'][0]['flow'] == 'xtls-rprx-vision'
+    assert outbound['streamSettings']['security'] == 'reality'
+    assert outbound['streamSettings']['realitySettings'] == {'serverName': 'www.example.com', 'fingerprint': 'chrome', 'publicKey': 'PUBKEY', 'shortId': 'ab', 'spiderX': ''}
+    assert main.compile_xray_outbound(dict(node, pbk='')) is None
+
+
+def test_kcp_header_and_seed():
+    node = {'protocol': 'vmess', 'add': 'k.example', 'port': '1000', 'id': 'uuid', 'net': 'kcp', 'type': 'wechat-video', 'path': 'seed', 'raw': 'vmess-kcp'}
+    stream = main.compile_xray_outbound(node)['streamSettings']
+    assert stream['network'] == 'kcp'
+    assert stream['kcpSettings'] == {'header': {'type': 'wechat-video'}, 'seed': 'seed'}
+
+
+@pytest.mark.parametrize('node', [
+    {'protocol': 'vless', 'add': 'x.example', 'port': '443', 'id': 'uuid', 'net': 'quic'},
+    {'protocol': 'vless', 'add': 'x.example', 'port': '443', 'id': 'uuid', 'security': 'xtls'},
+    {'protocol': 'vless', 'add': 'x.example', 'port': 'abc', 'id': 'uuid'},
+    {'protocol': 'vless', 'add': 'x.example', 'port': '443'},
+    {'protocol': 'hysteria2', 'add': 'x.example', 'port': '443', 'password': 'pw'},
+])
+def test_unsupported_nodes_give_none(node):
+    assert main.compile_xray_outbound(node) is None
+
+
+def test_build_adds_tag_without_touching_cache():
+    node = {'protocol': 'trojan', 'add': 't.example', 'port': '443', 'password': 'secret', 'raw': 'trojan-tagged'}
+    tagged = main.build_xray_outbound(node, tag='n7')
+    assert tagged['tag'] == 'n7'
+    assert 'tag' not in main.build_xray_outbound(node)